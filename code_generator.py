@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+激活码批量生成 - 加密安全随机数，按现有激活码文件格式输出
+"""
+
+import os
+import time
+import secrets
+from array import array
+from typing import Iterable, List, Optional
+
+from code_pool import CodePool, decode_code
+from code_ledger import ConsumptionLedger
+
+# 10位36进制激活码的取值空间（小于2^52）
+CODE_SPACE = 36 ** 10
+_MASK52 = (1 << 52) - 1
+# 2^52 中落在取值空间内的比例约81%，按此多取一些随机字节以减少补抽轮数
+_OVERDRAW = 1.3
+
+SEPARATOR = '=' * 51
+GROUP_SEPARATOR = '======'
+
+
+def random_code_values(count: int) -> List[int]:
+    """批量生成count个均匀分布的激活码整数（可能有重复，由调用方去重）
+
+    一次取出整批随机字节转成64位整数数组，截取低52位后拒绝采样，
+    避免逐字符生成。
+    """
+    result = []
+    while len(result) < count:
+        need = count - len(result)
+        batch = array('Q')
+        batch.frombytes(secrets.token_bytes(8 * (int(need * _OVERDRAW) + 16)))
+        result.extend(v for v in (x & _MASK52 for x in batch) if v < CODE_SPACE)
+    del result[count:]
+    return result
+
+
+def generate_codes(count: int, pools: Iterable[CodePool] = (),
+                   ledger: Optional[ConsumptionLedger] = None) -> List[int]:
+    """生成count个不重复的新激活码，排除现有激活码池和消耗账本中已有的激活码"""
+    pools = list(pools)
+    result = []
+    seen = set()
+    while len(result) < count:
+        batch = [v for v in random_code_values(count - len(result)) if v not in seen]
+        batch = list(dict.fromkeys(batch))
+        for pool in pools:
+            batch = pool.exclude(batch)
+        if ledger is not None and batch:
+            # 账本先经布隆过滤器筛查，只对可能命中的做精确确认
+            issued = ledger.find_consumed(batch)
+            if issued:
+                batch = [v for v in batch if v not in issued]
+        seen.update(batch)
+        result.extend(batch)
+    return result
+
+
+def format_code_file(days: str, values: List[int], group_size: int = 100) -> str:
+    """按现有激活码文件格式排版：文件头 + 分组激活码"""
+    lines = [
+        f'激活码列表 - {days}天有效期',
+        f'生成时间: {time.strftime("%Y-%m-%d %H:%M:%S")}',
+        f'总数: {len(values)}',
+        '字符集: A-Z, 0-9 (36个字符)',
+        SEPARATOR,
+        '',
+    ]
+    codes = [decode_code(v) for v in values]
+    for group, start in enumerate(range(0, len(codes), group_size), 1):
+        chunk = codes[start:start + group_size]
+        if group > 1:
+            lines.extend(['', GROUP_SEPARATOR, ''])
+        lines.append(f'第 {group} 组 (共 {len(chunk)} 个):')
+        lines.extend(chunk)
+    return '\n'.join(lines) + '\n'
+
+
+def write_code_file(path: str, days: str, values: List[int], group_size: int = 100):
+    """写出激活码文件（先写临时文件再原子替换）"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(format_code_file(days, values, group_size))
+    os.replace(tmp_path, path)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量导入激活码文件 - 多进程并行解析，合并去重后一次写入
+"""
+
+import os
+import time
+import zipfile
+import itertools
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from code_pool import CodePool, read_code_values
+from code_ledger import ConsumptionLedger
+from code_generator import write_code_file
+
+
+class FileStats(NamedTuple):
+    """单个文件的导入统计"""
+    path: str
+    valid: int = 0          # 文件中的有效激活码
+    duplicates: int = 0     # 文件内重复或与前面的文件重复
+    existing: int = 0       # 已在激活码池中
+    issued: int = 0         # 已发放过（账本中有记录）
+    imported: int = 0       # 实际导入
+    error: str = ''
+
+
+class ImportResult(NamedTuple):
+    """批量导入结果"""
+    output_path: Optional[str]   # 合并后写入的激活码文件（没有可导入的激活码时为None）
+    imported: int
+    files: List[FileStats]
+
+
+def scan_code_file(path: str) -> Tuple[str, bytes, str]:
+    """解析单个激活码文件（在工作进程中运行），返回(路径, 激活码数组字节, 错误信息)
+
+    文本文件和 .gz/.zip 压缩包都按块流式解析；结果以紧凑字节返回，减少进程间传输开销。
+    """
+    try:
+        values = array('Q', read_code_values(path))
+        return path, values.tobytes(), ''
+    except (OSError, EOFError, zipfile.BadZipFile) as e:
+        return path, b'', str(e)
+
+
+def scan_code_files(paths: List[str], workers: Optional[int] = None,
+                    use_processes: bool = True, mp_context=None) -> List[Tuple[str, bytes, str]]:
+    """并行解析多个文件，结果顺序与输入一致"""
+    if use_processes and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            return list(executor.map(scan_code_file, paths))
+    return [scan_code_file(path) for path in paths]
+
+
+def _reserve_output_path(output_dir: str, days: str) -> str:
+    """导入结果的新文件名（同一秒内多次导入时加序号）
+
+    以独占方式先创建空文件占住名称，写入时原子替换它，不会覆盖之前导入的文件。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    for n in itertools.count(1):
+        suffix = f'-{n}' if n > 1 else ''
+        path = os.path.join(output_dir, f'code{days}day-import-{stamp}{suffix}.txt')
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        return path
+
+
+def import_code_files(paths: List[str], days: str, output_dir: str,
+                      pools: Iterable[CodePool] = (),
+                      ledger: Optional[ConsumptionLedger] = None,
+                      workers: Optional[int] = None,
+                      use_processes: bool = True, mp_context=None) -> ImportResult:
+    """批量导入激活码文件
+
+    各文件在工作进程中并行解析；主进程按文件顺序去重，排除激活码池中已有的和
+    账本中已发放过的，最后把全部新激活码合并写入一个文件（原子写入，
+    要么全部导入要么都不导入）。
+    use_processes 为False时在当前进程中逐个解析（Android等不便启动子进程的环境）。
+    """
+    scans = scan_code_files(paths, workers, use_processes, mp_context)
+
+    seen = set()
+    per_file = []   # [(路径, 有效数, 去重后的激活码 或 错误信息)]
+    for path, raw, error in scans:
+        if error:
+            per_file.append((path, 0, error))
+            continue
+        values = array('Q')
+        values.frombytes(raw)
+        unique = [v for v in dict.fromkeys(values) if v not in seen]
+        seen.update(unique)
+        per_file.append((path, len(values), unique))
+
+    candidates = [v for _path, _valid, unique in per_file
+                  if not isinstance(unique, str) for v in unique]
+    remaining = candidates
+    for pool in pools:
+        remaining = pool.exclude(remaining)
+    not_existing = set(remaining)
+    issued = ledger.find_consumed(remaining) if ledger is not None else set()
+
+    stats = []
+    merged = []
+    for path, valid, unique in per_file:
+        if isinstance(unique, str):
+            stats.append(FileStats(path, error=unique))
+            continue
+        imported = [v for v in unique if v in not_existing and v not in issued]
+        existing = sum(1 for v in unique if v not in not_existing)
+        stats.append(FileStats(path, valid=valid, duplicates=valid - len(unique),
+                               existing=existing, issued=len(unique) - existing - len(imported),
+                               imported=len(imported)))
+        merged.extend(imported)
+
+    output_path = None
+    if merged:
+        output_path = _reserve_output_path(output_dir, days)
+        try:
+            write_code_file(output_path, days, merged)
+        except BaseException:
+            os.remove(output_path)
+            raise
+    return ImportResult(output_path, len(merged), stats)
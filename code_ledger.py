@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+激活码消耗账本 - 只追加的二进制日志，配合布隆过滤器快速筛查历史激活码
+"""
+
+import math
+import time
+import heapq
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from storage import Storage, as_storage
+
+# 档位编号（写入日志时用1字节表示）
+TIERS = ('1', '30', '90', '365')
+TIER_IDS = {tier: i for i, tier in enumerate(TIERS)}
+
+# 日志记录：操作、档位、提交序号、时间戳、激活码
+# 撤销记录的提交序号字段为被撤销的提交序号，每个被撤销的激活码一条
+_RECORD = struct.Struct('<BBIIQ')
+OP_CONSUME = 1
+OP_UNDO = 2
+# 其他设备消耗的激活码（同步导入），提交序号为0，不能撤销
+OP_REMOTE = 3
+_CONSUMING = (OP_CONSUME, OP_REMOTE)
+
+# 布隆过滤器文件头：魔数、位数、哈希次数、已加入数量、已覆盖的日志字节数、已撤销提交数、快照代数
+# 头部之后依次是位数组和已撤销的提交序号（uint32数组）
+_BLOOM_HEADER = struct.Struct('<4sQIQQII')
+_BLOOM_MAGIC = b'SCB3'
+
+# 快照文件头：魔数、快照代数、最后提交序号、已折叠的日志字节数、折叠处的最后一条日志记录
+# 之后是各档位的激活码数量，以及各档位排序后的激活码（uint64数组）
+_SNAPSHOT_HEADER = struct.Struct(f'<4sIIQ{_RECORD.size}s')
+_SNAPSHOT_COUNTS = struct.Struct(f'<{len(TIERS)}I')
+_SNAPSHOT_MAGIC = b'SCS1'
+
+# 日志中的记录数超过该值时折叠进快照（启动时最多重放这么多条记录）
+CHECKPOINT_RECORDS = 20000
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_READ_CHUNK = _RECORD.size * 4096
+
+# 存储中的名称
+JOURNAL_NAME = 'ledger.bin'
+BLOOM_NAME = 'ledger.bloom'
+SNAPSHOT_NAME = 'ledger.snap'
+
+
+def _mix64(x: int) -> int:
+    """splitmix64混合函数，把激活码整数打散为均匀的64位哈希"""
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    """布隆过滤器 - 判断"一定不存在"或"可能存在" """
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.01):
+        capacity = max(capacity, 1024)
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: int) -> Iterator[int]:
+        h = _mix64(value)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def add(self, value: int):
+        bits = self.bits
+        for pos in self._positions(value):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value: int) -> bool:
+        bits = self.bits
+        for pos in self._positions(value):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def filter_possible(self, values: Iterable[int]) -> List[int]:
+        """批量筛查，返回可能存在的值（内联哈希计算，比逐个 in 判断快）"""
+        bits = self.bits
+        num_bits = self.num_bits
+        hashes = range(self.num_hashes)
+        mix = _mix64
+        possible = []
+        for value in values:
+            h = mix(value)
+            h1 = h & 0xFFFFFFFF
+            h2 = (h >> 32) | 1
+            for i in hashes:
+                pos = (h1 + i * h2) % num_bits
+                if not bits[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                possible.append(value)
+        return possible
+
+    @property
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    def to_bytes(self, covered: int, undone: Iterable[int] = (), generation: int = 0) -> bytes:
+        undone = array('I', sorted(undone))
+        header = _BLOOM_HEADER.pack(_BLOOM_MAGIC, self.num_bits, self.num_hashes,
+                                    self.count, covered, len(undone), generation)
+        return header + bytes(self.bits) + undone.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Tuple['BloomFilter', int, Set[int], int]:
+        """解析过滤器数据，返回(过滤器, 已覆盖的日志字节数, 已撤销的提交序号, 快照代数)"""
+        (magic, num_bits, num_hashes, count, covered,
+         num_undone, generation) = _BLOOM_HEADER.unpack_from(data)
+        nbytes = (num_bits + 7) // 8
+        bits = data[_BLOOM_HEADER.size:_BLOOM_HEADER.size + nbytes]
+        undone = array('I')
+        undone.frombytes(data[_BLOOM_HEADER.size + nbytes:])
+        if magic != _BLOOM_MAGIC or len(bits) != nbytes or len(undone) != num_undone:
+            raise ValueError('布隆过滤器文件损坏')
+        bloom = cls.__new__(cls)
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.capacity = max(1024, int(num_bits * (math.log(2) ** 2) / -math.log(0.01)))
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom, covered, set(undone), generation
+
+
+class ConsumptionLedger:
+    """激活码消耗账本
+
+    每次复制消耗激活码时追加一条提交（同一提交的激活码共享提交序号），
+    历史激活码只保存在磁盘日志中；布隆过滤器常驻内存用于快速排除，
+    只有"可能存在"时才顺序扫描日志做精确确认。
+    撤销也是追加记录，被撤销的提交序号常驻内存，读取日志时跳过这些提交。
+
+    日志变长后由 checkpoint 折叠进快照（各档位排序后的激活码数组）并清空，
+    启动时只需加载快照、重放快照之后的日志，耗时与累计消耗量无关。
+    快照之前的提交不能再撤销。
+    """
+
+    def __init__(self, storage: Union[Storage, str]):
+        self.storage = as_storage(storage)
+        self.last_seq = 0
+        self.bloom = BloomFilter()
+        self.undone = set()    # 已撤销的提交序号
+        self.generation = 0    # 快照代数，每次折叠加一
+        self.snapshot = {tier_id: array('Q') for tier_id in range(len(TIERS))}
+        self.journal_start = 0  # 日志中尚未折叠进快照的起点（正常为0，见 _load_snapshot）
+        self._snapshot_values = None
+        self._bloom_dirty = False
+        self._open()
+
+    def _journal_size(self) -> int:
+        return self.storage.size(JOURNAL_NAME)
+
+    def _open(self):
+        """加载快照和布隆过滤器，并补上过滤器之后新增的日志"""
+        size = self._journal_size()
+        if size % _RECORD.size:
+            # 截掉崩溃时写了一半的记录，保证后续追加对齐
+            size -= size % _RECORD.size
+            self.storage.truncate(JOURNAL_NAME, size)
+        size = self._load_snapshot(size)
+        covered = None
+        try:
+            data = self.storage.get(BLOOM_NAME)
+            if data is not None:
+                bloom, covered, undone, generation = BloomFilter.from_bytes(data)
+                if generation == self.generation and self.journal_start <= covered <= size:
+                    self.bloom = bloom
+                    self.undone = undone
+                else:
+                    covered = None  # 过滤器与快照或日志不一致（折叠时中断），重建
+        except (ValueError, struct.error):
+            covered = None
+        if covered is None:
+            covered = self.journal_start
+            self.bloom = BloomFilter(capacity=max(1000000, 2 * len(self.snapshot_values())))
+            for code in self.snapshot_values():
+                self.bloom.add(code)
+            self._bloom_dirty = True
+        for op, _tier, seq, _ts, code in self._iter_records(covered):
+            if op in _CONSUMING:
+                self.bloom.add(code)
+            elif op == OP_UNDO:
+                self.undone.add(seq)
+            self._bloom_dirty = True
+        if self.bloom.is_full:
+            self._rebuild_filter()
+        # 末尾可能是撤销记录（其序号为被撤销的提交），取最后一条消耗记录的序号
+        for op, _tier, seq, _ts, _code in self._iter_records_reversed():
+            if op == OP_CONSUME:
+                self.last_seq = seq
+                break
+
+    def _load_snapshot(self, size: int) -> int:
+        """加载快照，返回日志大小
+
+        折叠时先写快照再清空日志；如果日志中折叠处的记录与快照中保存的一致，
+        说明清空前中断，此时补做清空（之后没有新记录时）或从折叠处开始读取。
+        快照损坏时报错而不是忽略，避免已发放的激活码被再次发出。
+        """
+        data = self.storage.get(SNAPSHOT_NAME)
+        if data is None:
+            return size
+        try:
+            magic, generation, last_seq, covered, last_record = _SNAPSHOT_HEADER.unpack_from(data)
+            counts = _SNAPSHOT_COUNTS.unpack_from(data, _SNAPSHOT_HEADER.size)
+        except struct.error:
+            raise ValueError('账本快照损坏')
+        pos = _SNAPSHOT_HEADER.size + _SNAPSHOT_COUNTS.size
+        if magic != _SNAPSHOT_MAGIC or len(data) != pos + 8 * sum(counts):
+            raise ValueError('账本快照损坏')
+        for tier_id, count in enumerate(counts):
+            codes = array('Q')
+            codes.frombytes(data[pos:pos + 8 * count])
+            self.snapshot[tier_id] = codes
+            pos += 8 * count
+        self.generation = generation
+        self.last_seq = last_seq
+        if covered and size >= covered and \
+                self.storage.read(JOURNAL_NAME, covered - _RECORD.size, _RECORD.size) == last_record:
+            if size == covered:
+                self.storage.truncate(JOURNAL_NAME, 0)
+                return 0
+            self.journal_start = covered
+        return size
+
+    def snapshot_values(self) -> array:
+        """快照中的全部激活码（排序）"""
+        if self._snapshot_values is None:
+            self._snapshot_values = array('Q', sorted(
+                code for tier_id in sorted(self.snapshot) for code in self.snapshot[tier_id]))
+        return self._snapshot_values
+
+    def _in_snapshot(self, code: int) -> bool:
+        values = self.snapshot_values()
+        i = bisect_left(values, code)
+        return i < len(values) and values[i] == code
+
+    def is_checkpointed(self, code: int) -> bool:
+        """激活码的消耗已折叠进快照（不能再撤销）"""
+        return self._in_snapshot(code)
+
+    def _iter_records(self, start: int = 0) -> Iterator[Tuple[int, int, int, int, int]]:
+        """顺序读取日志记录 (操作, 档位编号, 提交序号, 时间戳, 激活码)"""
+        read = self.storage.read
+        pos = max(start, self.journal_start)
+        while True:
+            chunk = read(JOURNAL_NAME, pos, _READ_CHUNK)
+            if len(chunk) < _RECORD.size:
+                return
+            usable = len(chunk) - len(chunk) % _RECORD.size
+            yield from _RECORD.iter_unpack(chunk[:usable])
+            if usable != len(chunk):
+                return
+            pos += usable
+
+    def _iter_records_reversed(self) -> Iterator[Tuple[int, int, int, int, int]]:
+        """从日志末尾向前逐块读取记录"""
+        pos = self.tell()
+        while pos > self.journal_start:
+            step = min(_READ_CHUNK, pos - self.journal_start)
+            pos -= step
+            yield from reversed(list(_RECORD.iter_unpack(self.storage.read(JOURNAL_NAME, pos, step))))
+
+    def _rebuild_filter(self):
+        """过滤器超出容量时按两倍容量重建，保持误判率"""
+        undone = self.undone
+        count = sum(1 for r in self._iter_records() if r[0] in _CONSUMING and r[2] not in undone)
+        bloom = BloomFilter(capacity=(count + len(self.snapshot_values())) * 2)
+        for code in self.snapshot_values():
+            bloom.add(code)
+        for op, _tier, seq, _ts, code in self._iter_records():
+            if op in _CONSUMING and seq not in undone:
+                bloom.add(code)
+        self.bloom = bloom
+        self._bloom_dirty = True
+
+    def commit(self, tier: str, codes: Iterable[int]) -> int:
+        """记录一次消耗提交，返回提交序号"""
+        return self.commit_entries((tier, code) for code in codes)
+
+    def commit_entries(self, entries: Iterable[Tuple[str, int]]) -> int:
+        """记录一次可包含多个档位的消耗提交（组合订单一次写入），返回提交序号"""
+        seq = self.last_seq + 1
+        ts = int(time.time())
+        entries = [(TIER_IDS[tier], code) for tier, code in entries]
+        codes = [code for _tier_id, code in entries]
+        data = b''.join(_RECORD.pack(OP_CONSUME, tier_id, seq, ts, code)
+                        for tier_id, code in entries)
+        self.storage.append(JOURNAL_NAME, data)
+        self.last_seq = seq
+        for code in codes:
+            self.bloom.add(code)
+        self._bloom_dirty = True
+        if self.bloom.is_full:
+            self._rebuild_filter()
+        return seq
+
+    def record_remote(self, entries: Iterable[Tuple[str, int]]) -> int:
+        """记录在其他设备上消耗的激活码 [(档位, 激活码)]（同步导入，不能撤销），返回记录数"""
+        ts = int(time.time())
+        entries = [(TIER_IDS[tier], code) for tier, code in entries]
+        if not entries:
+            return 0
+        self.storage.append(JOURNAL_NAME, b''.join(_RECORD.pack(OP_REMOTE, tier_id, 0, ts, code)
+                                                   for tier_id, code in entries))
+        for _tier_id, code in entries:
+            self.bloom.add(code)
+        self._bloom_dirty = True
+        if self.bloom.is_full:
+            self._rebuild_filter()
+        return len(entries)
+
+    def _last_commit(self) -> Tuple[int, List[Tuple[int, int]]]:
+        """从日志末尾向前找到最近一次未撤销的提交，返回(提交序号, [(档位编号, 激活码)])
+
+        同一提交的记录是一次写入的，在日志中连续，通常只需读取末尾一块。
+        """
+        last_seq = 0
+        records = []
+        for op, tier_id, seq, _ts, code in self._iter_records_reversed():
+            if op != OP_CONSUME or seq in self.undone:
+                continue
+            if last_seq and seq != last_seq:
+                break
+            last_seq = seq
+            records.append((tier_id, code))
+        return last_seq, records
+
+    def undo_last(self) -> List[Tuple[str, int]]:
+        """撤销最近一次未撤销的提交，返回被撤销的[(档位, 激活码)]，没有可撤销的提交时返回空列表
+
+        只追加撤销记录，不改写日志；布隆过滤器中的激活码保留（仅多一次精确确认）。
+        """
+        seq, records = self._last_commit()
+        if not seq:
+            return []
+        ts = int(time.time())
+        data = b''.join(_RECORD.pack(OP_UNDO, tier_id, seq, ts, code) for tier_id, code in records)
+        self.storage.append(JOURNAL_NAME, data)
+        self.undone.add(seq)
+        self._bloom_dirty = True
+        return [(TIERS[tier_id], code) for tier_id, code in reversed(records)]
+
+    def might_contain(self, code: int) -> bool:
+        """布隆过滤器判断：False表示一定未消耗过"""
+        return code in self.bloom
+
+    def find_consumed(self, codes: Iterable[int]) -> Set[int]:
+        """返回给定激活码中已消耗过的部分 - 先过滤器筛查，仅对可能命中的做精确确认"""
+        if not self.bloom.count:
+            return set()
+        candidates = set(self.bloom.filter_possible(codes))
+        if not candidates:
+            return set()
+        found = {code for code in candidates if self._in_snapshot(code)}
+        candidates -= found
+        if not candidates:
+            return found
+        undone = self.undone
+        for op, _tier, seq, _ts, code in self._iter_records():
+            if op in _CONSUMING and code in candidates and seq not in undone:
+                found.add(code)
+        return found
+
+    def tell(self) -> int:
+        """当前日志末尾位置，可作为 iter_consumed 的起点只读取之后新增的记录"""
+        size = self._journal_size()
+        return size - size % _RECORD.size
+
+    def iter_consumed(self, tier: Optional[str] = None, start: int = 0,
+                      snapshot: bool = True) -> Iterator[int]:
+        """遍历已消耗的激活码（可按档位过滤）
+
+        从日志开头读取时先给出快照中的激活码；snapshot 为False时只读日志
+        （快照部分已用 snapshot_values 批量处理时）。
+        """
+        tier_id = TIER_IDS[tier] if tier is not None else None
+        if snapshot and start <= self.journal_start:
+            for t, codes in self.snapshot.items():
+                if tier_id is None or t == tier_id:
+                    yield from codes
+        undone = self.undone
+        for op, t, seq, _ts, code in self._iter_records(start):
+            if op in _CONSUMING and seq not in undone and (tier_id is None or t == tier_id):
+                yield code
+
+    def consumed_entries(self) -> List[Tuple[int, int]]:
+        """全部已消耗的激活码 [(激活码, 档位编号)]，按激活码排序去重
+
+        快照中各档位已排序，只需排序日志中的部分再归并。
+        """
+        undone = self.undone
+        journal = sorted((code, tier_id) for op, tier_id, seq, _ts, code in self._iter_records()
+                         if op in _CONSUMING and seq not in undone)
+        tiers = [[(code, tier_id) for code in codes] for tier_id, codes in self.snapshot.items()]
+        entries = []
+        last = None
+        for code, tier_id in heapq.merge(journal, *tiers):
+            if code != last:
+                entries.append((code, tier_id))
+                last = code
+        return entries
+
+    def iter_undone(self, start: int = 0) -> Iterator[int]:
+        """遍历start之后撤销记录中的激活码（用于把撤销同步到增量加载的激活码池）"""
+        for op, _tier, _seq, _ts, code in self._iter_records(start):
+            if op == OP_UNDO:
+                yield code
+
+    def save_filter(self):
+        """持久化布隆过滤器（原子替换）"""
+        if not self._bloom_dirty:
+            return
+        self.storage.put(BLOOM_NAME, self.bloom.to_bytes(self.tell(), self.undone, self.generation))
+        self._bloom_dirty = False
+
+    @property
+    def journal_records(self) -> int:
+        """日志中尚未折叠进快照的记录数"""
+        return (self.tell() - self.journal_start) // _RECORD.size
+
+    @property
+    def needs_checkpoint(self) -> bool:
+        return self.journal_records >= CHECKPOINT_RECORDS
+
+    def checkpoint(self) -> bool:
+        """把日志折叠进快照并清空日志，日志为空时不做任何事，返回是否折叠
+
+        快照原子写入后才清空日志，任一步中断都能在下次打开时恢复（见 _load_snapshot）。
+        折叠后之前的提交不能再撤销。
+        """
+        size = self.tell()
+        if size <= self.journal_start:
+            return False
+        added = {tier_id: [] for tier_id in self.snapshot}
+        undone = self.undone
+        for op, tier_id, seq, _ts, code in self._iter_records():
+            if op in _CONSUMING and seq not in undone:
+                added[tier_id].append(code)
+        snapshot = {}
+        for tier_id, codes in self.snapshot.items():
+            if added[tier_id]:
+                codes = array('Q', sorted(set(codes).union(added[tier_id])))
+            snapshot[tier_id] = codes
+        last_record = self.storage.read(JOURNAL_NAME, size - _RECORD.size, _RECORD.size)
+        generation = self.generation + 1
+        tier_ids = sorted(snapshot)
+        header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, generation, self.last_seq, size, last_record)
+        counts = _SNAPSHOT_COUNTS.pack(*(len(snapshot[tier_id]) for tier_id in tier_ids))
+        self.storage.put(SNAPSHOT_NAME, header + counts +
+                         b''.join(snapshot[tier_id].tobytes() for tier_id in tier_ids))
+        self.storage.truncate(JOURNAL_NAME, 0)
+        self.snapshot = snapshot
+        self._snapshot_values = None
+        self.generation = generation
+        self.journal_start = 0
+        self.undone = set()
+        self._bloom_dirty = True
+        self.save_filter()
+        return True
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+激活码池 - 激活码以64位整数紧凑存储，仅在显示时还原为文本
+"""
+
+import os
+import re
+import random
+import hashlib
+import struct
+from array import array
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import Callable, Container, Iterable, Iterator, List, Optional, Union
+
+from source_reader import ASCII_COMPATIBLE, decode_chunks, iter_source_lines, iter_source_members
+from source_reader import is_archive, is_code_file, open_member, sniff_encoding
+from code_ledger import ConsumptionLedger
+
+# 激活码格式：10位，只包含大写字母A-Z和数字0-9（36进制，最大值小于2^52）
+CODE_LENGTH = 10
+CODE_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_CODE_RE = re.compile(r'[0-9A-Z]{10}')
+# 按字节整块提取激活码行（激活码是ASCII，兼容UTF-8/GBK等编码）
+_CODE_LINE_BYTES_RE = re.compile(rb'^[ \t]*([0-9A-Z]{10})[ \t\r]*$', re.M)
+
+# 两位一组的解码表（36*36=1296项），解码时只需5次取模
+_PAIR_TABLE = [a + b for a in CODE_ALPHABET for b in CODE_ALPHABET]
+
+# 索引文件头：魔数、源文件大小、源文件修改时间(ns)、已解析到的偏移、激活码数量、
+# 偏移前的探针字节（用于判断文件是只追加还是被改写）
+_INDEX_HEADER = struct.Struct('<4sQQQQH64s')
+_INDEX_MAGIC = b'SCI2'
+_PROBE_SIZE = 64
+
+
+def is_valid_code(s: str) -> bool:
+    """验证激活码是否有效 - 10位，只包含大写字母A-Z和数字0-9"""
+    return _CODE_RE.fullmatch(s.strip()) is not None
+
+
+def encode_code(code: str) -> int:
+    """激活码文本 -> 整数（调用前需保证格式有效）"""
+    return int(code, 36)
+
+
+def decode_code(value: int) -> str:
+    """整数 -> 激活码文本"""
+    table = _PAIR_TABLE
+    q, r5 = divmod(value, 1296)
+    q, r4 = divmod(q, 1296)
+    q, r3 = divmod(q, 1296)
+    r1, r2 = divmod(q, 1296)
+    return table[r1] + table[r2] + table[r3] + table[r4] + table[r5]
+
+
+def iter_code_values(lines: Iterable[str]) -> Iterator[int]:
+    """从文本行中提取激活码整数值，标题、分隔符、空行等自动跳过"""
+    fullmatch = _CODE_RE.fullmatch
+    for line in lines:
+        line = line.strip()
+        if len(line) == CODE_LENGTH and fullmatch(line):
+            yield int(line, 36)
+
+
+def iter_code_values_bytes(data: bytes) -> Iterator[int]:
+    """从原始字节中提取激活码整数值"""
+    for code in _CODE_LINE_BYTES_RE.findall(data):
+        yield int(code, 36)
+
+
+def iter_code_values_chunks(chunks: Iterable[bytes]) -> Iterator[int]:
+    """从分块字节流中提取激活码整数值，跨块的行拼接后再解析"""
+    carry = b''
+    for chunk in chunks:
+        data = carry + chunk
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            yield from iter_code_values_bytes(data[:cut])
+        carry = data[cut:]
+    if carry:
+        yield from iter_code_values_bytes(carry)
+
+
+def iter_code_values_text(chunks: Iterable[str]) -> Iterator[int]:
+    """从分块文本中提取激活码整数值（非ASCII兼容编码解码后使用）"""
+    carry = ''
+    for chunk in chunks:
+        lines = (carry + chunk).split('\n')
+        carry = lines.pop()
+        yield from iter_code_values(lines)
+    if carry:
+        yield from iter_code_values([carry])
+
+
+def read_code_values(path: str) -> Iterator[int]:
+    """流式读取来源文件（文本或 .gz/.zip 压缩包）中的激活码整数值
+
+    每个文件根据第一块判断编码：UTF-8、GBK 直接按字节提取，UTF-16 边解码边提取。
+    """
+    for chunks in iter_source_members(path):
+        encoding, chunks = open_member(chunks)
+        if encoding in ASCII_COMPATIBLE:
+            yield from iter_code_values_chunks(chunks)
+        else:
+            yield from iter_code_values_text(decode_chunks(encoding, chunks))
+
+
+def _sorted_unique(values: Iterable[int]) -> array:
+    """排序并去重，返回紧凑数组"""
+    ordered = sorted(values)
+    result = array('Q')
+    last = -1
+    for value in ordered:
+        if value != last:
+            result.append(value)
+            last = value
+    return result
+
+
+class CodePool:
+    """单个激活码文件的激活码池（排序去重的64位整数数组）"""
+
+    def __init__(self, values: Iterable[int] = (), source_path: Optional[str] = None):
+        self.source_path = source_path
+        self.source_size = 0
+        self.source_mtime_ns = 0
+        self.source_offset = 0      # 已解析到的字节偏移（最后一个完整行之后）
+        self.source_probe = b''     # 偏移前的若干字节
+        self.codes = _sorted_unique(values)
+        self._consumed = array('Q')  # 已消耗的激活码（排序，codes的子集）
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, code: Union[str, int]) -> bool:
+        if isinstance(code, str):
+            if not is_valid_code(code):
+                return False
+            code = encode_code(code.strip())
+        return self._has(code)
+
+    def _has(self, value: int) -> bool:
+        codes = self.codes
+        i = bisect_left(codes, value)
+        return i < len(codes) and codes[i] == value
+
+    def exclude(self, values: List[int]) -> List[int]:
+        """过滤掉池中已有的激活码"""
+        codes = self.codes
+        if len(codes) <= len(values):
+            members = set(codes)
+            return [v for v in values if v not in members]
+        n = len(codes)
+        result = []
+        for v in values:
+            i = bisect_left(codes, v)
+            if i == n or codes[i] != v:
+                result.append(v)
+        return result
+
+    @property
+    def available(self) -> int:
+        """未消耗的激活码数量"""
+        return len(self.codes) - len(self._consumed)
+
+    @property
+    def consumed_count(self) -> int:
+        """已消耗但仍留在池中的激活码数量"""
+        return len(self._consumed)
+
+    def is_consumed(self, value: int) -> bool:
+        consumed = self._consumed
+        i = bisect_left(consumed, value)
+        return i < len(consumed) and consumed[i] == value
+
+    def mark_consumed(self, values: Iterable[int]) -> int:
+        """标记激活码为已消耗（不属于本池的忽略），返回新标记的数量"""
+        marked = 0
+        for value in values:
+            if self._has(value) and not self.is_consumed(value):
+                insort(self._consumed, value)
+                marked += 1
+        return marked
+
+    def mark_consumed_sorted(self, values: Iterable[int]) -> int:
+        """批量标记已排序去重的激活码（账本快照），一次合并代替逐个插入，返回新标记的数量"""
+        hits = [value for value in values if self._has(value)]
+        if not hits:
+            return 0
+        before = len(self._consumed)
+        if before:
+            hits = sorted(set(self._consumed).union(hits))
+        self._consumed = array('Q', hits)
+        return len(self._consumed) - before
+
+    def mark_ledger_consumed(self, ledger: ConsumptionLedger) -> int:
+        """标记账本中全部已消耗的激活码（快照部分整批合并，再重放日志），返回新标记的数量"""
+        return (self.mark_consumed_sorted(ledger.snapshot_values()) +
+                self.mark_consumed(ledger.iter_consumed(snapshot=False)))
+
+    def unmark_consumed(self, values: Iterable[int]) -> int:
+        """撤销消耗标记（放回可用激活码），返回恢复的数量"""
+        consumed = self._consumed
+        restored = 0
+        for value in values:
+            i = bisect_left(consumed, value)
+            if i < len(consumed) and consumed[i] == value:
+                del consumed[i]
+                restored += 1
+        return restored
+
+    def _iter_available(self) -> Iterator[int]:
+        """按顺序遍历未消耗的激活码（与已消耗数组归并）"""
+        consumed = self._consumed
+        j = 0
+        for value in self.codes:
+            while j < len(consumed) and consumed[j] < value:
+                j += 1
+            if j < len(consumed) and consumed[j] == value:
+                continue
+            yield value
+
+    def code_at(self, i: int) -> str:
+        """按位置取激活码文本"""
+        return decode_code(self.codes[i])
+
+    def random_code(self, exclude: Container[int] = ()) -> Optional[str]:
+        """随机取一个未消耗的激活码（跳过exclude中已预留的）"""
+        available = self.available
+        if available <= 0:
+            return None
+        codes = self.codes
+        for _ in range(8):
+            value = codes[random.randrange(len(codes))]
+            if not self.is_consumed(value) and value not in exclude:
+                return decode_code(value)
+        # 大部分已消耗时按可用序号定位
+        if not exclude:
+            k = random.randrange(available)
+            return decode_code(next(islice(self._iter_available(), k, None)))
+        remaining = [v for v in self._iter_available() if v not in exclude]
+        return decode_code(random.choice(remaining)) if remaining else None
+
+    def head(self, n: int, exclude: Container[int] = ()) -> List[str]:
+        """取前n个未消耗的激活码（跳过exclude中已预留的）"""
+        values = self._iter_available()
+        if exclude:
+            values = (v for v in values if v not in exclude)
+        return [decode_code(v) for v in islice(values, n)]
+
+    def compacted(self, removable: Optional[Callable[[int], bool]] = None) -> 'CodePool':
+        """返回去掉已消耗激活码的新池（源文件信息不变，索引仍然有效）
+
+        指定 removable 时只去掉它认可的已消耗激活码（如已不能撤销的），其余保留消耗标记。
+        """
+        pool = CodePool(source_path=self.source_path)
+        if removable is None:
+            pool.codes = array('Q', self._iter_available())
+        else:
+            pool._consumed = array('Q', (v for v in self._consumed if not removable(v)))
+            pool.codes = array('Q', (v for v in self.codes
+                                     if not self.is_consumed(v) or pool.is_consumed(v)))
+        pool.source_size = self.source_size
+        pool.source_mtime_ns = self.source_mtime_ns
+        pool.source_offset = self.source_offset
+        pool.source_probe = self.source_probe
+        return pool
+
+    def _set_source_state(self, data: bytes, base: int, mtime_ns: int):
+        """记录已读取的数据范围：data 是从文件偏移 base 开始读到的内容"""
+        end = data.rfind(b'\n') + 1
+        self.source_size = base + len(data)
+        self.source_mtime_ns = mtime_ns
+        if end:
+            self.source_offset = base + end
+            self.source_probe = data[max(0, end - _PROBE_SIZE):end]
+
+    def _merge(self, values: Iterable[int]) -> List[int]:
+        """合并新的激活码（保持排序去重），返回新增的激活码"""
+        new = [v for v in _sorted_unique(values) if not self._has(v)]
+        if len(new) <= 1024:
+            for value in new:
+                insort(self.codes, value)
+        elif new:
+            merged = sorted(self.codes.tolist() + new)
+            self.codes = array('Q', merged)
+        return new
+
+    def refresh(self) -> Optional[List[int]]:
+        """增量刷新 - 文件只追加时只解析新增部分，返回新增的激活码
+
+        记录的偏移之前的探针字节不变，视为只追加；末尾没有换行的半行不解析，
+        下次刷新时连同后续内容一起读取。文件变短或被改写时返回None，
+        由调用方完整重建。
+        """
+        if not self.source_path:
+            return []
+        try:
+            st = os.stat(self.source_path)
+            if st.st_size == self.source_size and st.st_mtime_ns == self.source_mtime_ns:
+                return []
+            if not self.source_offset or st.st_size < self.source_offset:
+                # 没有可续读的位置（压缩包、UTF-16文件等）；文件变短说明被改写
+                return None
+            with open(self.source_path, 'rb') as f:
+                f.seek(self.source_offset - len(self.source_probe))
+                if f.read(len(self.source_probe)) != self.source_probe:
+                    return None
+                tail = f.read()
+        except OSError:
+            return None
+        # 只解析到最后一个换行：写入中的半行留到下次刷新，偏移也停在它之前
+        added = self._merge(iter_code_values_bytes(tail[:tail.rfind(b'\n') + 1]))
+        self._set_source_state(tail, self.source_offset, st.st_mtime_ns)
+        return added
+
+    def is_fresh(self) -> bool:
+        """源文件自加载后是否未变化"""
+        if not self.source_path:
+            return True
+        try:
+            st = os.stat(self.source_path)
+        except OSError:
+            return False
+        return st.st_size == self.source_size and st.st_mtime_ns == self.source_mtime_ns
+
+    def save_index(self, index_path: str):
+        """将激活码数组写入二进制索引文件（原子替换）"""
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, self.source_size, self.source_mtime_ns,
+                                       self.source_offset, len(self.codes),
+                                       len(self.source_probe), self.source_probe))
+            self.codes.tofile(f)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load_index(cls, index_path: str, source_path: str) -> Optional['CodePool']:
+        """读取二进制索引，索引损坏时返回None（源文件是否已变化由调用方用 is_fresh 判断）"""
+        try:
+            with open(index_path, 'rb') as f:
+                (magic, size, mtime_ns, offset, count,
+                 probe_len, probe) = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+                if magic != _INDEX_MAGIC:
+                    return None
+                pool = cls(source_path=source_path)
+                pool.codes.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        pool.source_size = size
+        pool.source_mtime_ns = mtime_ns
+        pool.source_offset = offset
+        pool.source_probe = probe[:probe_len]
+        return pool
+
+
+def index_path_for(source_path: str, index_dir: str) -> str:
+    """源文件对应的索引文件路径"""
+    digest = hashlib.sha1(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(index_dir, f'{digest}.idx')
+
+
+def parse_code_file(source_path: str) -> CodePool:
+    """解析激活码文件（压缩包边解压边解析）"""
+    st = os.stat(source_path)
+    if is_archive(source_path):
+        pool = CodePool(read_code_values(source_path), source_path=source_path)
+        pool.source_size = st.st_size
+        pool.source_mtime_ns = st.st_mtime_ns
+        return pool
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    encoding, bom = sniff_encoding(data)
+    if encoding not in ASCII_COMPATIBLE:
+        # UTF-16等编码无法按字节续读追加部分，变化时完整重建
+        pool = CodePool(iter_code_values_text(decode_chunks(encoding, iter([data[bom:]]))),
+                        source_path=source_path)
+        pool.source_size = st.st_size
+        pool.source_mtime_ns = st.st_mtime_ns
+        return pool
+    pool = CodePool(iter_code_values_bytes(data[bom:]), source_path=source_path)
+    pool._set_source_state(data, 0, st.st_mtime_ns)
+    return pool
+
+
+def save_pool_index(pool: CodePool, index_dir: str):
+    """保存激活码池索引（索引只是缓存，写入失败不影响使用）"""
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        pool.save_index(index_path_for(pool.source_path, index_dir))
+    except OSError:
+        pass
+
+
+def load_code_pool(source_path: str, index_dir: Optional[str] = None) -> CodePool:
+    """加载激活码池 - 索引有效时直接读取，索引落后于只追加的源文件时增量补上，
+    否则解析源文件并重建索引"""
+    if index_dir:
+        pool = CodePool.load_index(index_path_for(source_path, index_dir), source_path)
+        if pool is not None:
+            if pool.is_fresh():
+                return pool
+            if pool.refresh() is not None:
+                save_pool_index(pool, index_dir)
+                return pool
+    pool = parse_code_file(source_path)
+    if index_dir:
+        save_pool_index(pool, index_dir)
+    return pool
+
+
+def compact_code_file(source_path: str, is_consumed: Callable[[int], bool]) -> Optional[int]:
+    """重写激活码文件，去掉已消耗的激活码，返回剩余数量
+
+    文件头（到第一条 === 分隔线为止）原样保留并更新"总数"；
+    正文按分组（第 N 组、散装标题等非激活码行开头）处理，激活码全部消耗的分组整体删除。
+    先写临时文件再原子替换，中途失败不会损坏源文件。
+    读取后源文件被追加或改写（如补货时正在写入）则放弃本次压缩并返回None，
+    避免替换时丢掉新写入的激活码，下次空闲时再压缩。
+    """
+    before = os.stat(source_path)
+    fullmatch = _CODE_RE.fullmatch
+    header = []
+    sections = []  # [[行列表, 剩余激活码数], ...]
+    current = None
+    in_header = True
+    for line in iter_source_lines(source_path):
+        s = line.strip()
+        is_code = len(s) == CODE_LENGTH and fullmatch(s) is not None
+        if in_header:
+            if not is_code:
+                header.append(line)
+                if s.startswith('==='):
+                    in_header = False
+                continue
+            in_header = False
+        if is_code:
+            if is_consumed(int(s, 36)):
+                continue
+            if current is None:
+                current = [[], 0]
+                sections.append(current)
+            current[0].append(line)
+            current[1] += 1
+        elif s and not s.startswith('==='):
+            # 新分组开始
+            current = [[line], 0]
+            sections.append(current)
+        else:
+            # 空行和分隔线归属当前分组
+            if current is None:
+                current = [[], 0]
+                sections.append(current)
+            current[0].append(line)
+
+    total = sum(count for _lines, count in sections)
+    out = [f'总数: {total}' if line.startswith('总数') else line for line in header]
+    if out:
+        out.append('')
+    for lines, count in sections:
+        if count:
+            out.extend(lines)
+
+    tmp_path = source_path + '.compact.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(out))
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    after = os.stat(source_path)
+    if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, source_path)
+    return total
+
+
+def expand_sources(value: Union[None, str, List[str]]) -> List[str]:
+    """展开档位的激活码来源：单个文件、文件列表或目录（目录下的txt文件和压缩包按文件名排序）"""
+    if not value:
+        return []
+    paths = [value] if isinstance(value, str) else list(value)
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if is_code_file(name))
+            sources.extend(os.path.join(path, name) for name in names)
+        else:
+            sources.append(path)
+    return sources
+
+
+class TierPool:
+    """一个档位的多个激活码来源 - 按需打开，已用完的来源直接跳过
+
+    opener 负责打开单个文件的激活码池（由调用方缓存并增量刷新），
+    只有前面的来源不够用时才会打开后面的文件。
+    """
+
+    def __init__(self, sources: List[str], opener: Callable[[str], CodePool],
+                 round_robin: bool = False, start: int = 0):
+        self.sources = sources
+        self._opener = opener
+        self.round_robin = round_robin
+        self._start = start % len(sources) if (round_robin and sources) else 0
+
+    def iter_pools(self) -> Iterator[CodePool]:
+        """依次打开还有可用激活码的来源"""
+        order = self.sources[self._start:] + self.sources[:self._start]
+        for path in order:
+            try:
+                pool = self._opener(path)
+            except OSError:
+                continue  # 来源文件被删除或无法读取，跳过
+            if pool.available:
+                yield pool
+
+    @property
+    def available(self) -> int:
+        """所有来源的可用激活码总数（会打开全部来源）"""
+        return sum(pool.available for pool in self.iter_pools())
+
+    def __contains__(self, code: Union[str, int]) -> bool:
+        """激活码是否属于本档位的任一来源（包括已用完的来源）"""
+        for path in self.sources:
+            try:
+                if code in self._opener(path):
+                    return True
+            except OSError:
+                continue
+        return False
+
+    def random_code(self, exclude: Container[int] = ()) -> Optional[str]:
+        """从第一个还有激活码的来源中随机取一个（跳过exclude中已预留的）"""
+        for pool in self.iter_pools():
+            code = pool.random_code(exclude)
+            if code is not None:
+                return code
+        return None
+
+    def take(self, n: int, exclude: Container[int] = ()) -> List[str]:
+        """按来源顺序取n个未消耗的激活码（跳过exclude中已预留的，不足时返回全部可用的）"""
+        codes = []
+        for pool in self.iter_pools():
+            codes.extend(pool.head(n - len(codes), exclude))
+            if len(codes) >= n:
+                break
+        return codes
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+草稿历史 - 草稿的每次保存追加一条按行的差异记录，可恢复到任一保留的版本
+
+历史分成若干段，每段是一个只追加日志：第一条记录是完整快照，之后每条是相对上一版本的差异
+（替换的行范围和新的行），所以自动保存只写入改动的行，恢复一个版本最多重放一段。
+段列表保存在一个小文档中，只在开始新段时改写；总大小超过上限时删除最久未使用的段（当前段除外）。
+"""
+
+import json
+import time
+import bisect
+import struct
+import threading
+from typing import List, NamedTuple, Optional, Tuple
+
+from storage import Storage
+
+# 每段最多的版本数（恢复时最多重放这么多条记录）
+SNAPSHOT_INTERVAL = 50
+# 每个草稿历史的总大小上限（字节）
+HISTORY_MAX_BYTES = 512 * 1024
+
+# 记录头：类型、保存时间、起始行、删除的行数、新的行数、新行数据长度
+_RECORD = struct.Struct('<BdIIII')
+_SNAPSHOT = 0
+_DELTA = 1
+
+
+class DraftVersion(NamedTuple):
+    """历史中的一个版本"""
+    number: int         # 版本号（从1开始递增）
+    saved_at: float     # 保存时间（time.time()）
+    lines: int          # 行数
+
+
+class _Record(NamedTuple):
+    kind: int
+    saved_at: float
+    start: int
+    deleted: int
+    inserted: List[str]
+
+
+def line_delta(old: List[str], new: List[str]) -> Tuple[int, int, List[str]]:
+    """两个版本的按行差异 (起始行, 删除的行数, 新的行)：去掉相同的开头和结尾后剩下的部分
+
+    自动保存间隔内的编辑一般集中在一处，只比较首尾即可，耗时与行数成正比。
+    """
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+def _encode_record(kind: int, saved_at: float, start: int, deleted: int,
+                   inserted: List[str]) -> bytes:
+    payload = '\n'.join(inserted).encode('utf-8')
+    return _RECORD.pack(kind, saved_at, start, deleted, len(inserted), len(payload)) + payload
+
+
+def _parse_records(data: bytes) -> Tuple[List[_Record], int]:
+    """解析一段日志，返回 (记录, 有效数据长度)；末尾未写完或损坏的记录被忽略"""
+    records = []
+    offset = 0
+    while offset + _RECORD.size <= len(data):
+        kind, saved_at, start, deleted, count, length = _RECORD.unpack_from(data, offset)
+        end = offset + _RECORD.size + length
+        if kind not in (_SNAPSHOT, _DELTA) or end > len(data):
+            break
+        try:
+            payload = data[offset + _RECORD.size:end].decode('utf-8')
+        except UnicodeDecodeError:
+            break
+        inserted = payload.split('\n') if count else []
+        if len(inserted) != count:
+            break
+        records.append(_Record(kind, saved_at, start, deleted, inserted))
+        offset = end
+    return records, offset
+
+
+def _apply(lines: List[str], record: _Record) -> List[str]:
+    if record.kind == _SNAPSHOT:
+        return list(record.inserted)
+    lines[record.start:record.start + record.deleted] = record.inserted
+    return lines
+
+
+class DraftHistory:
+    """一个草稿的版本历史，可在多个线程中使用
+
+    存储中的名称：段列表 {prefix}-history.json，各段日志 {prefix}-history-{起始版本号}.bin
+    """
+
+    def __init__(self, storage: Storage, prefix: str, max_bytes: int = HISTORY_MAX_BYTES,
+                 interval: int = SNAPSHOT_INTERVAL):
+        self.storage = storage
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.index_name = f'{prefix}-history.json'
+        self._segments = None   # [[起始版本号, 最近使用时间]]，按版本号排序（首次访问时加载）
+        self._head_lines = []   # 最新版本的行
+        self._head_count = 0    # 当前段（最后一段）的记录数
+        self._lock = threading.RLock()
+
+    def _segment_name(self, first: int) -> str:
+        return f'{self.prefix}-history-{first}.bin'
+
+    def _read_segment(self, first: int) -> Tuple[List[_Record], int, int]:
+        name = self._segment_name(first)
+        data = self.storage.read(name, 0, self.storage.size(name))
+        records, valid = _parse_records(data)
+        return records, valid, len(data)
+
+    def _load(self):
+        if self._segments is not None:
+            return
+        segments = []
+        data = self.storage.get(self.index_name)
+        try:
+            raw = json.loads(data.decode('utf-8')) if data else []
+            segments = sorted([int(first), float(used)] for first, used in raw)
+        except (ValueError, TypeError):
+            segments = []
+        self._segments = segments
+        if segments:
+            first = segments[-1][0]
+            records, valid, size = self._read_segment(first)
+            if valid < size:
+                # 上次写入时中断，去掉未写完的记录
+                self.storage.truncate(self._segment_name(first), valid)
+            lines = []
+            for record in records:
+                lines = _apply(lines, record)
+            self._head_lines = lines
+            self._head_count = len(records)
+
+    def _save_index(self):
+        self.storage.put(self.index_name, json.dumps(self._segments).encode('utf-8'))
+
+    def head_number(self) -> Optional[int]:
+        """最新版本的版本号（没有历史时为None）"""
+        with self._lock:
+            self._load()
+            if not self._head_count:
+                return None
+            return self._segments[-1][0] + self._head_count - 1
+
+    def latest(self) -> Optional[str]:
+        """最新版本的内容（没有历史时为None）"""
+        with self._lock:
+            self._load()
+            return '\n'.join(self._head_lines) if self._head_count else None
+
+    def record(self, text: str) -> Optional[int]:
+        """保存一个新版本，返回版本号；与最新版本相同时不保存，返回None"""
+        lines = text.split('\n')
+        with self._lock:
+            self._load()
+            if self._head_count and lines == self._head_lines:
+                return None
+            now = time.time()
+            if self._segments and self._head_count == 0:
+                # 当前段还没有记录（快照损坏），直接写入快照
+                data = _encode_record(_SNAPSHOT, now, 0, 0, lines)
+                self.storage.append(self._segment_name(self._segments[-1][0]), data)
+            elif self._segments and self._head_count < self.interval:
+                start, deleted, inserted = line_delta(self._head_lines, lines)
+                data = _encode_record(_DELTA, now, start, deleted, inserted)
+                if (len(data) - _RECORD.size) * 2 <= len(text.encode('utf-8')):
+                    self.storage.append(self._segment_name(self._segments[-1][0]), data)
+                else:
+                    # 改动接近全文时快照更省空间，顺便开始新段
+                    self._start_segment(lines, now)
+            else:
+                self._start_segment(lines, now)
+            self._head_lines = lines
+            self._head_count += 1
+            return self._segments[-1][0] + self._head_count - 1
+
+    def _start_segment(self, lines: List[str], now: float):
+        """以快照开始新段：先写段日志再更新段列表，中断时只丢失这一个版本"""
+        first = self._segments[-1][0] + self._head_count if self._segments else 1
+        name = self._segment_name(first)
+        if self.storage.size(name):
+            self.storage.truncate(name, 0)  # 上次中断时留下的段
+        self.storage.append(name, _encode_record(_SNAPSHOT, now, 0, 0, lines))
+        self._segments.append([first, now])
+        self._head_count = 0
+        self._prune()
+        self._save_index()
+
+    def _prune(self):
+        """总大小超过上限时删除最久未使用的段（当前段保留）"""
+        sizes = {first: self.storage.size(self._segment_name(first)) for first, _used in self._segments}
+        total = sum(sizes.values())
+        while total > self.max_bytes and len(self._segments) > 1:
+            victim = min(self._segments[:-1], key=lambda segment: segment[1])
+            self.storage.delete(self._segment_name(victim[0]))
+            total -= sizes[victim[0]]
+            self._segments.remove(victim)
+
+    def versions(self) -> List[DraftVersion]:
+        """保留的所有版本（按版本号排序）"""
+        with self._lock:
+            self._load()
+            result = []
+            for first, _used in self._segments:
+                lines = []
+                records, _valid, _size = self._read_segment(first)
+                for i, record in enumerate(records):
+                    lines = _apply(lines, record)
+                    result.append(DraftVersion(first + i, record.saved_at, len(lines)))
+            return result
+
+    def restore(self, number: int) -> str:
+        """读取指定版本的内容（只重放所在的一段），并把该段记为最近使用；版本不存在时抛出 KeyError"""
+        with self._lock:
+            self._load()
+            index = bisect.bisect_right([first for first, _used in self._segments], number) - 1
+            if index < 0:
+                raise KeyError(f'版本不存在：{number}')
+            first = self._segments[index][0]
+            records, _valid, _size = self._read_segment(first)
+            if number - first >= len(records):
+                raise KeyError(f'版本不存在：{number}')
+            lines = []
+            for record in records[:number - first + 1]:
+                lines = _apply(lines, record)
+            if index < len(self._segments) - 1:
+                self._segments[index][1] = time.time()
+                self._save_index()
+            return '\n'.join(lines)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+账本离线同步 - 多台设备（手机、电脑）之间用文件交换激活码消耗记录，不需要网络服务
+
+每台设备维护一个同步集合：(激活码, 消耗设备) 的只增集合，按激活码排序保存。
+导出时先把本机账本中新的消耗并入集合，再写出上次导出之后新增的条目（包括从其他设备导入的，
+由本机转交）；导入时把文件与集合做一次排序归并（集合并集，与导入顺序和重复导入无关），
+并把其他设备消耗、本机账本中还没有的激活码记入账本。同一激活码被多台设备消耗时报告冲突。
+
+撤销不同步：已导出的激活码之后在本机撤销，其他设备仍视为已消耗。
+"""
+
+import os
+import re
+import time
+import uuid
+import socket
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from code_ledger import TIERS, ConsumptionLedger
+from settings import DEVICE_ID, Settings
+from storage import Storage
+
+# 存储中的名称
+STATE_NAME = 'ledger.sync'
+# 同步文件扩展名
+SYNC_SUFFIX = '.sync'
+
+# 同步集合：魔数、当前批次号、上次导出时的批次号、设备数、条目数；之后是设备表和条目
+# 条目：激活码、设备编号、档位编号、加入时的批次号（按激活码、设备排序）
+_STATE_HEADER = struct.Struct('<4sIIHI')
+_STATE_ENTRY = struct.Struct('<QHBI')
+_STATE_MAGIC = b'SCY1'
+
+# 同步文件：魔数、导出时间、导出设备编号、设备数、条目数；之后是设备表和条目（按激活码排序）
+_FILE_HEADER = struct.Struct('<4sIHHI')
+_FILE_ENTRY = struct.Struct('<QHB')
+_FILE_MAGIC = b'SCX1'
+
+
+class SyncConflict(NamedTuple):
+    """被多台设备消耗的激活码"""
+    code: int
+    tier: str
+    devices: List[str]
+
+
+class SyncResult(NamedTuple):
+    """一次导入的结果"""
+    device: str                     # 导出该文件的设备
+    received: int                   # 文件中新的条目数
+    consumed: int                   # 新记入本机账本的激活码数
+    conflicts: List[SyncConflict]   # 本次导入发现的冲突
+
+
+def device_id(settings: Settings) -> str:
+    """本机的设备名称（首次使用时由主机名和随机后缀生成并保存）"""
+    with settings.transaction():
+        name = settings.get(DEVICE_ID)
+        if not name:
+            host = re.sub(r'[^A-Za-z0-9_-]', '', socket.gethostname())[:20] or 'device'
+            name = f'{host}-{uuid.uuid4().hex[:6]}'
+            settings.set(DEVICE_ID, name)
+    return name
+
+
+def _pack_devices(devices: List[str]) -> bytes:
+    parts = []
+    for name in devices:
+        data = name.encode('utf-8')[:255]
+        parts.append(bytes([len(data)]) + data)
+    return b''.join(parts)
+
+
+def _unpack_devices(data: bytes, pos: int, count: int) -> Tuple[List[str], int]:
+    devices = []
+    for _ in range(count):
+        if pos >= len(data) or pos + 1 + data[pos] > len(data):
+            raise ValueError('设备表不完整')
+        length = data[pos]
+        devices.append(data[pos + 1:pos + 1 + length].decode('utf-8'))
+        pos += 1 + length
+    return devices, pos
+
+
+def _unpack_entries(entry: struct.Struct, data: bytes, pos: int, count: int) -> list:
+    if len(data) != pos + entry.size * count:
+        raise ValueError('条目数量不符')
+    return list(entry.iter_unpack(data[pos:]))
+
+
+def _conflicts(entries: list, devices: List[str], stamp: Optional[int] = None) -> List[SyncConflict]:
+    """扫描排序后的条目，找出被多台设备消耗的激活码（指定批次号时只报告涉及该批次的）"""
+    conflicts = []
+    i = 0
+    while i < len(entries):
+        j = i + 1
+        while j < len(entries) and entries[j][0] == entries[i][0]:
+            j += 1
+        if j - i > 1 and (stamp is None or any(entry[3] == stamp for entry in entries[i:j])):
+            conflicts.append(SyncConflict(entries[i][0], TIERS[entries[i][2]],
+                                          [devices[entry[1]] for entry in entries[i:j]]))
+        i = j
+    return conflicts
+
+
+class LedgerSync:
+    """本机的同步集合，导出、导入同步文件"""
+
+    def __init__(self, storage: Storage, ledger: ConsumptionLedger, device: str):
+        self.storage = storage
+        self.ledger = ledger
+        self.device = device
+        self.stamp = 0            # 当前批次号（每次有新条目加入时加一）
+        self.exported_stamp = 0   # 上次导出时的批次号
+        self.devices = []         # 设备表，条目中保存设备在表中的编号
+        self.entries = []         # [(激活码, 设备编号, 档位编号, 批次号)]，按激活码、设备排序
+        self._load()
+
+    def _load(self):
+        data = self.storage.get(STATE_NAME)
+        if data is None:
+            return
+        try:
+            magic, stamp, exported, num_devices, num_entries = _STATE_HEADER.unpack_from(data)
+            if magic != _STATE_MAGIC:
+                raise ValueError('魔数不符')
+            devices, pos = _unpack_devices(data, _STATE_HEADER.size, num_devices)
+            entries = _unpack_entries(_STATE_ENTRY, data, pos, num_entries)
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            # 与账本快照一样报错而不是忽略，避免其他设备发出的激活码被再次发出
+            raise ValueError(f'同步数据损坏：{e}')
+        self.stamp, self.exported_stamp = stamp, exported
+        self.devices, self.entries = devices, entries
+
+    def _save(self):
+        header = _STATE_HEADER.pack(_STATE_MAGIC, self.stamp, self.exported_stamp,
+                                    len(self.devices), len(self.entries))
+        self.storage.put(STATE_NAME, header + _pack_devices(self.devices) +
+                         b''.join(_STATE_ENTRY.pack(*entry) for entry in self.entries))
+
+    def _device_index(self, name: str) -> int:
+        try:
+            return self.devices.index(name)
+        except ValueError:
+            self.devices.append(name)
+            return len(self.devices) - 1
+
+    def reconcile(self) -> int:
+        """与本机账本对齐：账本中新的消耗作为本机条目并入集合；集合中其他设备消耗、
+        账本里没有的激活码记入账本（也补上次导入时中断的部分）。返回记入账本的数量
+
+        账本和集合都按激活码排序，一次归并完成。
+        """
+        consumed = self.ledger.consumed_entries()
+        entries = self.entries
+        me = self._device_index(self.device)
+        stamp = self.stamp + 1
+        merged = []
+        missing = []
+        added = 0
+        i = j = 0
+        while i < len(consumed) or j < len(entries):
+            if j == len(entries) or (i < len(consumed) and consumed[i][0] < entries[j][0]):
+                code, tier_id = consumed[i]
+                merged.append((code, me, tier_id, stamp))
+                added += 1
+                i += 1
+                continue
+            code = entries[j][0]
+            k = j
+            while k < len(entries) and entries[k][0] == code:
+                k += 1
+            if i < len(consumed) and consumed[i][0] == code:
+                i += 1
+            elif any(entry[1] != me for entry in entries[j:k]):
+                missing.append((TIERS[entries[j][2]], code))
+            merged.extend(entries[j:k])
+            j = k
+        if added:
+            self.entries = merged
+            self.stamp = stamp
+            self._save()
+        # 先保存集合再写账本：中断时下次对齐会补上
+        recorded = self.ledger.record_remote(missing)
+        if recorded:
+            self.ledger.save_filter()
+        return recorded
+
+    def export_delta(self, path: str, full: bool = False) -> int:
+        """导出上次导出之后新增的条目（full 为True时导出全部），返回条目数"""
+        self.reconcile()
+        since = 0 if full else self.exported_stamp
+        entries = [(code, device, tier_id) for code, device, tier_id, stamp in self.entries
+                   if stamp > since]
+        header = _FILE_HEADER.pack(_FILE_MAGIC, int(time.time()), self._device_index(self.device),
+                                   len(self.devices), len(entries))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header + _pack_devices(self.devices) +
+                    b''.join(_FILE_ENTRY.pack(*entry) for entry in entries))
+        os.replace(tmp_path, path)
+        self.exported_stamp = self.stamp
+        self._save()
+        return len(entries)
+
+    def import_delta(self, path: str) -> SyncResult:
+        """导入同步文件：与集合做并集，把其他设备新消耗的激活码记入账本，返回导入结果
+
+        重复导入同一文件或以任意顺序导入多个文件，结果都相同。
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            magic, _created, origin, num_devices, num_entries = _FILE_HEADER.unpack_from(data)
+            if magic != _FILE_MAGIC or origin >= num_devices:
+                raise ValueError('不是同步文件')
+            devices, pos = _unpack_devices(data, _FILE_HEADER.size, num_devices)
+            incoming = _unpack_entries(_FILE_ENTRY, data, pos, num_entries)
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f'同步文件损坏：{os.path.basename(path)}（{e}）')
+        if any(tier_id >= len(TIERS) or device >= num_devices for _code, device, tier_id in incoming):
+            raise ValueError(f'同步文件损坏：{os.path.basename(path)}')
+
+        # 先记下本机尚未并入集合的消耗，冲突才能归到本机
+        self.reconcile()
+        mapping = [self._device_index(name) for name in devices]
+        # 文件已按激活码排序，换成本机设备编号后只有同一激活码内的顺序可能变化，排序近似线性
+        incoming = sorted((code, mapping[device], tier_id) for code, device, tier_id in incoming)
+        entries = self.entries
+        stamp = self.stamp + 1
+        merged = []
+        received = 0
+        i = j = 0
+        while i < len(incoming) or j < len(entries):
+            if i < len(incoming) and (j == len(entries) or incoming[i][:2] < entries[j][:2]):
+                code, device, tier_id = incoming[i]
+                if not merged or merged[-1][:2] != (code, device):
+                    merged.append((code, device, tier_id, stamp))
+                    received += 1
+                i += 1
+            else:
+                if i < len(incoming) and incoming[i][:2] == entries[j][:2]:
+                    i += 1
+                merged.append(entries[j])
+                j += 1
+        conflicts = []
+        if received:
+            self.entries = merged
+            self.stamp = stamp
+            self._save()
+            conflicts = _conflicts(merged, self.devices, stamp)
+        consumed = self.reconcile()
+        return SyncResult(devices[origin], received, consumed, conflicts)
+
+    def conflicts(self) -> List[SyncConflict]:
+        """所有被多台设备消耗的激活码"""
+        return _conflicts(self.entries, self.devices)
+
+    def device_counts(self) -> Dict[str, int]:
+        """各设备消耗的激活码数量"""
+        counts = {}
+        for _code, device, _tier_id, _stamp in self.entries:
+            counts[self.devices[device]] = counts.get(self.devices[device], 0) + 1
+        return counts
+
+
+def export_file_name(device: str) -> str:
+    """导出文件的默认名称"""
+    return f'ledger-{device}-{time.strftime("%Y%m%d-%H%M%S")}{SYNC_SUFFIX}'
@@ -6,9 +6,10 @@ Android版发货软件 - 中文支持版本
 
 import os
 import sys
-import json
-import random
-from typing import List, Optional
+import time
+import threading
+import multiprocessing
+from typing import List, Optional, Set, Tuple
 
 # 设置编码
 if sys.platform.startswith('win'):
@@ -24,8 +25,11 @@ from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
 from kivy.uix.scrollview import ScrollView
-from kivy.uix.popup import Popup
-from kivy.uix.filechooser import FileChooserListView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+# Popup、FileChooserListView 只在对话框中使用，在各对话框方法中首次打开时才导入，加快启动
+from kivy.uix.progressbar import ProgressBar
 from kivy.clock import Clock
 from kivy.core.clipboard import Clipboard
 from kivy.core.window import Window
@@ -33,13 +37,41 @@ from kivy.utils import platform
 from kivy.logger import Logger
 from kivy.core.text import LabelBase
 
+from code_pool import CodePool, TierPool, load_code_pool, encode_code, decode_code, read_code_values, expand_sources
+from code_pool import compact_code_file, index_path_for, save_pool_index
+from code_pool import is_valid_code as _is_valid_code
+from code_ledger import TIERS, ConsumptionLedger
+from code_import import import_code_files
+from order_registry import OrderRegistry
+from ledger_sync import SYNC_SUFFIX, LedgerSync, device_id, export_file_name
+from source_reader import CODE_FILE_FILTERS, is_archive, is_code_file, read_source_text
+from storage import open_storage
+from shift_metrics import ShiftMetrics, format_report
+from message_builder import PackDefinition, OrderLine, CompiledTemplate, PreparedMessage
+from message_builder import parse_order_spec, compile_template, render_order, normalize_for_paste, scan_for_paste
+from settings import FONT_PATH, ORDERS, PACKS, Settings
+from template_library import TemplateLibrary
+
 # 设置窗口大小（仅在桌面端测试时使用）
 if platform != 'android':
     Window.size = (420, 750)
 
-# 注册中文字体 - 在App类定义之前
-def register_chinese_font():
-    """注册中文字体"""
+def _register_font(font_path: str) -> bool:
+    try:
+        LabelBase.register(name='Chinese', fn_regular=font_path)
+        Logger.info(f'Font: Registered Chinese font: {font_path}')
+        return True
+    except Exception as e:
+        Logger.warning(f'Font: Failed to register {font_path}: {e}')
+        return False
+
+# 注册中文字体 - 在创建界面之前
+def register_chinese_font(settings: Settings) -> bool:
+    """注册中文字体 - 优先使用设置中记住的字体文件，不存在时才依次查找并记住结果"""
+    cached = settings.get(FONT_PATH)
+    if cached and os.path.exists(cached) and _register_font(cached):
+        return True
+    
     if platform == 'android':
         # Android字体路径
         font_paths = [
@@ -57,34 +89,109 @@ def register_chinese_font():
         ]
     
     for font_path in font_paths:
-        if os.path.exists(font_path):
-            try:
-                LabelBase.register(name='Chinese', fn_regular=font_path)
-                Logger.info(f'Font: Registered Chinese font: {font_path}')
-                return True
-            except Exception as e:
-                Logger.warning(f'Font: Failed to register {font_path}: {e}')
-                continue
+        if font_path != cached and os.path.exists(font_path) and _register_font(font_path):
+            settings.set(FONT_PATH, font_path)
+            return True
     
     Logger.warning('Font: No Chinese font found, using system default')
+    if cached:
+        settings.set(FONT_PATH, '')
     return False
 
-# 注册字体
-chinese_font_available = register_chinese_font()
+# 是否已注册中文字体（App初始化时注册）
+chinese_font_available = False
+
+# 内置默认模板
+DEFAULT_TEMPLATE = """会员您好，您购买的商品现为您发货：
+
+最新链接：复制粘贴到浏览器，直接下载：
+https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0773adcaaf4a03bbd11dfbad4867fb/download
+
+固定链接：我用夸克网盘给您分享了软件，点击链接或复制整段内容，打开「夸克APP」即可获取
+链接：https://pan.quark.cn/s/a71a458ccea7
+
+如果您经常在网吧使用，请找我兑换网吧激活码
+
+下载后，双击 TS_v2.3.1 .exe ，打开 TS 文件夹，启动GO，复制粘贴激活码就成，直接使用
+
+软件包内有 使用视频教程，和使用说明
+
+后面有任何疑问，或者不懂的，不用自己想，直接随时找我解决就行"""
+
+# 多个激活码来源时的取码方式：False按顺序用完一个再用下一个，True轮流从各来源取
+CODE_SOURCE_ROUND_ROBIN = False
+# 后台预先排版下一条消息的档位（bulk 为当前激活码包）
+PREPARE_KEYS = ('365', '30', '90', 'bulk')
+
+# 账本、订单记录、统计、配置和草稿模板的存储后端：file（数据目录下的文件）、sqlite、memory
+STORAGE_BACKEND = 'file'
+
+# 空闲压缩：无操作超过该秒数、且池中已消耗激活码达到该数量时，折叠账本日志（之前的复制不能再撤销）并后台重写激活码文件
+COMPACT_IDLE_SECONDS = 60
+COMPACT_MIN_CONSUMED = 50
+
+# 填了订单号、分配激活码后超过该秒数仍未复制的订单，启动时取消并释放预留的激活码
+PENDING_ORDER_MAX_AGE = 7 * 24 * 3600
+
+# 只读预览每行的最小高度（像素），过长换行的行按实际高度
+PREVIEW_LINE_HEIGHT = 24
+
+# 草稿历史对话框中最多列出的版本数（最新的）
+DRAFT_HISTORY_SHOWN = 100
+
+
+class PreviewLine(RecycleDataViewBehavior, Label):
+    """只读预览中的一行 - 按宽度换行，实际高度与数据中的不同时更新数据"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rv = None
+        self.index = None
+        self.font_size = '14sp'
+        self.color = (0.1, 0.1, 0.2, 1)
+        self.halign = 'left'
+        self.valign = 'middle'
+        if chinese_font_available:
+            self.font_name = 'Chinese'
+        self.bind(width=lambda *args: setattr(self, 'text_size', (self.width, None)))
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.rv = rv
+        self.index = index
+        return super().refresh_view_attrs(rv, index, data)
+
+    def on_texture_size(self, instance, size):
+        if self.rv is None or self.index is None or self.index >= len(self.rv.data):
+            return
+        height = max(size[1], PREVIEW_LINE_HEIGHT)
+        item = self.rv.data[self.index]
+        if item.get('text') == self.text and item.get('height') != height:
+            # 只重新计算这一行的尺寸并重新排列，不重建整个列表
+            item['height'] = height
+            self.rv.refresh_from_data(modified=slice(self.index, self.index + 1))
+
 
 class ShippingApp(App):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.base_dir = self.get_base_dir()
+        self.storage = open_storage(STORAGE_BACKEND, self.base_dir)
+        # 档位激活码来源、模板、激活码包、组合订单等设置（修改后通过订阅更新）
+        self.settings = Settings(self.storage)
+        self.settings.subscribe(PACKS, lambda _key, packs: setattr(self, 'pack_definitions', packs))
+        self.settings.subscribe(ORDERS, lambda _key, specs: setattr(self, 'order_specs', specs))
+        # 命名消息模板（每种商品一个），切换后直接使用已预处理的模板
+        self.templates = TemplateLibrary(self.storage, self.settings)
+        global chinese_font_available
+        chinese_font_available = register_chinese_font(self.settings)
         self.current_content = ""
         self.copy_context = 'single'
-        # 激活码文件路径存储
-        self.code_file_paths = {
-            '1': None,    # 1天激活码文件路径
-            '30': None,   # 30天激活码文件路径
-            '90': None,   # 90天激活码文件路径
-            '365': None   # 365天激活码文件路径
-        }
+        # 散装激活码包定义（数量、天数、分组空行、标题）
+        self.pack_definitions = self.settings.get(PACKS)
+        self.current_pack = None
+        # 组合订单（如"365天+散装25个"）和当前显示的订单 (订单文本, 订单项, 各项激活码, 订单号)
+        self.order_specs = self.settings.get(ORDERS)
+        self.current_order = None
         # 激活码使用状态跟踪
         self.current_codes = {
             'bulk': [],      # 当前显示的散装激活码
@@ -94,11 +201,30 @@ class ShippingApp(App):
         }
         self.codes_used = {
             'bulk': False,   # 散装激活码是否已使用
+            'order': False,  # 组合订单激活码是否已使用
             '30': False,     # 30天激活码是否已使用
             '90': False,     # 90天激活码是否已使用
             '365': False     # 365天激活码是否已使用
         }
-        self.load_code_file_paths()
+        # 已加载的激活码池（按文件路径缓存，源文件变化时增量刷新或重新加载）
+        self.code_pools = {}
+        # 各档位取码次数（轮流取码时决定起始来源）
+        self.tier_draws = {}
+        # 模板库中没有可用模板时使用的内置模板
+        self.builtin_template = compile_template(DEFAULT_TEMPLATE)
+        # 激活码池加载锁（后台预热、压缩与界面操作共用）
+        self.pool_lock = threading.RLock()
+        # 最近一次用户操作时间（用于判断空闲）和后台压缩状态
+        self.last_activity = time.monotonic()
+        self.is_compacting = False
+        # 当前消息的填充时间（用于统计每单耗时）
+        self.prepared_at = None
+        # 各档位预先排版好的下一条消息（激活码已预留未消耗）
+        self.prepared = {}
+        self.is_preparing = False
+        self.prepare_pending = False
+        # 最近填充的单个激活码消息 (消息文本, 天数)，复制时内容未改动就不必再扫描档位
+        self.rendered_single = None
         
     def get_base_dir(self) -> str:
         """获取应用数据目录"""
@@ -118,6 +244,13 @@ class ShippingApp(App):
         # 创建数据目录
         os.makedirs(self.base_dir, exist_ok=True)
         
+        # 激活码消耗账本和订单出码记录
+        self.ledger = ConsumptionLedger(self.storage)
+        self.order_registry = OrderRegistry(self.storage)
+        released = self.order_registry.release_stale(PENDING_ORDER_MAX_AGE)
+        if released:
+            Logger.info(f'Orders: Released {len(released)} stale pending orders')
+        
         # 主布局 - 深色背景
         main_layout = BoxLayout(
             orientation='vertical', 
@@ -153,6 +286,31 @@ class ShippingApp(App):
         
         main_layout.add_widget(title_layout)
         
+        # 消息区域：平时显示只读预览（只渲染可见的行），编辑时换成文本输入框
+        self.message_area = BoxLayout()
+        self.preview = RecycleView(
+            bar_width=10,
+            scroll_type=['bars', 'content'],
+            effect_cls='ScrollEffect'
+        )
+        self.preview.viewclass = PreviewLine
+        preview_layout = RecycleBoxLayout(
+            orientation='vertical',
+            default_size=(None, PREVIEW_LINE_HEIGHT),
+            default_size_hint=(1, None),
+            size_hint_y=None,
+            padding=[12, 10, 12, 10]
+        )
+        preview_layout.bind(minimum_height=preview_layout.setter('height'))
+        self.preview.add_widget(preview_layout)
+        with self.preview.canvas.before:
+            Color(0.95, 0.97, 1, 1)
+            self.preview_rect = Rectangle(pos=self.preview.pos, size=self.preview.size)
+        self.preview.bind(pos=lambda w, v: setattr(self.preview_rect, 'pos', v),
+                          size=lambda w, v: setattr(self.preview_rect, 'size', v))
+        # 当前消息（预览时以此为准，编辑时以文本输入框为准）
+        self.message_text = ''
+        
         # 可滚动的文本输入框（增加高度）
         scroll = ScrollView(
             bar_width=10,  # 滚动条宽度
@@ -178,11 +336,25 @@ class ShippingApp(App):
         # 确保文本框内容超出时可以滚动
         self.text_input.bind(minimum_height=self.text_input.setter('height'))
         scroll.add_widget(self.text_input)
-        main_layout.add_widget(scroll)
+        self.editor = scroll
+        self.message_area.add_widget(self.preview)
+        main_layout.add_widget(self.message_area)
+        
+        # 订单号输入 - 填写后同一订单重复出码会返回原激活码
+        self.order_id_input = TextInput(
+            hint_text='订单号（可选，同一订单重复出码返回原激活码）',
+            multiline=False,
+            size_hint_y=None,
+            height=36,
+            font_size='13sp',
+            padding=[10, 8, 10, 8],
+            font_name='Chinese' if chinese_font_available else None
+        )
+        main_layout.add_widget(self.order_id_input)
         
         # 激活码按钮区域 - 进一步压缩
         code_layout = GridLayout(
-            cols=2,
+            cols=3,
             size_hint_y=None,
             height=95,  # 再减少5px
             spacing=10,
@@ -195,6 +367,8 @@ class ShippingApp(App):
             ('30天', lambda x: self.on_fill_code('30'), (0.2, 0.7, 0.3, 1)),
             ('90天', lambda x: self.on_fill_code('90'), (0.9, 0.6, 0.1, 1)),
             ('散装', self.on_bulk, (0.5, 0.3, 0.8, 1)),
+            ('组合', self.on_order, (0.2, 0.5, 0.7, 1)),
+            ('统计', self.on_stats, (0.4, 0.4, 0.5, 1)),
         ]
         
         for text, callback, color in code_buttons:
@@ -214,19 +388,19 @@ class ShippingApp(App):
         
         main_layout.add_widget(code_layout)
         
-        # 底部按钮区域 - 三按钮布局
+        # 底部按钮区域 - 四按钮布局
         bottom_layout = BoxLayout(
             orientation='horizontal',
             size_hint_y=None,
             height=52,
-            spacing=8,  # 稍微减少间距适应三个按钮
+            spacing=6,  # 减少间距适应四个按钮
             padding=[8, 3, 8, 3]
         )
         
         # 上传按钮 - 左侧
         upload_btn = Button(
             text='📁 上传',
-            size_hint_x=0.3,  # 调整为30%
+            size_hint_x=0.22,  # 22%宽度
             size_hint_y=None,
             height=45,
             font_size='15sp',  # 稍微减小字体适应三按钮
@@ -242,7 +416,7 @@ class ShippingApp(App):
         # 编辑按钮 - 中间
         edit_btn = Button(
             text='✏️ 编辑',
-            size_hint_x=0.25,  # 25%宽度
+            size_hint_x=0.2,  # 20%宽度
             size_hint_y=None,
             height=45,
             font_size='15sp',
@@ -255,10 +429,26 @@ class ShippingApp(App):
         edit_btn.bind(on_press=self.on_edit)
         bottom_layout.add_widget(edit_btn)
         
+        # 撤销按钮 - 撤销最近一次复制消耗的激活码
+        undo_btn = Button(
+            text='↩ 撤销',
+            size_hint_x=0.2,  # 20%宽度
+            size_hint_y=None,
+            height=45,
+            font_size='15sp',
+            font_name='Chinese' if chinese_font_available else None,
+            bold=True,
+            background_color=(0.6, 0.3, 0.3, 1),  # 暗红色系
+            background_normal='',
+            color=(1, 1, 1, 1)
+        )
+        undo_btn.bind(on_press=self.on_undo)
+        bottom_layout.add_widget(undo_btn)
+        
         # 复制内容按钮 - 右侧
         copy_btn = Button(
             text='📋 复制内容',
-            size_hint_x=0.45,  # 调整为45%
+            size_hint_x=0.38,  # 调整为38%
             size_hint_y=None,
             height=45,
             font_size='15sp',  # 稍微减小字体
@@ -286,12 +476,24 @@ class ShippingApp(App):
         self.status_label.bind(size=self.status_label.setter('text_size'))
         main_layout.add_widget(self.status_label)
         
+        # 启动预热进度条（预热完成后移除）
+        self.warmup_bar = ProgressBar(max=1, value=0, size_hint_y=None, height=4)
+        main_layout.add_widget(self.warmup_bar)
+        
         # 绑定文本变化事件，用于自动保存草稿
         self.text_input.bind(text=self.on_text_changed)
         
         # 初始化默认内容 - 启动时自动加载模板
         Clock.schedule_once(self.load_default_content, 0.1)
         
+        # 记录用户操作时间，空闲时在后台压缩激活码文件
+        Window.bind(on_touch_down=self._on_user_activity, on_key_down=self._on_user_activity)
+        Clock.schedule_interval(self.check_idle_compaction, 30)
+        
+        # 发货效率统计（复制时只在内存中计数，定时保存）
+        self.metrics = ShiftMetrics(self.storage)
+        Clock.schedule_interval(self.save_metrics, 60)
+        
         # 标记是否为程序自动更新文本（避免在自动加载时触发保存）
         self.is_auto_update = False
         
@@ -300,24 +502,208 @@ class ShippingApp(App):
         
         return main_layout
     
-    def load_code_file_paths(self):
-        """加载激活码文件路径配置"""
+    def on_start(self):
+        """界面显示后在后台预热模板缓存和激活码池，首次点击无需再加载"""
+        threading.Thread(target=self._warmup_worker, daemon=True).start()
+    
+    def _warmup_worker(self):
+        """后台预热线程"""
+        steps = [('模板', self.templates.warm)]
+        for days in TIERS:
+            steps.append((f'{days}天激活码', lambda d=days: self._warm_code_pool(d)))
+        
+        total = len(steps)
+        Clock.schedule_once(lambda dt: setattr(self.warmup_bar, 'max', total))
+        for i, (name, step) in enumerate(steps, 1):
+            try:
+                step()
+            except Exception as e:
+                Logger.warning(f'Warmup: {name} failed: {e}')
+            Clock.schedule_once(lambda dt, n=i: self._update_warmup_progress(n))
+    
+    def _warm_code_pool(self, days: str):
+        """预热单个档位的激活码池（后台线程中调用，不更新界面） - 只打开第一个还有激活码的来源"""
+        tier_pool = TierPool(self.get_code_sources(days), self._open_code_pool)
+        next(tier_pool.iter_pools(), None)
+    
+    def _update_warmup_progress(self, value: int):
+        """更新预热进度，完成后移除进度条并预先排版各档位的消息"""
+        self.warmup_bar.value = value
+        if value >= self.warmup_bar.max and self.warmup_bar.parent:
+            self.warmup_bar.parent.remove_widget(self.warmup_bar)
+            self.schedule_prepare()
+    
+    def reserved_values(self) -> Set[int]:
+        """已显示未消耗的激活码和预先排版的消息中的激活码（取新激活码时跳过）"""
+        codes = []
+        for days in ('30', '90', '365'):
+            if not self.codes_used[days] and self.current_codes[days]:
+                codes.append(self.current_codes[days])
+        if not self.codes_used['bulk']:
+            codes.extend(self.current_codes['bulk'])
+        if not self.codes_used['order'] and self.current_order:
+            for line_codes in self.current_order[2]:
+                codes.extend(line_codes)
+        for prepared in list(self.prepared.values()):
+            codes.extend(prepared.codes)
+        # 已分配给订单号但尚未发出的激活码
+        return {encode_code(code) for code in codes} | self.order_registry.pending_values()
+    
+    def schedule_prepare(self):
+        """在后台线程中预先排版各档位的下一条消息（已有的跳过）"""
+        with self.pool_lock:
+            self.prepare_pending = True
+            if self.is_preparing:
+                return  # 正在运行的线程会再补一轮
+            self.is_preparing = True
+        threading.Thread(target=self._prepare_worker, daemon=True).start()
+    
+    def _prepare_worker(self):
+        """预排版线程 - 运行期间又有新请求时再补一轮"""
+        while True:
+            with self.pool_lock:
+                if not self.prepare_pending:
+                    self.is_preparing = False
+                    return
+                self.prepare_pending = False
+            self._prepare_messages()
+    
+    def _prepare_messages(self):
+        """预留激活码并排版缺少的消息，不更新界面"""
         try:
-            config_path = os.path.join(self.base_dir, 'code_paths.json')
-            if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    self.code_file_paths.update(json.load(f))
+            template = self.get_message_template()
+            for key in PREPARE_KEYS:
+                with self.pool_lock:
+                    if key in self.prepared:
+                        continue
+                    if key == 'bulk':
+                        pack = self.current_pack or self.pack_definitions[0]
+                        line = OrderLine(pack.tier, pack.size, pack)
+                    else:
+                        line = OrderLine(key)
+                    pool = self._tier_pool(line.tier)
+                    if pool is None:
+                        continue
+                    exclude = self.reserved_values()
+                    if line.pack is None:
+                        code = pool.random_code(exclude)
+                        codes = [code] if code is not None else []
+                    else:
+                        codes = pool.take(line.count, exclude)
+                    if len(codes) < line.count:
+                        continue
+                    text = render_order(template, [line], [codes])
+                    self.prepared[key] = PreparedMessage(template, line, codes, text)
+        except Exception as e:
+            Logger.warning(f'Prepare messages failed: {e}')
+    
+    def take_prepared(self, key: str, line: OrderLine) -> Optional[PreparedMessage]:
+        """取出预先排版的消息（订单项不同时丢弃，激活码放回）"""
+        with self.pool_lock:
+            prepared = self.prepared.pop(key, None)
+        if prepared is not None and prepared.line != line:
+            return None
+        return prepared
+    
+    def on_stop(self):
+        """退出时保存账本过滤器和统计，关闭存储"""
+        try:
+            self.ledger.save_filter()
         except Exception as e:
-            Logger.warning(f'Failed to load code file paths: {e}')
+            Logger.warning(f'Failed to save ledger filter: {e}')
+        self.save_metrics()
+        self.storage.close()
     
-    def save_code_file_paths(self):
-        """保存激活码文件路径配置"""
+    def save_metrics(self, dt=None):
+        """保存发货效率统计（没有新记录时不写文件）"""
         try:
-            config_path = os.path.join(self.base_dir, 'code_paths.json')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                json.dump(self.code_file_paths, f, ensure_ascii=False, indent=2)
+            self.metrics.save()
         except Exception as e:
-            Logger.warning(f'Failed to save code file paths: {e}')
+            Logger.warning(f'Save metrics failed: {e}')
+    
+    def record_copy(self, kind: str):
+        """记录一单完成：从填充消息到复制消耗的耗时"""
+        if self.prepared_at is not None:
+            self.metrics.record(kind, time.monotonic() - self.prepared_at)
+            self.prepared_at = None
+    
+    def add_code_source(self, days: str, path: str):
+        """把文件加入档位的激活码来源（原有来源保留，用完的会自动跳过；尚未配置时先保留默认激活码文件）"""
+        self.settings.add_tier_source(days, path, self.get_code_sources(days))
+    
+    def _on_user_activity(self, *args):
+        """记录用户操作时间"""
+        self.last_activity = time.monotonic()
+    
+    def check_idle_compaction(self, dt):
+        """空闲时折叠账本日志，并启动后台压缩 - 去掉激活码文件中已消耗的激活码"""
+        if self.is_compacting or time.monotonic() - self.last_activity < COMPACT_IDLE_SECONDS:
+            return
+        with self.pool_lock:
+            jobs = [path for path, pool in self.code_pools.items()
+                    if pool.consumed_count >= COMPACT_MIN_CONSUMED]
+        # 压缩只去掉已折叠进快照的消耗（还能撤销的激活码删掉后就无法放回），
+        # 所以压缩前先折叠日志：空闲这么久后不再撤销之前的复制
+        if jobs or self.ledger.needs_checkpoint:
+            self.checkpoint_ledger()
+        if not jobs:
+            return
+        self.is_compacting = True
+        threading.Thread(target=self._compact_worker, args=(jobs,), daemon=True).start()
+    
+    def checkpoint_ledger(self):
+        """把账本日志折叠进快照，启动时不必重放全部历史（折叠前的消耗不能再撤销）
+
+        持有激活码池锁：其他线程打开激活码池时先读快照再重放日志，中间不能折叠。
+        """
+        try:
+            with self.pool_lock:
+                folded = self.ledger.checkpoint()
+            if folded:
+                Logger.info(f'Ledger: checkpoint {self.ledger.generation}')
+        except Exception as e:
+            Logger.warning(f'Ledger checkpoint failed: {e}')
+    
+    def _compact_worker(self, jobs):
+        """后台压缩线程 - 数据目录内的激活码文本文件直接重写，外部文件和压缩包只压缩索引"""
+        index_dir = os.path.join(self.base_dir, 'index')
+        results = {}
+        for path in jobs:
+            try:
+                pool = load_code_pool(path, index_dir)
+                with self.pool_lock:
+                    start = self.ledger.tell()
+                    pool.mark_ledger_consumed(self.ledger)
+                in_base_dir = os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.base_dir)
+                if in_base_dir and not is_archive(path):
+                    if compact_code_file(path, self.ledger.is_checkpointed) is None:
+                        Logger.info(f'Compact {path} skipped: file changed while compacting')
+                        continue
+                    # 重写后的文件仍保留还能撤销的已消耗激活码，重新加载后要再标记一遍
+                    pool = load_code_pool(path, index_dir)
+                    with self.pool_lock:
+                        start = self.ledger.tell()
+                        pool.mark_ledger_consumed(self.ledger)
+                else:
+                    pool = pool.compacted(self.ledger.is_checkpointed)
+                    pool.save_index(index_path_for(path, index_dir))
+                results[path] = (pool, start)
+            except Exception as e:
+                Logger.warning(f'Compact {path} failed: {e}')
+        Clock.schedule_once(lambda dt: self._finish_compaction(results))
+    
+    def _finish_compaction(self, results):
+        """在主线程替换压缩后的激活码池，补标压缩期间新消耗的激活码"""
+        self.is_compacting = False
+        with self.pool_lock:
+            for path, (pool, start) in results.items():
+                if path not in self.code_pools:
+                    continue  # 压缩期间已不再使用该文件
+                pool.mark_consumed(self.ledger.iter_consumed(start=start))
+                pool.unmark_consumed(self.ledger.iter_undone(start=start))
+                self.code_pools[path] = pool
+        if results:
+            Logger.info(f'Compact: compacted {len(results)} code file(s)')
     
     def _update_rect(self, instance, value):
         """更新背景矩形"""
@@ -326,6 +712,7 @@ class ShippingApp(App):
     
     def show_message(self, title: str, message: str):
         """显示消息弹窗"""
+        from kivy.uix.popup import Popup
         popup = Popup(
             title=title,
             content=Label(
@@ -343,31 +730,27 @@ class ShippingApp(App):
         self.status_label.text = message
         Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', '就绪'), 3)
     
+    def get_base_content(self) -> Optional[str]:
+        """获取当前模板的基础内容（草稿优先，其次模板） - 内容未变化时直接使用模板库的缓存"""
+        loaded = self.templates.load()
+        return loaded.text if loaded else None
+    
+    def get_message_template(self) -> CompiledTemplate:
+        """获取当前模板预处理后的结果 - 内容未变化时直接使用模板库的缓存"""
+        loaded = self.templates.load()
+        return loaded.compiled if loaded else self.builtin_template
+    
     def load_default_content(self, dt):
         """加载默认内容 - 优先加载草稿"""
         try:
             self.is_auto_update = True  # 标记为自动更新，避免触发保存
             
-            # 检查是否有草稿文件
-            draft_path = os.path.join(self.base_dir, 'draft.txt')
-            template_path = os.path.join(self.base_dir, 'sendGoodsMode.txt')
-            
-            if os.path.exists(draft_path):
-                # 有草稿文件，直接加载草稿
-                with open(draft_path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    self.text_input.text = content
-                    self.current_content = content
-                    self.update_status('已加载草稿内容')
-                return
-            
-            # 没有草稿，加载默认模板
-            if os.path.exists(template_path):
-                with open(template_path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    self.text_input.text = content
-                    self.current_content = content
-                    self.update_status('已加载默认模板')
+            loaded = self.templates.load()
+            if loaded is not None:
+                self.set_message(loaded.text)
+                self.current_content = loaded.text
+                self.update_status(f'已加载草稿内容（{loaded.name}）' if loaded.is_draft
+                                   else f'已加载模板：{loaded.name}')
             else:
                 # 加载内置默认内容
                 self.load_builtin_template()
@@ -379,32 +762,27 @@ class ShippingApp(App):
     
     def load_builtin_template(self):
         """加载内置默认模板"""
-        default_content = """会员您好，您购买的商品现为您发货：
-
-最新链接：复制粘贴到浏览器，直接下载：
-https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0773adcaaf4a03bbd11dfbad4867fb/download
-
-固定链接：我用夸克网盘给您分享了软件，点击链接或复制整段内容，打开「夸克APP」即可获取
-链接：https://pan.quark.cn/s/a71a458ccea7
-
-如果您经常在网吧使用，请找我兑换网吧激活码
-
-下载后，双击 TS_v2.3.1 .exe ，打开 TS 文件夹，启动GO，复制粘贴激活码就成，直接使用
-
-软件包内有 使用视频教程，和使用说明
-
-后面有任何疑问，或者不懂的，不用自己想，直接随时找我解决就行"""
-        
-        # 创建默认模板文件
-        template_path = os.path.join(self.base_dir, 'sendGoodsMode.txt')
-        with open(template_path, 'w', encoding='utf-8') as f:
-            f.write(default_content)
+        # 为当前模板创建默认内容
+        self.templates.save(self.templates.active, DEFAULT_TEMPLATE)
         
-        self.text_input.text = default_content
-        self.current_content = default_content
+        self.set_message(DEFAULT_TEMPLATE)
+        self.current_content = DEFAULT_TEMPLATE
         self.update_status('已创建默认模板')
     
     
+    def set_message(self, text: str):
+        """显示消息 - 预览时只更新行数据（只渲染可见的行），编辑时写入文本输入框"""
+        self.message_text = text
+        if self.is_editing:
+            self.text_input.text = text
+        else:
+            self.preview.data = [{'text': line, 'height': PREVIEW_LINE_HEIGHT}
+                                 for line in text.split('\n')]
+    
+    def get_message(self) -> str:
+        """当前消息（编辑时为文本输入框中的内容）"""
+        return self.text_input.text if self.is_editing else self.message_text
+    
     def on_text_changed(self, instance, text):
         """文本改变时自动保存草稿"""
         if self.is_auto_update or not self.is_editing:
@@ -423,189 +801,413 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
             if not self.text_input.text.strip():
                 return  # 空内容不保存
                 
-            draft_path = os.path.join(self.base_dir, 'draft.txt')
-            with open(draft_path, 'w', encoding='utf-8') as f:
-                f.write(self.text_input.text)
+            self.templates.save_draft(self.templates.active, self.text_input.text)
         except Exception as e:
             Logger.warning(f'Save draft failed: {e}')
     
     def is_valid_code(self, s: str) -> bool:
         """验证激活码是否有效 - 与桌面端逻辑一致"""
-        s = s.strip()
-        if len(s) != 10:
-            return False
-        for ch in s:
-            if not (ch.isdigit() or ('A' <= ch <= 'Z')):
-                return False
-        return True
+        return _is_valid_code(s)
     
-    def read_codes_from_file(self, filename: str) -> List[str]:
-        """从文件读取激活码 - 优先从用户上传的文件读取"""
-        try:
-            # 提取天数标识
-            days = filename.replace('code', '').replace('day.txt', '')
-            
-            # 优先使用用户上传的文件路径
-            if self.code_file_paths.get(days):
-                path = self.code_file_paths[days]
-                if not os.path.exists(path):
-                    self.update_status(f'上传的{days}天激活码文件不存在')
-                    return []
-            else:
-                # 回退到默认路径
-                path = os.path.join(self.base_dir, filename)
-                if not os.path.exists(path):
-                    return []
-            
-            with open(path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            codes = []
-            for line in lines:
-                line = line.strip()
-                # 过滤掉标题、分隔符、空行等，只保留激活码
-                # 使用与桌面端一致的验证逻辑：10位，只包含大写字母A-Z和数字0-9
-                if (line and 
-                    not line.startswith('#') and 
-                    not line.startswith('激活码列表') and
-                    not line.startswith('生成时间') and
-                    not line.startswith('总数') and
-                    not line.startswith('字符集') and
-                    not line.startswith('===') and
-                    not line.startswith('第') and
-                    not line.startswith('组') and
-                    '组' not in line and
-                    not '以下是25个1天的激活码' in line and
-                    self.is_valid_code(line)):
-                    codes.append(line)
-            
-            return codes
-        except Exception as e:
-            self.update_status(f'读取激活码失败：{str(e)}')
-            return []
+    def get_code_sources(self, days: str) -> List[str]:
+        """获取激活码来源文件列表 - 优先使用用户上传的文件，不存在的文件自动跳过"""
+        configured = expand_sources(self.settings.tier_sources(days))
+        if configured:
+            return [path for path in configured if os.path.exists(path)]
+        # 回退到默认路径
+        path = os.path.join(self.base_dir, f'code{days}day.txt')
+        return [path] if os.path.exists(path) else []
+    
+    def load_code_pool(self, days: str) -> Optional[TierPool]:
+        """获取指定天数的激活码池 - 各来源文件按需打开"""
+        pool = self._tier_pool(days)
+        if pool is None and self.settings.tier_sources(days):
+            self.update_status(f'上传的{days}天激活码文件不存在')
+        return pool
+    
+    def _tier_pool(self, days: str) -> Optional[TierPool]:
+        """创建档位的激活码池（不更新界面，可在后台线程中调用）"""
+        sources = self.get_code_sources(days)
+        if not sources:
+            return None
+        draws = self.tier_draws.get(days, 0)
+        self.tier_draws[days] = draws + 1
+        return TierPool(sources, self._open_code_pool,
+                        round_robin=CODE_SOURCE_ROUND_ROBIN, start=draws)
+    
+    def _open_code_pool(self, path: str) -> CodePool:
+        """打开单个激活码文件的池（线程安全）
+
+        源文件未变化时直接使用内存中的池；文件只是被追加时只解析新增部分；
+        文件变短或被改写时完整重建。
+        """
+        index_dir = os.path.join(self.base_dir, 'index')
+        with self.pool_lock:
+            pool = self.code_pools.get(path)
+            if pool is not None:
+                if pool.is_fresh():
+                    return pool
+                added = pool.refresh()
+                if added is not None:
+                    # 新增的激活码也要排除已消耗的
+                    pool.mark_consumed(self.ledger.find_consumed(added))
+                    save_pool_index(pool, index_dir)
+                    return pool
+            pool = load_code_pool(path, index_dir)
+            # 跳过账本中已消耗的激活码
+            pool.mark_ledger_consumed(self.ledger)
+            self.code_pools[path] = pool
+            return pool
+    
+    def consume_codes(self, days: str, codes: List[str]):
+        """将激活码记入消耗账本，并从激活码池中排除"""
+        self.consume_entries([(days, code) for code in codes])
+    
+    def consume_entries(self, entries: List[Tuple[str, str]]):
+        """将多个档位的激活码作为一次提交记入账本（只写一次日志），并从激活码池中排除
+
+        写账本时持有激活码池锁：后台线程在锁内读取日志、查询过滤器，
+        不能看到写了一半的提交或重建中的过滤器。
+        """
+        values = [(days, encode_code(code)) for days, code in entries]
+        with self.pool_lock:
+            self.ledger.commit_entries(values)
+            for pool in self.code_pools.values():
+                pool.mark_consumed(value for _days, value in values)
     
     def on_bulk(self, instance):
-        """散装按钮 - 25个1天激活码（延迟消耗机制）"""
-        self.copy_context = 'bulk'
+        """散装按钮 - 选择激活码包（只有一种时直接填充）"""
+        from kivy.uix.popup import Popup
+        if len(self.pack_definitions) == 1:
+            self.fill_pack(self.pack_definitions[0])
+            return
+        
         try:
-            # 重新加载基础内容，确保没有单个激活码
-            self.load_default_content(None)
-            base_content = self.text_input.text
+            content = BoxLayout(orientation='vertical', padding=20, spacing=10)
             
-            # 移除基础内容中可能存在的单个激活码行
-            lines = base_content.split('\n')
-            filtered_lines = []
-            for line in lines:
-                if not (line.strip().startswith('30天激活码：') or 
-                       line.strip().startswith('90天激活码：') or 
-                       line.strip().startswith('365天激活码：')):
-                    filtered_lines.append(line)
+            button_layout = GridLayout(cols=1, spacing=10, size_hint_y=None)
+            button_layout.bind(minimum_height=button_layout.setter('height'))
             
-            clean_base_content = '\n'.join(filtered_lines)
+            for pack in self.pack_definitions:
+                btn = Button(
+                    text=f'{pack.name}（{pack.size}个{pack.tier}天）',
+                    size_hint_y=None,
+                    height=45,
+                    font_size='16sp',
+                    font_name='Chinese' if chinese_font_available else None,
+                    background_color=(0.5, 0.3, 0.8, 1),
+                    background_normal='',
+                    color=(1, 1, 1, 1)
+                )
+                btn.bind(on_press=lambda x, p=pack: self._select_pack(p, popup))
+                button_layout.add_widget(btn)
             
-            # 如果还没有使用过当前激活码，重用当前激活码
-            if not self.codes_used['bulk'] and self.current_codes['bulk']:
+            content.add_widget(button_layout)
+            
+            cancel_btn = Button(
+                text='取消',
+                size_hint_y=None,
+                height=40,
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            cancel_btn.bind(on_press=lambda x: popup.dismiss())
+            content.add_widget(cancel_btn)
+            
+            popup = Popup(
+                title='选择散装激活码包',
+                content=content,
+                size_hint=(0.8, 0.6)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'打开散装选择失败：{str(e)}')
+    
+    def _select_pack(self, pack: PackDefinition, parent_popup):
+        """选择激活码包后填充"""
+        parent_popup.dismiss()
+        self.fill_pack(pack)
+    
+    def fill_pack(self, pack: PackDefinition):
+        """填充散装激活码包（延迟消耗机制）"""
+        line = OrderLine(pack.tier, pack.size, pack)
+        order_id = self.order_id_input.text.strip()
+        if order_id:
+            # 有订单号时按订单出码（重复出码返回原激活码）
+            self.fill_order(pack.name, [line], order_id)
+            return
+        
+        self.copy_context = 'bulk'
+        try:
+            text = None
+            # 如果还没有使用过当前激活码包，重用当前激活码
+            if (not self.codes_used['bulk'] and self.current_codes['bulk'] and
+                    self.current_pack == pack):
                 codes_to_use = self.current_codes['bulk']
-                self.update_status('已加载散装模式（重用当前激活码）')
+                self.update_status(f'已加载{pack.name}（重用当前激活码）')
             else:
-                # 读取新的1天激活码
-                codes_1 = self.read_codes_from_file('code1day.txt')
-                
-                if not codes_1:
-                    self.show_message('警告', '未找到1天激活码文件')
-                    return
-                
-                if len(codes_1) < 25:
-                    self.show_message('警告', f'1天激活码不足25个，只有{len(codes_1)}个')
-                    return
+                # 优先使用后台预先排版好的消息
+                prepared = self.take_prepared('bulk', line)
+                if prepared is not None:
+                    codes_to_use = prepared.codes
+                    if prepared.template == self.get_message_template():
+                        text = prepared.text
+                else:
+                    # 读取新的激活码
+                    pool = self.load_code_pool(pack.tier)
+                    
+                    if not pool:
+                        self.show_message('警告', f'未找到{pack.tier}天激活码文件')
+                        return
+                    
+                    # 按来源顺序取整包激活码，只打开需要的文件，跳过已预留的
+                    with self.pool_lock:
+                        codes_to_use = pool.take(pack.size, self.reserved_values())
+                    if len(codes_to_use) < pack.size:
+                        self.show_message('警告', f'{pack.tier}天激活码不足{pack.size}个，只有{len(codes_to_use)}个')
+                        return
                 
                 # 保存新的激活码，但不标记为已使用
-                codes_to_use = codes_1[:25]
                 self.current_codes['bulk'] = codes_to_use
+                self.current_pack = pack
                 self.codes_used['bulk'] = False
-                self.update_status('已加载散装模式（25个新激活码）')
-            
-            # 构建散装内容 - 与桌面端逻辑一致
-            content_parts = [clean_base_content]
-            content_parts.append('\n以下是25个1天的激活码，激活之后才开始生效：')
-            
-            # 添加25个1天激活码，在第10和15个后添加空行
-            for i, code in enumerate(codes_to_use):
-                content_parts.append(code)
-                # 在第10和15个激活码后添加空行
-                if i == 9 or i == 14:  # 索引从0开始，第10个是索引9，第15个是索引14
-                    content_parts.append('')
+                self.update_status(f'已加载{pack.name}（{pack.size}个新激活码）')
+                self.schedule_prepare()
             
-            bulk_content = '\n'.join(content_parts)
-            self.text_input.text = bulk_content
+            # 基础内容（缓存，已移除激活码行和激活码包），激活码包追加在末尾
+            self.set_message(text or render_order(self.get_message_template(),
+                                                  [line], [codes_to_use]))
+            self.prepared_at = time.monotonic()
             
         except Exception as e:
             self.show_message('错误', f'加载散装内容失败：{str(e)}')
     
     def on_fill_code(self, days: str):
         """填充指定天数的激活码（延迟消耗机制）"""
+        line = OrderLine(days)
+        order_id = self.order_id_input.text.strip()
+        if order_id:
+            # 有订单号时按订单出码（重复出码返回原激活码）
+            self.fill_order(f'{days}天', [line], order_id)
+            return
+        
         self.copy_context = 'single'
         try:
+            text = None
             # 如果还没有使用过当前激活码，重用当前激活码
             if not self.codes_used[days] and self.current_codes[days]:
                 code = self.current_codes[days]
                 self.update_status(f'已填充{days}天激活码（重用当前激活码）')
             else:
-                # 读取新的激活码
-                filename = f'code{days}day.txt'
-                codes = self.read_codes_from_file(filename)
-                
-                if not codes:
-                    self.show_message('警告', f'未找到{days}天激活码文件')
-                    return
-                
-                # 随机选择一个新的激活码
-                code = random.choice(codes)
+                # 优先使用后台预先排版好的消息
+                prepared = self.take_prepared(days, line)
+                if prepared is not None:
+                    code = prepared.codes[0]
+                    if prepared.template == self.get_message_template():
+                        text = prepared.text
+                else:
+                    # 读取新的激活码
+                    pool = self.load_code_pool(days)
+                    
+                    if not pool:
+                        self.show_message('警告', f'未找到{days}天激活码文件')
+                        return
+                    
+                    # 随机选择一个新的激活码，跳过已预留的
+                    with self.pool_lock:
+                        code = pool.random_code(self.reserved_values())
+                    if code is None:
+                        self.show_message('警告', f'{days}天激活码已用完')
+                        return
                 
                 # 保存新的激活码，但不标记为已使用
                 self.current_codes[days] = code
                 self.codes_used[days] = False
                 self.update_status(f'已填充{days}天激活码（新激活码）')
-            
-            # 重新加载基础内容
-            self.load_default_content(None)
-            base_content = self.text_input.text
-            
-            # 移除现有的激活码行
-            lines = base_content.split('\n')
-            filtered_lines = []
-            for line in lines:
-                if not (line.strip().startswith('30天激活码：') or 
-                       line.strip().startswith('90天激活码：') or 
-                       line.strip().startswith('365天激活码：')):
-                    filtered_lines.append(line)
-            
-            # 在"如果您经常在网吧使用"之前插入新的激活码
-            activation_line = f'{days}天激活码：{code}'
-            
-            final_lines = []
-            inserted = False
-            for line in filtered_lines:
-                if '如果您经常在网吧使用' in line and not inserted:
-                    final_lines.append(activation_line)
-                    final_lines.append('')  # 空行
-                    inserted = True
-                final_lines.append(line)
-            
-            # 如果没有找到插入位置，添加到末尾
-            if not inserted:
-                final_lines.append('')
-                final_lines.append(activation_line)
-            
-            content = '\n'.join(final_lines)
-            self.text_input.text = content
+                self.schedule_prepare()
+            
+            # 基础内容（缓存，已移除激活码行和激活码包），
+            # 在"如果您经常在网吧使用"之前插入新的激活码，没有找到插入位置时添加到末尾
+            message = text or render_order(self.get_message_template(), [line], [[code]])
+            self.set_message(message)
+            self.rendered_single = (message, days)
+            self.prepared_at = time.monotonic()
             self.update_status(f'已填充{days}天激活码')
             
         except Exception as e:
             self.show_message('错误', f'填充{days}天激活码失败：{str(e)}')
     
+    def on_order(self, instance):
+        """组合按钮 - 选择或输入组合订单（如"365天+散装25个"）"""
+        from kivy.uix.popup import Popup
+        try:
+            content = BoxLayout(orientation='vertical', padding=20, spacing=10)
+            
+            button_layout = GridLayout(cols=1, spacing=10, size_hint_y=None)
+            button_layout.bind(minimum_height=button_layout.setter('height'))
+            
+            for spec in self.order_specs:
+                btn = Button(
+                    text=spec,
+                    size_hint_y=None,
+                    height=45,
+                    font_size='16sp',
+                    font_name='Chinese' if chinese_font_available else None,
+                    background_color=(0.2, 0.5, 0.7, 1),
+                    background_normal='',
+                    color=(1, 1, 1, 1)
+                )
+                btn.bind(on_press=lambda x, s=spec: self._select_order(s, popup))
+                button_layout.add_widget(btn)
+            
+            content.add_widget(button_layout)
+            
+            # 自定义订单：各项用"+"分隔
+            spec_input = TextInput(
+                hint_text='自定义，如 365天+散装25个 或 30天x2',
+                multiline=False,
+                size_hint_y=None,
+                height=40,
+                font_name='Chinese' if chinese_font_available else None
+            )
+            content.add_widget(spec_input)
+            
+            action_layout = BoxLayout(size_hint_y=None, height=40, spacing=10)
+            ok_btn = Button(
+                text='生成',
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            ok_btn.bind(on_press=lambda x: self._select_order(spec_input.text, popup))
+            cancel_btn = Button(
+                text='取消',
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            cancel_btn.bind(on_press=lambda x: popup.dismiss())
+            action_layout.add_widget(ok_btn)
+            action_layout.add_widget(cancel_btn)
+            content.add_widget(action_layout)
+            
+            popup = Popup(
+                title='选择组合订单',
+                content=content,
+                size_hint=(0.85, 0.7)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'打开组合订单失败：{str(e)}')
+    
+    def _select_order(self, spec: str, parent_popup):
+        """选择组合订单后填充"""
+        try:
+            order = parse_order_spec(spec, self.pack_definitions)
+        except ValueError as e:
+            self.show_message('提示', str(e))
+            return
+        parent_popup.dismiss()
+        self.fill_order(spec.strip(), order, self.order_id_input.text.strip())
+    
+    def reserve_order(self, order: List[OrderLine]) -> List[List[str]]:
+        """为订单各项一次性取出激活码（持有池锁，每个档位只取一次，任一档位不足时都不取）"""
+        needed = {}
+        for line in order:
+            needed[line.tier] = needed.get(line.tier, 0) + line.count
+        
+        taken = {}
+        with self.pool_lock:
+            exclude = self.reserved_values()
+            for days, count in needed.items():
+                pool = self.load_code_pool(days)
+                if not pool:
+                    raise ValueError(f'未找到{days}天激活码文件')
+                codes = pool.take(count, exclude)
+                if len(codes) < count:
+                    raise ValueError(f'{days}天激活码不足{count}个，只有{len(codes)}个')
+                taken[days] = codes
+        
+        # 按订单顺序分配给各项
+        result = []
+        for line in order:
+            codes = taken[line.tier]
+            result.append(codes[:line.count])
+            del codes[:line.count]
+        return result
+    
+    def fill_order(self, spec: str, order: List[OrderLine], order_id: str = ''):
+        """填充组合订单（延迟消耗机制） - 一次取码、一次排版
+
+        有订单号时，该订单号已出过码则直接显示原激活码，不再取新的。
+        """
+        self.copy_context = 'order'
+        try:
+            record = self.order_registry.get(order_id) if order_id else None
+            if record is not None:
+                # 同一订单号重复出码：按索引找到原激活码
+                order = parse_order_spec(record.spec, self.pack_definitions)
+                codes = record.codes
+                self.current_order = (record.spec, order, codes, order_id)
+                self.codes_used['order'] = record.done
+                state = '已发出' if record.done else '未发出'
+                self.update_status(f'订单{order_id}已出过码（{record.spec}，{state}），显示原激活码')
+            # 如果还没有使用过当前订单的激活码，重用当前激活码
+            elif (not self.codes_used['order'] and self.current_order and
+                    self.current_order[1] == order and self.current_order[3] == order_id):
+                codes = self.current_order[2]
+                self.update_status(f'已加载组合订单 {spec}（重用当前激活码）')
+            else:
+                try:
+                    codes = self.reserve_order(order)
+                except ValueError as e:
+                    self.show_message('警告', str(e))
+                    return
+                if order_id:
+                    self.order_registry.add(order_id, spec, codes)
+                
+                # 保存新的激活码，但不标记为已使用
+                self.current_order = (spec, order, codes, order_id)
+                self.codes_used['order'] = False
+                self.update_status(f'已加载组合订单 {spec}（{sum(map(len, codes))}个新激活码）')
+            
+            self.set_message(render_order(self.get_message_template(), order, codes))
+            self.prepared_at = time.monotonic()
+            
+        except Exception as e:
+            self.show_message('错误', f'加载组合订单失败：{str(e)}')
+    
+    def on_stats(self, instance):
+        """统计按钮 - 显示订单数和每单耗时"""
+        from kivy.uix.popup import Popup
+        try:
+            report = Label(
+                text=format_report(self.metrics),
+                font_name='Chinese' if chinese_font_available else None,
+                font_size='14sp',
+                halign='left',
+                valign='top',
+                size_hint_y=None
+            )
+            report.bind(width=lambda instance, width: setattr(instance, 'text_size', (width, None)))
+            report.bind(texture_size=lambda instance, size: setattr(instance, 'height', size[1]))
+            
+            scroll = ScrollView()
+            scroll.add_widget(report)
+            
+            popup = Popup(
+                title='发货统计',
+                content=scroll,
+                size_hint=(0.9, 0.8)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'打开统计失败：{str(e)}')
+    
     def on_upload_codes(self, instance):
         """上传激活码文件"""
+        from kivy.uix.popup import Popup
         try:
             # 创建激活码类型选择弹窗
             content = BoxLayout(orientation='vertical', padding=20, spacing=15)
@@ -670,6 +1272,8 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
     
     def select_code_file(self, days: str, parent_popup):
         """选择激活码文件"""
+        from kivy.uix.popup import Popup
+        from kivy.uix.filechooser import FileChooserListView
         try:
             parent_popup.dismiss()
             
@@ -758,7 +1362,7 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
             # 文件选择器
             filechooser = FileChooserListView(
                 path=root_path,
-                filters=['*.txt'],
+                filters=CODE_FILE_FILTERS,
                 dirselect=False,  # 只能选择文件
                 show_hidden=False  # 不显示隐藏文件
             )
@@ -827,47 +1431,86 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
         except Exception as e:
             self.show_message('错误', f'选择文件失败：{str(e)}')
     
-    def upload_code_file(self, days: str, file_path: str):
-        """上传并验证激活码文件"""
+    def upload_code_file(self, days: str, file_path: str) -> bool:
+        """上传并验证激活码文件 - 已发放过的激活码会被识别并跳过"""
         try:
             # 验证文件是否存在
             if not os.path.exists(file_path):
                 self.show_message('错误', '选择的文件不存在')
-                return
+                return False
             
-            # 验证文件内容
-            test_codes = []
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
+            # 验证文件内容（压缩包边解压边解析，不解压到磁盘）
+            values = set(read_code_values(file_path))
             
-            for line in lines:
-                line = line.strip()
-                if (line and 
-                    not line.startswith('#') and 
-                    self.is_valid_code(line)):
-                    test_codes.append(line)
+            # 先用账本过滤器筛查，只有可能命中的才精确确认
+            issued = self.ledger.find_consumed(values)
+            valid_count = len(values) - len(issued)
             
-            if len(test_codes) < 5:
-                self.show_message('警告', f'文件中只找到{len(test_codes)}个有效激活码，建议至少5个')
-                return
+            if valid_count < 5:
+                self.show_message('警告', f'文件中只找到{valid_count}个未发放的有效激活码，建议至少5个')
+                return False
             
-            # 保存文件路径
-            self.code_file_paths[days] = file_path
-            self.save_code_file_paths()
+            # 添加到该档位的激活码来源
+            self.add_code_source(days, file_path)
             
             # 显示成功信息
             filename = os.path.basename(file_path)
-            self.show_message('成功', f'已上传{days}天激活码文件:\n{filename}\n找到{len(test_codes)}个有效激活码')
-            self.update_status(f'已上传{days}天激活码文件（{len(test_codes)}个）')
+            message = f'已上传{days}天激活码文件:\n{filename}\n找到{valid_count}个有效激活码'
+            if issued:
+                message += f'\n（{len(issued)}个已发放过，将自动跳过）'
+            self.show_message('成功', message)
+            self.update_status(f'已上传{days}天激活码文件（{valid_count}个）')
+            return True
             
         except Exception as e:
             self.show_message('错误', f'上传文件失败：{str(e)}')
+            return False
+    
+    
+    def bulk_import_code_files(self, days: str, paths: List[str]):
+        """批量导入激活码文件 - 在后台线程中解析、去重并合并为一个来源文件"""
+        self.update_status(f'正在导入{len(paths)}个{days}天激活码文件...')
+        threading.Thread(target=self._bulk_import_worker, args=(days, list(paths)), daemon=True).start()
+    
+    def _bulk_import_worker(self, days: str, paths: List[str]):
+        """批量导入线程 - Linux桌面端用多进程并行解析，其他平台在本线程中逐个解析"""
+        try:
+            pools = []
+            for tier in TIERS:
+                pools.extend(TierPool(self.get_code_sources(tier), self._open_code_pool).iter_pools())
+            
+            use_processes = platform == 'linux'
+            # 不能直接fork：本进程有窗口和多个线程，子进程会继承GL/SDL状态和其他线程持有的锁；
+            # forkserver 从干净的服务进程派生工作进程，只需要 code_import 中可序列化的函数
+            mp_context = multiprocessing.get_context('forkserver') if use_processes else None
+            result = import_code_files(paths, days, os.path.join(self.base_dir, 'imports'),
+                                       pools, self.ledger, use_processes=use_processes,
+                                       mp_context=mp_context)
+            Clock.schedule_once(lambda dt: self._finish_bulk_import(days, result))
+        except Exception as e:
+            Clock.schedule_once(lambda dt, msg=str(e): self.show_message('错误', f'批量导入失败：{msg}'))
     
+    def _finish_bulk_import(self, days: str, result):
+        """批量导入完成 - 把合并后的文件加入档位来源并显示各文件统计"""
+        if result.output_path:
+            self.add_code_source(days, result.output_path)
+        
+        lines = []
+        for stats in result.files:
+            name = os.path.basename(stats.path)
+            if stats.error:
+                lines.append(f'{name}：读取失败')
+            else:
+                lines.append(f'{name}：有效{stats.valid}，重复{stats.duplicates}，'
+                             f'已在池中{stats.existing}，已发放{stats.issued}，导入{stats.imported}')
+        lines.append(f'共导入{result.imported}个{days}天激活码')
+        self.show_message('批量导入完成', '\n'.join(lines))
+        self.update_status(f'已批量导入{days}天激活码（{result.imported}个）')
     
     def on_copy(self, instance):
         """复制内容到剪贴板（标记激活码为已使用）"""
         try:
-            content = self.text_input.text
+            content = self.get_message()
             if not content.strip():
                 self.show_message('提示', '没有内容可复制')
                 return
@@ -877,34 +1520,92 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
                 # 散装模式：保持原有格式
                 processed_content = content
                 # 标记散装激活码为已使用
+                if not self.codes_used['bulk'] and self.current_codes['bulk']:
+                    self.consume_codes(self.current_pack.tier, self.current_codes['bulk'])
+                    self.record_copy('bulk')
                 self.codes_used['bulk'] = True
                 self.update_status('内容已复制到剪贴板（散装激活码已消耗）')
+            elif self.copy_context == 'order':
+                # 组合订单：保持原有格式，所有档位的激活码一次提交
+                processed_content = content
+                if not self.codes_used['order'] and self.current_order:
+                    _spec, order, codes, order_id = self.current_order
+                    self.consume_entries([(line.tier, code)
+                                          for line, line_codes in zip(order, codes)
+                                          for code in line_codes])
+                    if order_id:
+                        self.order_registry.mark_done(order_id)
+                        # 订单已发出，清空订单号，避免下一单沿用
+                        self.order_id_input.text = ''
+                    self.record_copy('order')
+                self.codes_used['order'] = True
+                self.update_status('内容已复制到剪贴板（组合订单激活码已消耗）')
             else:
-                # 单个模式：规范化空行
-                processed_content = self.normalize_text_for_paste(content)
-                # 检查并标记对应天数的激活码为已使用
-                for days in ['30', '90', '365']:
-                    if f'{days}天激活码：' in content:
-                        self.codes_used[days] = True
-                        self.update_status(f'内容已复制到剪贴板（{days}天激活码已消耗）')
-                        break
+                # 单个模式：规范化空行；内容就是填充时生成的消息时档位已知，
+                # 否则（编辑过）在规范化的同一次扫描中找出激活码行的档位
+                rendered = self.rendered_single
+                if rendered is not None and rendered[0] == content:
+                    processed_content = normalize_for_paste(content)
+                    found = {rendered[1]}
+                else:
+                    processed_content, found = scan_for_paste(content)
+                # 标记对应天数的激活码为已使用
+                days = next((d for d in ['30', '90', '365'] if d in found), None)
+                if days is not None:
+                    if not self.codes_used[days] and self.current_codes[days]:
+                        self.consume_codes(days, [self.current_codes[days]])
+                        self.record_copy('single')
+                    self.codes_used[days] = True
+                    self.update_status(f'内容已复制到剪贴板（{days}天激活码已消耗）')
                 else:
                     self.update_status('内容已复制到剪贴板')
             
             Clipboard.copy(processed_content)
+            # 后台补上被取走的预排版消息
+            self.schedule_prepare()
             
         except Exception as e:
             self.show_message('错误', f'复制失败：{str(e)}')
     
-    def normalize_text_for_paste(self, text: str) -> str:
-        """规范化文本中的空行"""
-        import re
-        # 将多个连续空行合并为单个空行
-        normalized = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
-        return normalized.strip()
+    def on_undo(self, instance):
+        """撤销最近一次复制消耗的激活码，放回激活码池"""
+        try:
+            with self.pool_lock:
+                undone = self.ledger.undo_last()
+            if not undone:
+                self.show_message('提示', '没有可撤销的激活码消耗')
+                return
+            
+            values = [code for _tier, code in undone]
+            with self.pool_lock:
+                restored = sum(pool.unmark_consumed(values) for pool in self.code_pools.values())
+            
+            # 撤销的正好是当前消息中的激活码时，允许再次复制时重新消耗
+            codes = {decode_code(value) for value in values}
+            for days in ['30', '90', '365']:
+                if self.current_codes[days] in codes:
+                    self.codes_used[days] = False
+            if codes.intersection(self.current_codes['bulk']):
+                self.codes_used['bulk'] = False
+            if self.current_order and any(codes.intersection(c) for c in self.current_order[2]):
+                self.codes_used['order'] = False
+            # 包含这些激活码的订单改回未发出，激活码仍预留给该订单
+            for order_id in self.order_registry.orders_with_values(values):
+                self.order_registry.reopen(order_id)
+            
+            tiers = '、'.join(dict.fromkeys(f'{days}天' for days, _code in undone))
+            if restored < len(values):
+                self.show_message('提示', f'已撤销{len(undone)}个激活码的消耗（{tiers}），'
+                                        f'但只有{restored}个放回了激活码池，'
+                                        f'其余{len(values) - restored}个已不在激活码文件中，不会再发出')
+            else:
+                self.update_status(f'已撤销{len(undone)}个激活码的消耗（{tiers}），已放回激活码池')
+        except Exception as e:
+            self.show_message('错误', f'撤销失败：{str(e)}')
     
     def on_upload(self, instance):
         """统一上传按钮 - 显示上传类型选择"""
+        from kivy.uix.popup import Popup
         try:
             # 创建深色主题的上传类型选择弹窗
             content = BoxLayout(orientation='vertical', padding=25, spacing=15)
@@ -943,6 +1644,46 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
             template_btn.bind(on_press=lambda x: self._upload_template_file(popup))
             button_layout.add_widget(template_btn)
             
+            # 切换模板按钮 - 浅蓝色系（模板库中有多个模板时才显示）
+            if len(self.templates.names()) > 1:
+                switch_btn = Button(
+                    text=f'🔀 切换模板（当前：{self.templates.active}）',
+                    font_name='Chinese',
+                    font_size='16sp',
+                    size_hint_y=None,
+                    height='52dp',
+                    background_color=(0.3, 0.6, 0.9, 1),
+                    background_normal=''
+                )
+                switch_btn.bind(on_press=lambda x: self._show_template_switcher(popup))
+                button_layout.add_widget(switch_btn)
+            
+            # 草稿历史按钮 - 灰蓝色系
+            history_btn = Button(
+                text='🕘 草稿历史',
+                font_name='Chinese',
+                font_size='16sp',
+                size_hint_y=None,
+                height='52dp',
+                background_color=(0.35, 0.45, 0.6, 1),
+                background_normal=''
+            )
+            history_btn.bind(on_press=lambda x: self._show_draft_history(popup))
+            button_layout.add_widget(history_btn)
+            
+            # 同步账本按钮 - 青色系
+            sync_btn = Button(
+                text='🔄 同步账本',
+                font_name='Chinese',
+                font_size='16sp',
+                size_hint_y=None,
+                height='52dp',
+                background_color=(0.2, 0.6, 0.6, 1),
+                background_normal=''
+            )
+            sync_btn.bind(on_press=lambda x: self._show_ledger_sync(popup))
+            button_layout.add_widget(sync_btn)
+            
             # 1天激活码按钮 - 绿色系
             code1_btn = Button(
                 text='🎯 1天激活码',
@@ -1029,6 +1770,262 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
         # 调用原来的上传模板逻辑，但不需要再显示弹窗
         self._show_template_file_chooser()
     
+    def _show_template_switcher(self, parent_popup):
+        """选择模板库中的模板"""
+        from kivy.uix.popup import Popup
+        parent_popup.dismiss()
+        try:
+            content = BoxLayout(orientation='vertical', padding=20, spacing=10)
+            
+            button_layout = GridLayout(cols=1, spacing=10, size_hint_y=None)
+            button_layout.bind(minimum_height=button_layout.setter('height'))
+            
+            active = self.templates.active
+            for name in self.templates.names():
+                btn = Button(
+                    text=f'✔ {name}' if name == active else name,
+                    size_hint_y=None,
+                    height=45,
+                    font_size='16sp',
+                    font_name='Chinese' if chinese_font_available else None,
+                    background_color=(0.2, 0.5, 0.8, 1),
+                    background_normal='',
+                    color=(1, 1, 1, 1)
+                )
+                btn.bind(on_press=lambda x, n=name: self._select_template(n, popup))
+                button_layout.add_widget(btn)
+            
+            scroll = ScrollView()
+            scroll.add_widget(button_layout)
+            content.add_widget(scroll)
+            
+            cancel_btn = Button(
+                text='取消',
+                size_hint_y=None,
+                height=40,
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            cancel_btn.bind(on_press=lambda x: popup.dismiss())
+            content.add_widget(cancel_btn)
+            
+            popup = Popup(
+                title='切换消息模板',
+                content=content,
+                size_hint=(0.8, 0.6)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'打开模板列表失败：{str(e)}')
+    
+    def _select_template(self, name: str, parent_popup):
+        """切换到选中的模板并显示其内容，已预排版的消息按新模板重新排版"""
+        parent_popup.dismiss()
+        if self.is_editing:
+            # 先保存正在编辑的内容到原模板的草稿
+            Clock.unschedule(self.save_draft)
+            self.save_draft()
+        self.templates.activate(name)
+        loaded = self.templates.load(name)
+        text = loaded.text if loaded else DEFAULT_TEMPLATE
+        self.is_auto_update = True
+        try:
+            self.set_message(text)
+        finally:
+            self.is_auto_update = False
+        self.current_content = text
+        self.schedule_prepare()
+        self.update_status(f'已切换到模板：{name}')
+    
+    def _show_draft_history(self, parent_popup):
+        """列出当前模板的草稿历史（最新的在前）"""
+        from kivy.uix.popup import Popup
+        parent_popup.dismiss()
+        try:
+            if self.is_editing:
+                Clock.unschedule(self.save_draft)
+                self.save_draft()
+            name = self.templates.active
+            versions = self.templates.history(name).versions()
+            if not versions:
+                self.show_message('提示', f'模板"{name}"还没有草稿历史')
+                return
+            
+            content = BoxLayout(orientation='vertical', padding=20, spacing=10)
+            
+            button_layout = GridLayout(cols=1, spacing=10, size_hint_y=None)
+            button_layout.bind(minimum_height=button_layout.setter('height'))
+            
+            for version in reversed(versions[-DRAFT_HISTORY_SHOWN:]):
+                saved_at = time.strftime('%m-%d %H:%M:%S', time.localtime(version.saved_at))
+                btn = Button(
+                    text=f'第{version.number}版  {saved_at}  {version.lines}行',
+                    size_hint_y=None,
+                    height=45,
+                    font_size='16sp',
+                    font_name='Chinese' if chinese_font_available else None,
+                    background_color=(0.35, 0.45, 0.6, 1),
+                    background_normal='',
+                    color=(1, 1, 1, 1)
+                )
+                btn.bind(on_press=lambda x, n=version.number: self._restore_draft(n, popup))
+                button_layout.add_widget(btn)
+            
+            scroll = ScrollView()
+            scroll.add_widget(button_layout)
+            content.add_widget(scroll)
+            
+            cancel_btn = Button(
+                text='取消',
+                size_hint_y=None,
+                height=40,
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            cancel_btn.bind(on_press=lambda x: popup.dismiss())
+            content.add_widget(cancel_btn)
+            
+            popup = Popup(
+                title=f'草稿历史（{name}）',
+                content=content,
+                size_hint=(0.8, 0.6)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'读取草稿历史失败：{str(e)}')
+    
+    def _restore_draft(self, number: int, parent_popup):
+        """恢复草稿的一个历史版本（恢复本身也记为新版本，可以再恢复回来）"""
+        parent_popup.dismiss()
+        try:
+            name = self.templates.active
+            text = self.templates.history(name).restore(number)
+            self.templates.save_draft(name, text)
+            self.is_auto_update = True
+            try:
+                self.set_message(text)
+            finally:
+                self.is_auto_update = False
+            self.current_content = text
+            self.schedule_prepare()
+            self.update_status(f'已恢复草稿第{number}版')
+        except Exception as e:
+            self.show_message('错误', f'恢复草稿失败：{str(e)}')
+    
+    def get_sync_dir(self) -> str:
+        """同步文件目录：导出的文件放在这里，其他设备的文件复制到这里再导入"""
+        sync_dir = os.path.join(self.base_dir, 'sync')
+        os.makedirs(sync_dir, exist_ok=True)
+        return sync_dir
+    
+    def _show_ledger_sync(self, parent_popup):
+        """账本同步 - 导出本机的消耗记录，或导入同步目录中其他设备的文件"""
+        from kivy.uix.popup import Popup
+        parent_popup.dismiss()
+        try:
+            content = BoxLayout(orientation='vertical', padding=20, spacing=10)
+            content.add_widget(Label(
+                text=f'本机：{device_id(self.settings)}\n同步目录：{self.get_sync_dir()}',
+                font_name='Chinese' if chinese_font_available else None,
+                halign='center'
+            ))
+            
+            for text, action in (('导出同步文件', self._export_ledger_sync),
+                                 ('导入同步目录中的文件', self._import_ledger_sync)):
+                btn = Button(
+                    text=text,
+                    size_hint_y=None,
+                    height=45,
+                    font_size='16sp',
+                    font_name='Chinese' if chinese_font_available else None,
+                    background_color=(0.2, 0.6, 0.6, 1),
+                    background_normal='',
+                    color=(1, 1, 1, 1)
+                )
+                btn.bind(on_press=lambda x, a=action: a(popup))
+                content.add_widget(btn)
+            
+            cancel_btn = Button(
+                text='取消',
+                size_hint_y=None,
+                height=40,
+                font_size='16sp',
+                font_name='Chinese' if chinese_font_available else None
+            )
+            cancel_btn.bind(on_press=lambda x: popup.dismiss())
+            content.add_widget(cancel_btn)
+            
+            popup = Popup(
+                title='同步账本',
+                content=content,
+                size_hint=(0.8, 0.6)
+            )
+            popup.open()
+            
+        except Exception as e:
+            self.show_message('错误', f'打开账本同步失败：{str(e)}')
+    
+    def _export_ledger_sync(self, parent_popup):
+        """导出上次导出之后的消耗记录到同步目录"""
+        parent_popup.dismiss()
+        try:
+            device = device_id(self.settings)
+            path = os.path.join(self.get_sync_dir(), export_file_name(device))
+            with self.pool_lock:
+                count = LedgerSync(self.storage, self.ledger, device).export_delta(path)
+            self.show_message('导出完成', f'已导出{count}条消耗记录：\n{path}\n\n'
+                                          f'把文件复制到其他设备的同步目录后在那里导入')
+        except Exception as e:
+            self.show_message('错误', f'导出同步文件失败：{str(e)}')
+    
+    def _import_ledger_sync(self, parent_popup):
+        """导入同步目录中其他设备的文件（导入后移到 imported 子目录），并把新消耗的激活码从激活码池中排除"""
+        parent_popup.dismiss()
+        try:
+            device = device_id(self.settings)
+            sync_dir = self.get_sync_dir()
+            paths = sorted(os.path.join(sync_dir, name) for name in os.listdir(sync_dir)
+                           if name.endswith(SYNC_SUFFIX) and not name.startswith(f'ledger-{device}-'))
+            if not paths:
+                self.show_message('提示', f'同步目录中没有其他设备的同步文件：\n{sync_dir}')
+                return
+            
+            sync = LedgerSync(self.storage, self.ledger, device)
+            start = self.ledger.tell()
+            done_dir = os.path.join(sync_dir, 'imported')
+            os.makedirs(done_dir, exist_ok=True)
+            lines = []
+            conflicts = []
+            consumed = 0
+            for path in paths:
+                with self.pool_lock:
+                    result = sync.import_delta(path)
+                os.replace(path, os.path.join(done_dir, os.path.basename(path)))
+                lines.append(f'{result.device}：新记录{result.received}条，新消耗{result.consumed}个')
+                conflicts.extend(result.conflicts)
+                consumed += result.consumed
+            
+            if consumed:
+                with self.pool_lock:
+                    for pool in self.code_pools.values():
+                        pool.mark_consumed(self.ledger.iter_consumed(start=start))
+                    # 预排版的消息可能用到了其他设备已发出的激活码
+                    self.prepared.clear()
+                self.schedule_prepare()
+            
+            if conflicts:
+                lines.append(f'\n⚠️ {len(conflicts)}个激活码被多台设备发出：')
+                for conflict in conflicts[:20]:
+                    lines.append(f'{conflict.tier}天 {decode_code(conflict.code)}：{"、".join(conflict.devices)}')
+                if len(conflicts) > 20:
+                    lines.append('……')
+            self.show_message('导入完成', '\n'.join(lines))
+            self.update_status(f'已同步账本（新消耗{consumed}个）')
+        except Exception as e:
+            self.show_message('错误', f'导入同步文件失败：{str(e)}')
+    
     def _upload_activation_codes(self, days, parent_popup):
         """上传激活码文件的具体实现"""
         parent_popup.dismiss()
@@ -1037,6 +2034,8 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
 
     def _show_template_file_chooser(self):
         """显示模板文件选择器"""
+        from kivy.uix.popup import Popup
+        from kivy.uix.filechooser import FileChooserListView
         try:
             # 创建文件选择弹窗
             content = BoxLayout(orientation='vertical', padding=20, spacing=15)
@@ -1122,22 +2121,22 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
                     file_path = filechooser.selection[0]
                     if file_path.lower().endswith('.txt'):
                         try:
-                            # 读取模板文件内容
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                template_content = f.read().strip()
+                            # 读取模板文件内容（自动识别UTF-8/GBK等编码）
+                            template_content = read_source_text(file_path).strip()
                             
                             if template_content:
-                                # 保存模板文件路径
-                                template_path = os.path.join(self.base_dir, 'sendGoodsMode.txt')
-                                with open(template_path, 'w', encoding='utf-8') as f:
-                                    f.write(template_content)
+                                # 以文件名作为模板名称加入模板库（同名时覆盖）并切换到该模板
+                                name = os.path.splitext(os.path.basename(file_path))[0]
+                                name = self.templates.save(name, template_content)
+                                self.templates.activate(name)
                                 
                                 # 更新当前显示内容
-                                self.text_input.text = template_content
+                                self.set_message(template_content)
                                 self.current_content = template_content
+                                self.schedule_prepare()
                                 
                                 popup.dismiss()
-                                self.update_status(f'✅ 已上传自定义模板：{os.path.basename(file_path)}')
+                                self.update_status(f'✅ 已上传模板：{name}')
                             else:
                                 self.show_message('错误', '模板文件内容为空')
                         except Exception as e:
@@ -1179,12 +2178,14 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
     
     def _show_activation_code_file_chooser(self, days):
         """显示激活码文件选择器"""
+        from kivy.uix.popup import Popup
+        from kivy.uix.filechooser import FileChooserListView
         try:
             # 创建文件选择弹窗
             content = BoxLayout(orientation='vertical', padding=20, spacing=15)
             
             title_label = Label(
-                text=f'选择{days}天激活码文件 (txt格式)',
+                text=f'选择{days}天激活码文件 (txt/gz/zip格式，可多选批量导入)',
                 font_name='Chinese',
                 font_size='16sp',
                 size_hint_y=None,
@@ -1203,7 +2204,8 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
             # 创建文件选择器
             filechooser = FileChooserListView(
                 path=initial_path,
-                filters=['*.txt'],
+                filters=CODE_FILE_FILTERS,
+                multiselect=True,
                 size_hint=(1, 0.7)
             )
             content.add_widget(filechooser)
@@ -1260,40 +2262,18 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
             
             # 确认按钮
             def upload_activation_codes_file(instance):
-                if filechooser.selection:
+                if len(filechooser.selection) > 1:
+                    # 多个文件：后台并行批量导入
+                    popup.dismiss()
+                    self.bulk_import_code_files(days, filechooser.selection)
+                elif filechooser.selection:
                     file_path = filechooser.selection[0]
-                    if file_path.lower().endswith('.txt'):
-                        try:
-                            # 验证文件内容
-                            test_codes = []
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                lines = f.readlines()
-                            
-                            for line in lines:
-                                line = line.strip()
-                                if (line and 
-                                    not line.startswith('#') and 
-                                    self.is_valid_code(line)):
-                                    test_codes.append(line)
-                            
-                            if len(test_codes) < 5:
-                                self.show_message('警告', f'文件中只找到{len(test_codes)}个有效激活码，建议至少5个')
-                                return
-                            
-                            # 保存文件路径
-                            self.code_file_paths[days] = file_path
-                            self.save_code_paths()
-                            
-                            # 显示成功信息
-                            filename = os.path.basename(file_path)
+                    if is_code_file(file_path):
+                        # 验证并保存文件路径
+                        if self.upload_code_file(days, file_path):
                             popup.dismiss()
-                            self.show_message('成功', f'已上传{days}天激活码文件:\n{filename}\n找到{len(test_codes)}个有效激活码')
-                            self.update_status(f'已上传{days}天激活码文件（{len(test_codes)}个）')
-                            
-                        except Exception as e:
-                            self.show_message('错误', f'读取激活码文件失败：{str(e)}')
                     else:
-                        self.show_message('错误', '请选择txt格式的文件')
+                        self.show_message('错误', '请选择txt、gz或zip格式的文件')
                 else:
                     self.show_message('提示', '请选择一个文件')
             
@@ -1331,8 +2311,13 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
         """编辑按钮 - 简单的编辑/保存切换"""
         try:
             if not self.is_editing:
-                # 启用编辑模式
+                # 启用编辑模式：把当前消息放入文本输入框，换下只读预览
+                self.is_auto_update = True
+                self.text_input.text = self.message_text
+                self.is_auto_update = False
                 self.is_editing = True
+                self.message_area.clear_widgets()
+                self.message_area.add_widget(self.editor)
                 
                 # 聚焦到文本输入框
                 self.text_input.focus = True
@@ -1354,8 +2339,11 @@ https://workdrive.zohopublic.com.cn/external/a54d69935446b55e625ee705ccb564d7cf0
                 # 手动保存草稿
                 self.save_draft()
                 
-                # 移除焦点
+                # 移除焦点，换回只读预览
                 self.text_input.focus = False
+                self.set_message(self.text_input.text)
+                self.message_area.clear_widgets()
+                self.message_area.add_widget(self.preview)
                 
                 # 恢复按钮文本和颜色
                 instance.text = '✏️ 编辑'
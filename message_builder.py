@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发货消息排版 - 激活码行、散装激活码包、组合订单
+"""
+
+import re
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from code_ledger import TIERS
+
+# 单个激活码行，如 "30天激活码：XXXXXXXXXX"
+_ACTIVATION_LINE_RE = re.compile(r'^\s*\d+天激活码：')
+# 散装激活码包标题，如 "以下是25个1天的激活码，激活之后才开始生效："
+_PACK_HEADER_RE = re.compile(r'^\s*以下是\d+个\d+天的激活码')
+_CODE_LINE_RE = re.compile(r'^\s*[0-9A-Z]{10}\s*$')
+
+DEFAULT_PACK_HEADER = '以下是{size}个{days}天的激活码，激活之后才开始生效：'
+
+# 单个激活码行插入在这一行之前（模板中没有时追加到末尾）
+ACTIVATION_ANCHOR = '如果您经常在网吧使用'
+# 组合订单中的单项，如 "365天"、"30天x2"、"90"
+_ORDER_ITEM_RE = re.compile(r'^(\d+)(?:天)?(?:\s*[x×*]\s*(\d+))?$')
+# 复制时合并的连续空行
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+# 复制时一次扫描：连续空行，或激活码行的档位
+_PASTE_RE = re.compile(r'\n\s*\n\s*\n+|(\d+)天激活码：')
+
+
+class PackDefinition(NamedTuple):
+    """散装激活码包定义"""
+    name: str                         # 按钮显示名称
+    size: int                         # 激活码数量
+    tier: str = '1'                   # 激活码天数
+    breaks: Tuple[int, ...] = ()      # 在第N个激活码之后空一行
+    header: str = DEFAULT_PACK_HEADER
+
+    @property
+    def header_text(self) -> str:
+        return self.header.format(size=self.size, days=self.tier)
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'size': self.size, 'tier': self.tier,
+                'breaks': list(self.breaks), 'header': self.header}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'PackDefinition':
+        size = int(data['size'])
+        if size <= 0:
+            raise ValueError(f'激活码包数量无效：{size}')
+        breaks = tuple(sorted(int(b) for b in data.get('breaks', ()) if 0 < int(b) < size))
+        return cls(name=str(data.get('name') or f'{size}个'), size=size,
+                   tier=str(data.get('tier', '1')), breaks=breaks,
+                   header=str(data.get('header') or DEFAULT_PACK_HEADER))
+
+
+# 默认激活码包：原有的25个散装（第10、15个后空行），以及10/50/100个
+DEFAULT_PACKS = [
+    PackDefinition('散装25个', 25, '1', (10, 15)),
+    PackDefinition('10个', 10, '1'),
+    PackDefinition('50个', 50, '1', (10, 20, 30, 40)),
+    PackDefinition('100个', 100, '1', (10, 20, 30, 40, 50, 60, 70, 80, 90)),
+]
+
+
+# 默认组合订单：单个激活码 + 散装激活码包
+DEFAULT_ORDERS = ['365天+散装25个', '90天+散装25个', '30天+散装25个']
+
+
+class OrderLine(NamedTuple):
+    """订单中的一项：若干个单独成行的激活码，或一个散装激活码包"""
+    tier: str
+    count: int = 1
+    pack: Optional[PackDefinition] = None
+
+
+class CompiledTemplate(NamedTuple):
+    """预处理后的消息模板：已去掉激活码行，按激活码插入位置拆成前后两段"""
+    head: Tuple[str, ...]     # 插入位置之前的行
+    tail: Tuple[str, ...]     # 插入位置及之后的行
+    anchored: bool            # 是否找到插入位置
+
+
+class PreparedMessage(NamedTuple):
+    """预先排版好的消息：激活码已预留但未消耗，模板变化后需重新排版"""
+    template: CompiledTemplate
+    line: OrderLine
+    codes: List[str]
+    text: str
+
+
+def render_pack(pack: PackDefinition, codes: List[str]) -> str:
+    """排版激活码包：标题 + 激活码（按分组空行），一次join完成"""
+    lines = [pack.header_text]
+    start = 0
+    for stop in pack.breaks:
+        lines.extend(codes[start:stop])
+        lines.append('')
+        start = stop
+    lines.extend(codes[start:])
+    return '\n'.join(lines)
+
+
+def strip_activation_lines(text: str) -> str:
+    """去掉消息中已有的激活码行和散装激活码包"""
+    result = []
+    in_pack = False
+    for line in text.split('\n'):
+        if in_pack:
+            if not line.strip() or _CODE_LINE_RE.match(line):
+                continue
+            in_pack = False
+        if _PACK_HEADER_RE.match(line):
+            in_pack = True
+            continue
+        if _ACTIVATION_LINE_RE.match(line):
+            continue
+        result.append(line)
+    return '\n'.join(result)
+
+
+def parse_order_spec(spec: str, packs: List[PackDefinition]) -> List[OrderLine]:
+    """解析组合订单，各项用"+"分隔：激活码包名称（如"散装25个"）或"天数[x数量]"（如"365天"、"30天x2"）"""
+    by_name = {pack.name: pack for pack in packs}
+    order = []
+    for item in spec.replace('＋', '+').split('+'):
+        item = item.strip()
+        if not item:
+            continue
+        pack = by_name.get(item)
+        if pack is not None:
+            order.append(OrderLine(pack.tier, pack.size, pack))
+            continue
+        match = _ORDER_ITEM_RE.match(item)
+        if not match:
+            raise ValueError(f'无法识别的订单项：{item}')
+        if match.group(1) not in TIERS:
+            raise ValueError(f'不支持的激活码天数：{item}')
+        count = int(match.group(2) or 1)
+        if count <= 0:
+            raise ValueError(f'订单项数量无效：{item}')
+        order.append(OrderLine(match.group(1), count))
+    if not order:
+        raise ValueError('订单为空')
+    return order
+
+
+def compile_template(text: str) -> CompiledTemplate:
+    """预处理模板：去掉已有的激活码行，找到激活码插入位置（只需在模板变化时做一次）"""
+    lines = strip_activation_lines(text).split('\n')
+    for i, line in enumerate(lines):
+        if ACTIVATION_ANCHOR in line:
+            return CompiledTemplate(tuple(lines[:i]), tuple(lines[i:]), True)
+    return CompiledTemplate(tuple(lines), (), False)
+
+
+def render_order(template: CompiledTemplate, order: List[OrderLine],
+                 codes: List[List[str]]) -> str:
+    """按模板排版整个订单：单个激活码插入到插入位置之前，激活码包追加在末尾
+
+    codes 与 order 一一对应，一次join完成。
+    """
+    singles = []
+    blocks = []
+    for line, line_codes in zip(order, codes):
+        if line.pack is not None:
+            blocks.append(render_pack(line.pack, line_codes))
+        else:
+            singles.extend(f'{line.tier}天激活码：{code}' for code in line_codes)
+    lines = list(template.head)
+    if singles:
+        if template.anchored:
+            lines.extend(singles)
+            lines.append('')
+        else:
+            lines.append('')
+            lines.extend(singles)
+    lines.extend(template.tail)
+    return '\n\n'.join(['\n'.join(lines)] + blocks)
+
+
+def normalize_for_paste(text: str) -> str:
+    """规范化文本中的空行：多个连续空行合并为一个"""
+    return _BLANK_LINES_RE.sub('\n\n', text).strip()
+
+
+def scan_for_paste(text: str) -> Tuple[str, Set[str]]:
+    """规范化空行，同时找出消息中激活码行的档位，一次扫描完成
+
+    用于内容被编辑过、不知道消息中包含哪些激活码时；未编辑的消息直接用 normalize_for_paste。
+    """
+    tiers = set()
+
+    def replace(match):
+        days = match.group(1)
+        if days is None:
+            return '\n\n'
+        tiers.add(days)
+        return match.group(0)
+
+    return _PASTE_RE.sub(replace, text).strip(), tiers
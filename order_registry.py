@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+订单出码记录 - 按订单号记录已分配的激活码，同一订单重复出码时直接返回原激活码
+"""
+
+import json
+import time
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Union
+
+from code_pool import encode_code
+from storage import Storage, as_storage
+
+# 存储中的名称
+JOURNAL_NAME = 'orders.jsonl'
+
+
+class OrderRecord(NamedTuple):
+    """一个订单号已分配的激活码"""
+    order_id: str
+    spec: str                 # 订单内容，如 "365天"、"散装25个"、"365天+散装25个"
+    codes: List[List[str]]    # 与订单各项一一对应
+    ts: int
+    done: bool = False        # 是否已复制发出（激活码已消耗）
+
+
+class OrderRegistry:
+    """订单出码记录
+
+    只追加的 JSON 行日志（orders.jsonl），打开时读入内存建立 订单号 -> 记录 的索引；
+    分配激活码、发出、撤销发出和取消各追加一行并立即落盘。
+    已分配但尚未发出的激活码视为预留，取新激活码时需跳过；放弃的订单取消后预留才释放。
+    """
+
+    def __init__(self, storage: Union[Storage, str]):
+        self.storage = as_storage(storage)
+        self.orders = {}       # 订单号 -> OrderRecord
+        self._pending = set()  # 已分配未发出的激活码
+        self._load()
+
+    def _load(self):
+        data = self.storage.read(JOURNAL_NAME, 0, self.storage.size(JOURNAL_NAME))
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # 崩溃时写了一半的行
+            order_id = entry.get('id')
+            if entry.get('op') == 'issue':
+                self.orders[order_id] = OrderRecord(order_id, entry['spec'], entry['codes'],
+                                                    entry['ts'], entry.get('done', False))
+            elif entry.get('op') in ('done', 'reopen') and order_id in self.orders:
+                done = entry['op'] == 'done'
+                self.orders[order_id] = self.orders[order_id]._replace(done=done)
+            elif entry.get('op') == 'cancel':
+                self.orders.pop(order_id, None)
+        for record in self.orders.values():
+            if not record.done:
+                self._pending.update(self._values(record))
+
+    @staticmethod
+    def _values(record: OrderRecord) -> List[int]:
+        return [encode_code(code) for line_codes in record.codes for code in line_codes]
+
+    def _append(self, entry: Dict):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        self.storage.append(JOURNAL_NAME, line.encode('utf-8'))
+
+    def get(self, order_id: str) -> Optional[OrderRecord]:
+        return self.orders.get(order_id)
+
+    def add(self, order_id: str, spec: str, codes: List[List[str]], done: bool = False) -> OrderRecord:
+        """记录订单号分配到的激活码（订单号已存在时报错）"""
+        if order_id in self.orders:
+            raise ValueError(f'订单号已存在：{order_id}')
+        record = OrderRecord(order_id, spec, codes, int(time.time()), done)
+        self._append({'op': 'issue', 'id': order_id, 'spec': spec, 'codes': codes,
+                      'ts': record.ts, 'done': done})
+        self.orders[order_id] = record
+        if not done:
+            self._pending.update(self._values(record))
+        return record
+
+    def mark_done(self, order_id: str):
+        """订单已发出，激活码不再算作预留"""
+        record = self.orders.get(order_id)
+        if record is None or record.done:
+            return
+        self._append({'op': 'done', 'id': order_id})
+        self.orders[order_id] = record._replace(done=True)
+        self._pending.difference_update(self._values(record))
+
+    def reopen(self, order_id: str):
+        """订单的消耗被撤销，激活码重新算作预留（再次复制时重新消耗）"""
+        record = self.orders.get(order_id)
+        if record is None or not record.done:
+            return
+        self._append({'op': 'reopen', 'id': order_id})
+        self.orders[order_id] = record._replace(done=False)
+        self._pending.update(self._values(record))
+
+    def cancel(self, order_id: str) -> bool:
+        """取消未发出的订单：释放预留的激活码，订单号可重新出码；已发出或不存在时返回False"""
+        record = self.orders.get(order_id)
+        if record is None or record.done:
+            return False
+        self._append({'op': 'cancel', 'id': order_id})
+        del self.orders[order_id]
+        self._pending.difference_update(self._values(record))
+        return True
+
+    def release_stale(self, max_age: float) -> List[str]:
+        """取消分配后超过 max_age 秒仍未发出的订单，返回被取消的订单号"""
+        deadline = time.time() - max_age
+        stale = [record.order_id for record in self.orders.values()
+                 if not record.done and record.ts < deadline]
+        for order_id in stale:
+            self.cancel(order_id)
+        return stale
+
+    def orders_with_values(self, values: Iterable[int]) -> List[str]:
+        """包含其中任一激活码的已发出订单（撤销消耗时用来重新打开对应订单）"""
+        values = set(values)
+        return [record.order_id for record in self.orders.values()
+                if record.done and values.intersection(self._values(record))]
+
+    def pending_values(self) -> FrozenSet[int]:
+        """已分配给订单但尚未发出的激活码（快照：后台线程取码时界面线程可能正在出码或撤销）"""
+        return frozenset(self._pending)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+统一设置 - 档位激活码来源、模板库、激活码包和组合订单等设置保存在一个文档中
+
+首次访问时加载一次；多项修改可放在一个事务中一次原子写入；修改后通知订阅者。
+"""
+
+import copy
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from message_builder import DEFAULT_ORDERS, DEFAULT_PACKS, PackDefinition
+from storage import Storage
+
+# 存储中的名称
+DOCUMENT_NAME = 'settings.json'
+# 默认消息模板的名称（模板库中始终存在）
+DEFAULT_TEMPLATE_NAME = '默认'
+
+
+class SettingKey(NamedTuple):
+    """设置项：名称、默认值、JSON与值之间的转换，以及迁移前的旧配置文件"""
+    name: str
+    default: Callable[[], Any]
+    decode: Callable[[Any], Any]       # JSON数据 -> 值，数据无效时抛出 ValueError/TypeError/KeyError
+    encode: Callable[[Any], Any]       # 值 -> JSON数据
+    legacy: Optional[str] = None
+
+
+def _decode_tier_sources(data) -> Dict[str, Any]:
+    sources = {}
+    for days, value in data.items():
+        if value is None or isinstance(value, str):
+            sources[str(days)] = value
+        else:
+            sources[str(days)] = [str(path) for path in value]
+    return sources
+
+
+def _decode_orders(data) -> List[str]:
+    specs = [str(item) for item in data if str(item).strip()]
+    if not specs:
+        raise ValueError('没有组合订单')
+    return specs
+
+
+def _decode_templates(data) -> List[str]:
+    names = [str(name) for name in data]
+    if DEFAULT_TEMPLATE_NAME not in names:
+        names.insert(0, DEFAULT_TEMPLATE_NAME)
+    return names
+
+
+def _decode_packs(data) -> List[PackDefinition]:
+    packs = [PackDefinition.from_dict(item) for item in data]
+    if not packs:
+        raise ValueError('没有激活码包')
+    return packs
+
+
+# 各档位的激活码来源：{天数: 文件路径、文件路径列表或目录}
+TIER_SOURCES = SettingKey('tier_sources', dict, _decode_tier_sources, dict, 'code_paths.json')
+# 模板库中的模板名称
+TEMPLATES = SettingKey('templates', lambda: [DEFAULT_TEMPLATE_NAME], _decode_templates, list)
+# 当前使用的消息模板（模板名称）
+ACTIVE_TEMPLATE = SettingKey('active_template', lambda: DEFAULT_TEMPLATE_NAME, str, str)
+# 散装激活码包定义
+PACKS = SettingKey('packs', lambda: list(DEFAULT_PACKS), _decode_packs,
+                   lambda packs: [pack.to_dict() for pack in packs], 'code_packs.json')
+# 组合订单（如"365天+散装25个"）
+ORDERS = SettingKey('orders', lambda: list(DEFAULT_ORDERS), _decode_orders, list, 'code_orders.json')
+# 上次找到的中文字体文件（启动时直接注册，文件不存在时才重新查找）
+FONT_PATH = SettingKey('font_path', str, str, str)
+# 本机在账本同步中的设备名称（首次同步时生成）
+DEVICE_ID = SettingKey('device_id', str, str, str)
+
+
+class Settings:
+    """设置存储
+
+    所有设置项保存在一个JSON文档中（原子替换）；尚未保存过的设置项从旧的配置文件
+    （code_paths.json 等）迁移。读取返回副本，修改只能通过 set 或 transaction。
+    可在多个线程中使用。
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self._raw = None        # 文档中的JSON数据（首次访问时加载）
+        self._values = {}       # 设置项名称 -> 已解析的值
+        self._pending = None    # 事务中尚未写入的修改
+        self._subscribers = {}  # 设置项名称 -> [回调]
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._raw is not None:
+            return
+        data = self.storage.get(DOCUMENT_NAME)
+        try:
+            raw = json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            raw = {}
+        self._raw = raw if isinstance(raw, dict) else {}
+
+    def _resolve(self, key: SettingKey):
+        """解析设置项：文档中的值，其次旧配置文件，都无效时使用默认值"""
+        if key.name in self._raw:
+            try:
+                return key.decode(self._raw[key.name])
+            except (ValueError, TypeError, KeyError, AttributeError):
+                return key.default()
+        if key.legacy:
+            data = self.storage.get(key.legacy)
+            if data:
+                try:
+                    return key.decode(json.loads(data.decode('utf-8')))
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    pass
+        return key.default()
+
+    def get(self, key: SettingKey):
+        with self._lock:
+            if self._pending is not None and key.name in self._pending:
+                return copy.deepcopy(self._pending[key.name][1])
+            self._load()
+            if key.name not in self._values:
+                self._values[key.name] = self._resolve(key)
+            return copy.deepcopy(self._values[key.name])
+
+    def set(self, key: SettingKey, value):
+        """修改设置项（在事务中时等事务结束一起写入）"""
+        with self.transaction():
+            self._pending[key.name] = (key, copy.deepcopy(value))
+
+    @contextmanager
+    def transaction(self):
+        """事务：其中的多项修改在结束时一次原子写入并通知订阅者；出错时全部放弃
+
+        嵌套的事务并入最外层。事务期间持有锁，其他线程的读写会等待。
+        """
+        with self._lock:
+            if self._pending is not None:
+                yield self
+                return
+            self._load()
+            self._pending = {}
+            try:
+                yield self
+            except BaseException:
+                self._pending = None
+                raise
+            changes, self._pending = self._pending, None
+            if not changes:
+                return
+            raw = dict(self._raw)
+            for name, (key, value) in changes.items():
+                raw[name] = key.encode(value)
+            text = json.dumps(raw, ensure_ascii=False, indent=2)
+            self.storage.put(DOCUMENT_NAME, text.encode('utf-8'))
+            self._raw = raw
+            for name, (_key, value) in changes.items():
+                self._values[name] = value
+        for name, (key, value) in changes.items():
+            for callback in self._subscribers.get(name, ()):
+                callback(key, copy.deepcopy(value))
+
+    def subscribe(self, key: SettingKey, callback: Callable[[SettingKey, Any], None]):
+        """订阅设置项的修改，回调参数为(设置项, 新值)，在写入后于修改所在的线程中调用"""
+        self._subscribers.setdefault(key.name, []).append(callback)
+
+    def tier_sources(self, days: str):
+        """档位配置的激活码来源（未配置时为None）"""
+        return self.get(TIER_SOURCES).get(days)
+
+    def add_tier_source(self, days: str, path: str, current: List[str]):
+        """把文件加入档位的激活码来源；尚未配置时以 current（当前实际使用的来源）为基础"""
+        with self.transaction():
+            sources = self.get(TIER_SOURCES)
+            configured = sources.get(days) or list(current)
+            if isinstance(configured, str):
+                configured = [configured]
+            if path not in configured:
+                configured.append(path)
+            sources[days] = configured
+            self.set(TIER_SOURCES, sources)
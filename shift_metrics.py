@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发货效率统计 - 每小时订单数和每单耗时直方图（固定分桶，紧凑二进制保存）
+"""
+
+import time
+import struct
+from array import array
+from bisect import bisect_right
+from typing import List, Optional, Union
+
+from storage import Storage, as_storage
+
+# 订单类型：单个激活码、散装激活码包、组合订单
+KINDS = ('single', 'bulk', 'order')
+KIND_LABELS = {'single': '单个', 'bulk': '散装', 'order': '组合'}
+
+# 耗时分桶上界（秒），最后一个桶为超过最大上界
+BUCKET_BOUNDS = (2, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+NUM_BUCKETS = len(BUCKET_BOUNDS) + 1
+
+# 最多保留的小时数（90天）
+MAX_HOURS = 24 * 90
+
+# 文件头：魔数、类型数、分桶数、小时记录数
+_HEADER = struct.Struct('<4sBBI')
+_MAGIC = b'SCM1'
+
+# 存储中的名称
+DOCUMENT_NAME = 'metrics.bin'
+
+
+class ShiftMetrics:
+    """发货效率统计
+
+    record 只在内存中累加计数（不做IO），由调用方在空闲时调用 save 持久化。
+    文件内容：各类型的耗时直方图、耗时总和（毫秒），以及 (小时序号, 订单数) 对。
+    """
+
+    def __init__(self, storage: Union[Storage, str]):
+        self.storage = as_storage(storage)
+        self.histograms = {kind: array('I', bytes(4 * NUM_BUCKETS)) for kind in KINDS}
+        self.latency_ms = {kind: 0 for kind in KINDS}
+        self.hours = {}     # 小时序号（Unix时间 // 3600） -> 订单数
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        data = self.storage.get(DOCUMENT_NAME)
+        if data is None:
+            return
+        try:
+            magic, num_kinds, num_buckets, num_hours = _HEADER.unpack_from(data)
+        except struct.error:
+            return
+        if magic != _MAGIC or num_kinds != len(KINDS) or num_buckets != NUM_BUCKETS:
+            return  # 格式不同（分桶改变过），重新统计
+        pos = _HEADER.size
+        hist = array('I')
+        hist.frombytes(data[pos:pos + 4 * num_kinds * num_buckets])
+        pos += 4 * num_kinds * num_buckets
+        sums = array('Q')
+        sums.frombytes(data[pos:pos + 8 * num_kinds])
+        pos += 8 * num_kinds
+        pairs = array('I')
+        pairs.frombytes(data[pos:pos + 8 * num_hours])
+        if len(hist) != num_kinds * num_buckets or len(sums) != num_kinds or len(pairs) != 2 * num_hours:
+            return
+        for i, kind in enumerate(KINDS):
+            self.histograms[kind] = hist[i * num_buckets:(i + 1) * num_buckets]
+            self.latency_ms[kind] = sums[i]
+        self.hours = dict(zip(pairs[0::2], pairs[1::2]))
+
+    def record(self, kind: str, latency: float, ts: Optional[float] = None):
+        """记录一单：类型、从填充到复制的耗时（秒）"""
+        if ts is None:
+            ts = time.time()
+        self.histograms[kind][bisect_right(BUCKET_BOUNDS, latency)] += 1
+        self.latency_ms[kind] += int(latency * 1000)
+        hour = int(ts // 3600)
+        self.hours[hour] = self.hours.get(hour, 0) + 1
+        self.dirty = True
+
+    def save(self):
+        """持久化（原子替换），只保留最近 MAX_HOURS 个小时的计数"""
+        if not self.dirty:
+            return
+        if len(self.hours) > MAX_HOURS:
+            for hour in sorted(self.hours)[:-MAX_HOURS]:
+                del self.hours[hour]
+        hist = array('I')
+        for kind in KINDS:
+            hist.extend(self.histograms[kind])
+        sums = array('Q', (self.latency_ms[kind] for kind in KINDS))
+        pairs = array('I')
+        for hour in sorted(self.hours):
+            pairs.append(hour)
+            pairs.append(self.hours[hour])
+        header = _HEADER.pack(_MAGIC, len(KINDS), NUM_BUCKETS, len(self.hours))
+        self.storage.put(DOCUMENT_NAME, header + hist.tobytes() + sums.tobytes() + pairs.tobytes())
+        self.dirty = False
+
+    def total(self, kind: Optional[str] = None) -> int:
+        kinds = KINDS if kind is None else (kind,)
+        return sum(sum(self.histograms[k]) for k in kinds)
+
+    def percentile(self, q: float, kind: Optional[str] = None) -> Optional[float]:
+        """按分桶估算耗时分位数（返回所在桶的上界，超过最大上界时返回None）"""
+        kinds = KINDS if kind is None else (kind,)
+        counts = [sum(self.histograms[k][i] for k in kinds) for i in range(NUM_BUCKETS)]
+        total = sum(counts)
+        if not total:
+            return None
+        target = q * total
+        running = 0
+        for i, count in enumerate(counts):
+            running += count
+            if running >= target:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else None
+        return None
+
+    def hourly(self, hours: int = 24, now: Optional[float] = None) -> List[int]:
+        """最近若干小时（含当前小时）的订单数，按时间顺序"""
+        current = int((time.time() if now is None else now) // 3600)
+        return [self.hours.get(h, 0) for h in range(current - hours + 1, current + 1)]
+
+
+def _bucket_label(i: int) -> str:
+    if i == 0:
+        return f'<{BUCKET_BOUNDS[0]}秒'
+    if i < len(BUCKET_BOUNDS):
+        return f'{BUCKET_BOUNDS[i - 1]}-{BUCKET_BOUNDS[i]}秒'
+    return f'>{BUCKET_BOUNDS[-1]}秒'
+
+
+def _bound_label(bound: Optional[float]) -> str:
+    return f'≤{bound}秒' if bound is not None else f'>{BUCKET_BOUNDS[-1]}秒'
+
+
+def format_report(metrics: ShiftMetrics, hours: int = 12, now: Optional[float] = None) -> str:
+    """生成统计报告文本（App统计界面和命令行共用）"""
+    now = time.time() if now is None else now
+    total = metrics.total()
+    lines = [f'累计订单：{total}']
+    if not total:
+        return lines[0]
+
+    counts = {kind: metrics.total(kind) for kind in KINDS}
+    lines.append('  '.join(f'{KIND_LABELS[kind]} {counts[kind]}' for kind in KINDS))
+    active = [count for count in metrics.hours.values() if count]
+    if active:
+        lines.append(f'有订单的小时平均每小时 {sum(active) / len(active):.1f} 单，最高 {max(active)} 单')
+    total_ms = sum(metrics.latency_ms.values())
+    p50 = metrics.percentile(0.5)
+    p90 = metrics.percentile(0.9)
+    lines.append(f'平均每单 {total_ms / total / 1000:.1f} 秒，'
+                 f'中位数 {_bound_label(p50)}，90% {_bound_label(p90)}')
+
+    lines.append('')
+    lines.append(f'最近{hours}小时订单数：')
+    recent = metrics.hourly(hours, now)
+    first_hour = int(now // 3600) - hours + 1
+    peak = max(recent) or 1
+    for offset, count in enumerate(recent):
+        label = time.strftime('%m-%d %H:00', time.localtime((first_hour + offset) * 3600))
+        lines.append(f'{label}  {count:>4}  {"█" * round(count * 20 / peak)}')
+
+    lines.append('')
+    lines.append('每单耗时分布：')
+    histogram = [sum(metrics.histograms[k][i] for k in KINDS) for i in range(NUM_BUCKETS)]
+    peak = max(histogram) or 1
+    for i, count in enumerate(histogram):
+        lines.append(f'{_bucket_label(i):>10}  {count:>5}  {"█" * round(count * 20 / peak)}')
+    return '\n'.join(lines)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发货助手命令行工具 - 在电脑上批量处理激活码（不依赖Kivy）
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import Dict, List, Optional
+
+from code_pool import CodePool, load_code_pool, decode_code, encode_code, expand_sources
+from code_ledger import TIERS, ConsumptionLedger
+from code_generator import generate_codes, write_code_file
+from code_import import import_code_files
+from order_registry import OrderRegistry
+from ledger_sync import LedgerSync, SyncConflict, device_id, export_file_name
+from message_builder import parse_order_spec, render_order
+from shift_metrics import ShiftMetrics, format_report
+from settings import PACKS, Settings
+from storage import STORAGE_BACKENDS, open_storage
+from storage_bench import format_benchmark, run_storage_benchmark
+from startup_bench import format_startup, measure_startup, slowest_imports
+from template_library import TemplateLibrary
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def tier_sources(data_dir: str, settings: Settings, days: str) -> List[str]:
+    """获取档位的激活码来源文件 - 与App一致，优先使用上传的文件"""
+    sources = expand_sources(settings.tier_sources(days))
+    if not sources:
+        sources = [os.path.join(data_dir, f'code{days}day.txt')]
+    return [path for path in sources if os.path.exists(path)]
+
+
+def load_tier_pools(data_dir: str, settings: Settings,
+                    ledger: ConsumptionLedger) -> Dict[str, List[CodePool]]:
+    """加载所有档位全部来源的激活码池"""
+    pools = {}
+    index_dir = os.path.join(data_dir, 'index')
+    for days in TIERS:
+        pools[days] = []
+        for path in tier_sources(data_dir, settings, days):
+            pool = load_code_pool(path, index_dir)
+            pool.mark_consumed_sorted(ledger.snapshot_values())
+            pool.mark_consumed(ledger.iter_consumed(snapshot=False))
+            pools[days].append(pool)
+    return pools
+
+
+def cmd_generate(args) -> int:
+    """生成激活码文件"""
+    if args.count <= 0:
+        print('数量必须大于0', file=sys.stderr)
+        return 2
+    ledger = ConsumptionLedger(args.storage)
+    pools = load_tier_pools(args.data_dir, args.settings, ledger)
+
+    started = time.perf_counter()
+    all_pools = [pool for tier_pools in pools.values() for pool in tier_pools]
+    values = generate_codes(args.count, all_pools, ledger)
+    output = args.output or os.path.join(
+        args.data_dir, f'code{args.tier}day-{time.strftime("%Y%m%d-%H%M%S")}.txt')
+    write_code_file(output, args.tier, values, args.group_size)
+    elapsed = time.perf_counter() - started
+
+    print(f'已生成{len(values)}个{args.tier}天激活码：{output}（耗时{elapsed:.2f}秒）')
+    return 0
+
+
+def cmd_import(args) -> int:
+    """批量导入激活码文件"""
+    ledger = ConsumptionLedger(args.storage)
+    pools = load_tier_pools(args.data_dir, args.settings, ledger)
+    all_pools = [pool for tier_pools in pools.values() for pool in tier_pools]
+
+    started = time.perf_counter()
+    result = import_code_files(args.files, args.tier, os.path.join(args.data_dir, 'imports'),
+                               all_pools, ledger, workers=args.workers)
+    if result.output_path:
+        # 尚未配置时先保留默认激活码文件（与App共用设置）
+        args.settings.add_tier_source(args.tier, result.output_path,
+                                      tier_sources(args.data_dir, args.settings, args.tier))
+        ledger.save_filter()
+    elapsed = time.perf_counter() - started
+
+    print(f'{"文件":<40} {"有效":>8} {"重复":>8} {"已在池中":>8} {"已发放":>8} {"导入":>8}')
+    for stats in result.files:
+        name = os.path.basename(stats.path)
+        if stats.error:
+            print(f'{name:<40} 读取失败：{stats.error}')
+        else:
+            print(f'{name:<40} {stats.valid:>8} {stats.duplicates:>8} {stats.existing:>8} '
+                  f'{stats.issued:>8} {stats.imported:>8}')
+    if result.output_path:
+        print(f'共导入{result.imported}个{args.tier}天激活码：{result.output_path}（耗时{elapsed:.2f}秒）')
+    else:
+        print(f'没有可导入的新激活码（耗时{elapsed:.2f}秒）')
+    return 0 if all(not stats.error for stats in result.files) else 1
+
+
+def cmd_undo(args) -> int:
+    """撤销最近的消耗提交"""
+    ledger = ConsumptionLedger(args.storage)
+    registry = OrderRegistry(args.storage)
+    for _ in range(args.count):
+        undone = ledger.undo_last()
+        if not undone:
+            print('没有可撤销的激活码消耗')
+            break
+        codes = ' '.join(decode_code(code) for _tier, code in undone)
+        print(f'已撤销{len(undone)}个{undone[0][0]}天激活码：{codes}')
+        # 对应的订单改回未发出，激活码仍预留给该订单，不会被其他订单取走
+        for order_id in registry.orders_with_values(code for _tier, code in undone):
+            registry.reopen(order_id)
+            print(f'订单{order_id}已改为未发出')
+    ledger.save_filter()
+    return 0
+
+
+def cmd_checkpoint(args) -> int:
+    """把账本日志折叠进快照并清空日志"""
+    ledger = ConsumptionLedger(args.storage)
+    records = ledger.journal_records
+    if ledger.checkpoint():
+        print(f'已折叠{records}条日志记录，快照共{len(ledger.snapshot_values())}个激活码')
+    else:
+        print('日志为空，无需折叠')
+    return 0
+
+
+def cmd_sync_export(args) -> int:
+    """导出上次导出之后的消耗记录，供其他设备导入"""
+    device = device_id(args.settings)
+    output = args.output or os.path.join(args.data_dir, 'sync', export_file_name(device))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    ledger = ConsumptionLedger(args.storage)
+    count = LedgerSync(args.storage, ledger, device).export_delta(output, full=args.full)
+    print(f'已导出{count}条消耗记录（本机：{device}）：{output}')
+    return 0
+
+
+def print_conflicts(conflicts: List[SyncConflict]):
+    """列出被多台设备发出的激活码"""
+    for conflict in conflicts:
+        print(f'  {conflict.tier}天 {decode_code(conflict.code)}：{"、".join(conflict.devices)}')
+
+
+def cmd_sync_import(args) -> int:
+    """导入其他设备导出的同步文件（可重复导入，顺序无关）"""
+    ledger = ConsumptionLedger(args.storage)
+    sync = LedgerSync(args.storage, ledger, device_id(args.settings))
+    conflicts = 0
+    for path in args.files:
+        try:
+            result = sync.import_delta(path)
+        except (OSError, ValueError) as e:
+            print(f'{path}：{e}', file=sys.stderr)
+            return 1
+        print(f'{os.path.basename(path)}（{result.device}）：新记录{result.received}条，'
+              f'新消耗{result.consumed}个')
+        if result.conflicts:
+            print(f'⚠ {len(result.conflicts)}个激活码被多台设备发出：')
+            print_conflicts(result.conflicts)
+        conflicts += len(result.conflicts)
+    return 3 if conflicts else 0
+
+
+def cmd_sync_status(args) -> int:
+    """显示各设备的消耗数量和所有冲突"""
+    ledger = ConsumptionLedger(args.storage)
+    sync = LedgerSync(args.storage, ledger, device_id(args.settings))
+    sync.reconcile()
+    print(f'本机：{sync.device}')
+    for device, count in sync.device_counts().items():
+        print(f'  {device:<30} {count:>8}')
+    conflicts = sync.conflicts()
+    if conflicts:
+        print(f'{len(conflicts)}个激活码被多台设备发出：')
+        print_conflicts(conflicts)
+    else:
+        print('没有冲突')
+    return 0
+
+
+def cmd_issue(args) -> int:
+    """按订单号出码并直接记为已消耗；同一订单号重复调用返回原激活码"""
+    template = None
+    if args.template is not None:
+        # 未指定名称时使用App当前的模板（草稿优先，与App一致）
+        loaded = TemplateLibrary(args.storage, args.settings).load(args.template or None)
+        if loaded is None:
+            print(f'模板不存在或为空：{args.template}', file=sys.stderr)
+            return 2
+        template = loaded.compiled
+    ledger = ConsumptionLedger(args.storage)
+    registry = OrderRegistry(args.storage)
+    record = registry.get(args.order_id)
+    reused = record is not None
+    packs = args.settings.get(PACKS)
+    order = None
+    if record is None:
+        try:
+            order = parse_order_spec(args.spec, packs)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        pools = load_tier_pools(args.data_dir, args.settings, ledger)
+        exclude = registry.pending_values()
+        needed = {}
+        for line in order:
+            needed[line.tier] = needed.get(line.tier, 0) + line.count
+        taken = {}
+        for days, count in needed.items():
+            codes = []
+            for pool in pools[days]:
+                codes.extend(pool.head(count - len(codes), exclude))
+                if len(codes) >= count:
+                    break
+            if len(codes) < count:
+                print(f'{days}天激活码不足{count}个，只有{len(codes)}个', file=sys.stderr)
+                return 1
+            taken[days] = codes
+        codes = []
+        for line in order:
+            codes.append(taken[line.tier][:line.count])
+            del taken[line.tier][:line.count]
+        # 先记为预留再消耗：中断时重试同一订单号会取回这些激活码，不会重新分配
+        record = registry.add(args.order_id, args.spec.strip(), codes)
+    if not record.done:
+        # 新订单，或上次中断、被撤销的订单：补记账本中还没有的消耗
+        if order is None:
+            try:
+                order = parse_order_spec(record.spec, packs)
+            except ValueError as e:
+                print(f'无法解析订单{record.order_id}的内容：{e}', file=sys.stderr)
+                return 1
+        entries = [(line.tier, encode_code(code))
+                   for line, line_codes in zip(order, record.codes) for code in line_codes]
+        consumed = ledger.find_consumed(value for _tier, value in entries)
+        entries = [entry for entry in entries if entry[1] not in consumed]
+        if entries:
+            ledger.commit_entries(entries)
+            ledger.save_filter()
+        registry.mark_done(record.order_id)
+
+    message = None
+    if template is not None:
+        try:
+            message = render_order(template, parse_order_spec(record.spec, packs), record.codes)
+        except ValueError as e:
+            print(f'无法按模板排版订单{record.order_id}：{e}', file=sys.stderr)
+            return 1
+    if args.json:
+        result = {'order_id': record.order_id, 'spec': record.spec,
+                  'codes': record.codes, 'reused': reused}
+        if message is not None:
+            result['message'] = message
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        if reused:
+            print(f'订单{record.order_id}已出过码（{record.spec}），返回原激活码')
+        if message is not None:
+            print(message)
+        else:
+            for line_codes in record.codes:
+                print('\n'.join(line_codes))
+    return 0
+
+
+def cmd_orders(args) -> int:
+    """列出未发出的订单（预留着激活码），可取消指定订单或释放长时间未发出的订单"""
+    registry = OrderRegistry(args.storage)
+    for order_id in args.cancel:
+        if registry.cancel(order_id):
+            print(f'已取消订单{order_id}，预留的激活码已释放')
+        else:
+            print(f'订单{order_id}不存在或已发出，无法取消', file=sys.stderr)
+    if args.release_older_than is not None:
+        released = registry.release_stale(args.release_older_than * 3600)
+        print(f'已释放{len(released)}个超过{args.release_older_than:g}小时未发出的订单'
+              + (f'：{" ".join(released)}' if released else ''))
+    pending = [record for record in registry.orders.values() if not record.done]
+    if not pending:
+        print('没有未发出的订单')
+    for record in pending:
+        count = sum(len(line_codes) for line_codes in record.codes)
+        print(f'{record.order_id}\t{time.strftime("%Y-%m-%d %H:%M", time.localtime(record.ts))}'
+              f'\t{record.spec or "-"}\t预留{count}个激活码')
+    return 0
+
+
+def cmd_templates(args) -> int:
+    """列出模板库中的模板"""
+    library = TemplateLibrary(args.storage, args.settings)
+    active = library.active
+    for name in library.names():
+        loaded = library.load(name)
+        if loaded is None:
+            state = '（空）'
+        else:
+            state = f'{len(loaded.text)}字' + ('，使用草稿' if loaded.is_draft else '')
+        print(f'{"*" if name == active else " "} {name}  {state}')
+    return 0
+
+
+def cmd_drafts(args) -> int:
+    """列出模板的草稿历史，或恢复其中一个版本"""
+    library = TemplateLibrary(args.storage, args.settings)
+    name = args.template or library.active
+    if name not in library.names():
+        print(f'模板不存在：{name}', file=sys.stderr)
+        return 2
+    history = library.history(name)
+    if args.restore is not None:
+        try:
+            text = history.restore(args.restore)
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            return 1
+        library.save_draft(name, text)
+        print(text)
+        return 0
+    versions = history.versions()
+    if not versions:
+        print(f'模板"{name}"还没有草稿历史')
+    for version in versions:
+        saved_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version.saved_at))
+        print(f'{version.number:>6}  {saved_at}  {version.lines}行')
+    return 0
+
+
+def cmd_stats(args) -> int:
+    """显示发货效率统计"""
+    print(format_report(ShiftMetrics(args.storage), hours=args.hours))
+    return 0
+
+
+def cmd_bench_storage(args) -> int:
+    """在临时目录中对比各存储后端的延迟和占用空间（不读写数据目录）"""
+    backends = args.backends or list(STORAGE_BACKENDS)
+    unknown = [backend for backend in backends if backend not in STORAGE_BACKENDS]
+    if unknown:
+        print(f'未知的存储后端：{", ".join(unknown)}', file=sys.stderr)
+        return 2
+    print(format_benchmark(run_storage_benchmark(backends, args.commits, args.codes)))
+    return 0
+
+
+def cmd_bench_startup(args) -> int:
+    """测量App启动耗时（子进程中运行，需要Kivy）"""
+    try:
+        results = measure_startup(args.runs)
+        imports = slowest_imports(args.top) if args.top else []
+    except subprocess.CalledProcessError as e:
+        print(f'启动App失败（退出码{e.returncode}），请确认已安装Kivy', file=sys.stderr)
+        return 1
+    print(format_startup(results, imports))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='发货助手命令行工具')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help='数据目录（默认为程序目录下的data）')
+    parser.add_argument('--storage', dest='backend', default='file', choices=STORAGE_BACKENDS,
+                        help='账本、订单记录和配置的存储后端（默认file，与App一致）')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    gen = subparsers.add_parser('generate', help='批量生成激活码文件')
+    gen.add_argument('--tier', required=True, choices=TIERS, help='激活码天数')
+    gen.add_argument('--count', type=int, default=1000, help='生成数量（默认1000）')
+    gen.add_argument('--group-size', type=int, default=100, help='每组激活码数量（默认100）')
+    gen.add_argument('-o', '--output', help='输出文件（默认写入数据目录）')
+    gen.set_defaults(func=cmd_generate)
+
+    imp = subparsers.add_parser('import', help='批量导入激活码文件（多进程并行解析）')
+    imp.add_argument('--tier', required=True, choices=TIERS, help='激活码天数')
+    imp.add_argument('--workers', type=int, help='工作进程数（默认为CPU核数）')
+    imp.add_argument('files', nargs='+', help='激活码文件')
+    imp.set_defaults(func=cmd_import)
+
+    undo = subparsers.add_parser('undo', help='撤销最近的激活码消耗（放回激活码池）')
+    undo.add_argument('--count', type=int, default=1, help='撤销的提交次数（默认1）')
+    undo.set_defaults(func=cmd_undo)
+
+    checkpoint = subparsers.add_parser('checkpoint', help='把账本日志折叠进快照（之前的消耗不能再撤销）')
+    checkpoint.set_defaults(func=cmd_checkpoint)
+
+    sync_export = subparsers.add_parser('sync-export', help='导出上次导出之后的消耗记录（离线同步）')
+    sync_export.add_argument('-o', '--output', help='输出文件（默认写入数据目录下的sync）')
+    sync_export.add_argument('--full', action='store_true', help='导出全部记录而不只是新增的部分')
+    sync_export.set_defaults(func=cmd_sync_export)
+
+    sync_import = subparsers.add_parser('sync-import', help='导入其他设备的同步文件（有冲突时退出码为3）')
+    sync_import.add_argument('files', nargs='+', help='同步文件')
+    sync_import.set_defaults(func=cmd_sync_import)
+
+    sync_status = subparsers.add_parser('sync-status', help='各设备的消耗数量和被多台设备发出的激活码')
+    sync_status.set_defaults(func=cmd_sync_status)
+
+    issue = subparsers.add_parser('issue', help='按订单号出码（同一订单号重复调用返回原激活码）')
+    issue.add_argument('--order-id', required=True, help='订单号')
+    issue.add_argument('--spec', default='', help='订单内容，如 "365天"、"散装25个"、"365天+散装25个"')
+    issue.add_argument('--json', action='store_true', help='以JSON输出')
+    issue.add_argument('--template', nargs='?', const='', metavar='NAME',
+                       help='按模板输出完整消息（不指定名称时为App当前使用的模板）')
+    issue.set_defaults(func=cmd_issue)
+
+    orders = subparsers.add_parser('orders', help='未发出的订单：列出、取消或释放长时间未发出的订单')
+    orders.add_argument('--cancel', action='append', default=[], metavar='ORDER_ID',
+                        help='取消未发出的订单，释放预留的激活码（可重复指定）')
+    orders.add_argument('--release-older-than', type=float, metavar='HOURS',
+                        help='取消分配后超过指定小时数仍未发出的订单')
+    orders.set_defaults(func=cmd_orders)
+
+    templates = subparsers.add_parser('templates', help='列出消息模板（*为App当前使用的模板）')
+    templates.set_defaults(func=cmd_templates)
+
+    drafts = subparsers.add_parser('drafts', help='草稿历史：列出版本或恢复指定版本')
+    drafts.add_argument('--template', metavar='NAME', help='模板名称（默认为App当前使用的模板）')
+    drafts.add_argument('--restore', type=int, metavar='N', help='把第N版恢复为当前草稿并输出')
+    drafts.set_defaults(func=cmd_drafts)
+
+    stats = subparsers.add_parser('stats', help='发货效率统计（每小时订单数、每单耗时分布）')
+    stats.add_argument('--hours', type=int, default=24, help='显示最近多少小时的订单数（默认24）')
+    stats.set_defaults(func=cmd_stats)
+
+    bench = subparsers.add_parser('bench-storage', help='对比各存储后端的延迟和占用空间')
+    bench.add_argument('--commits', type=int, default=500, help='消耗提交次数（默认500）')
+    bench.add_argument('--codes', type=int, default=5, help='每次提交的激活码数量（默认5）')
+    bench.add_argument('backends', nargs='*', help='要测试的后端：file、sqlite、memory（默认全部）')
+    bench.set_defaults(func=cmd_bench_storage)
+
+    startup = subparsers.add_parser('bench-startup', help='测量App启动耗时（导入、初始化、构建界面）')
+    startup.add_argument('--runs', type=int, default=5, help='运行次数（默认5）')
+    startup.add_argument('--top', type=int, default=10, help='列出导入最慢的模块数（默认10，0为不列出）')
+    startup.set_defaults(func=cmd_bench_startup)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.storage = open_storage(args.backend, args.data_dir)
+    args.settings = Settings(args.storage)
+    try:
+        return args.func(args)
+    finally:
+        args.storage.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
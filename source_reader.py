@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+来源文件读取 - 文本文件和 .gz/.zip 压缩包统一按块流式读取，不解压到磁盘；
+根据开头的数据判断编码（UTF-8/UTF-16/GBK），边读边增量解码，不重复读取文件
+"""
+
+import codecs
+import gzip
+import zipfile
+from itertools import chain
+from typing import Iterator, Tuple
+
+# 支持的激活码来源文件类型
+ARCHIVE_SUFFIXES = ('.gz', '.zip')
+CODE_FILE_SUFFIXES = ('.txt',) + ARCHIVE_SUFFIXES
+# 文件选择器过滤规则
+CODE_FILE_FILTERS = ['*' + suffix for suffix in CODE_FILE_SUFFIXES]
+
+CHUNK_SIZE = 1 << 20
+
+# 不是UTF-8时按GB18030解码（GBK的超集，Windows中文工具导出的文件）
+FALLBACK_ENCODING = 'gb18030'
+# ASCII兼容的编码，激活码可以直接按字节提取
+ASCII_COMPATIBLE = ('utf-8', FALLBACK_ENCODING)
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+
+
+def is_archive(path: str) -> bool:
+    """是否为压缩包（按扩展名判断）"""
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_code_file(path: str) -> bool:
+    """是否为支持的激活码来源文件"""
+    return path.lower().endswith(CODE_FILE_SUFFIXES)
+
+
+def sniff_encoding(head: bytes) -> Tuple[str, int]:
+    """根据开头的数据判断编码，返回(编码, BOM长度)
+
+    优先看BOM；没有BOM时按零字节分布识别UTF-16，能按UTF-8解码的视为UTF-8
+    （纯ASCII也先按UTF-8处理），否则视为GBK。
+    """
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    sample = head[:4096]
+    if len(sample) >= 4:
+        half = len(sample) // 2
+        odd_zeros = sample[1::2].count(0)
+        even_zeros = sample[0::2].count(0)
+        if odd_zeros > half * 0.4 and even_zeros < half * 0.05:
+            return 'utf-16-le', 0
+        if even_zeros > half * 0.4 and odd_zeros < half * 0.05:
+            return 'utf-16-be', 0
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8', 0
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING, 0
+
+
+def _zip_members(zf: zipfile.ZipFile):
+    """压缩包内的文件（跳过目录和macOS生成的附带文件）"""
+    for info in zf.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith('__MACOSX/') or name.rsplit('/', 1)[-1].startswith('.'):
+            continue
+        yield info
+
+
+def iter_source_members(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Iterator[bytes]]:
+    """按文件依次给出内容的分块迭代器（.zip 中每个文件一个，其他文件只有一个）
+
+    压缩包边读边解压；每个分块迭代器需在取下一个之前读完。
+    """
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for info in _zip_members(zf):
+                with zf.open(info) as f:
+                    yield iter(lambda: f.read(chunk_size), b'')
+        return
+    opener = gzip.open if lower.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        yield iter(lambda: f.read(chunk_size), b'')
+
+
+def open_member(chunks: Iterator[bytes]) -> Tuple[str, Iterator[bytes]]:
+    """读取第一块判断编码，返回(编码, 去掉BOM后的完整分块迭代器)"""
+    first = next(chunks, b'')
+    encoding, bom = sniff_encoding(first)
+    return encoding, chain([first[bom:]], chunks)
+
+
+def iter_source_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """按块读取来源文件的原始字节（多个文件之间插入换行，避免首尾两行相连）"""
+    for i, chunks in enumerate(iter_source_members(path, chunk_size)):
+        if i:
+            yield b'\n'
+        yield from chunks
+
+
+def decode_chunks(encoding: str, chunks: Iterator[bytes]) -> Iterator[str]:
+    """增量解码分块字节
+
+    按UTF-8解码时，如果此前都是ASCII、之后才遇到非UTF-8字节，说明开头的数据
+    不足以判断编码：从当前块起改用GBK继续解码（解码器中缓存的字节一并带上），
+    不需要重新读取文件；其他解码错误用替换字符代替。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='strict' if encoding == 'utf-8' else 'replace')
+    ascii_only = encoding == 'utf-8'
+    for chunk in chunks:
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError:
+            pending = decoder.getstate()[0]
+            fallback = FALLBACK_ENCODING if ascii_only else 'utf-8'
+            decoder = codecs.getincrementaldecoder(fallback)(errors='replace')
+            text = decoder.decode(pending + chunk)
+            ascii_only = False
+        if ascii_only and not text.isascii():
+            ascii_only = False
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_source_text(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """按块读取并解码来源文件（每个文件各自判断编码），多个文件之间插入换行"""
+    for i, chunks in enumerate(iter_source_members(path, chunk_size)):
+        if i:
+            yield '\n'
+        yield from decode_chunks(*open_member(chunks))
+
+
+def iter_source_lines(path: str) -> Iterator[str]:
+    """逐行读取来源文件（去掉行尾换行符）"""
+    carry = ''
+    for text in iter_source_text(path):
+        lines = (carry + text).split('\n')
+        carry = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if carry:
+        yield carry.rstrip('\r')
+
+
+def read_source_text(path: str) -> str:
+    """读取整个来源文件的文本（模板等小文件）"""
+    return ''.join(iter_source_text(path))
+
+
+def decode_bytes(data: bytes) -> str:
+    """按与来源文件相同的规则判断编码并解码内存中的数据（存储后端中的模板等）"""
+    return ''.join(decode_chunks(*open_member(iter([data]))))
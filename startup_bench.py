@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时测试 - 在子进程中导入App模块、创建App并构建界面（不进入事件循环），
+多次运行取中位数，并列出导入最慢的模块（需要桌面端Kivy环境）
+"""
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+from typing import Dict, List, Tuple
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 子进程中运行的测量脚本
+_PROBE = '''
+import json, time
+t0 = time.perf_counter()
+import main_chinese
+t1 = time.perf_counter()
+app = main_chinese.ShippingApp()
+t2 = time.perf_counter()
+app.build()
+t3 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "init": t2 - t1, "build": t3 - t2}))
+'''
+
+STAGES = ('import', 'init', 'build')
+STAGE_LABELS = {'import': '导入模块', 'init': '创建App', 'build': '构建界面'}
+
+
+def _probe_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({'KIVY_NO_ARGS': '1', 'KIVY_NO_CONSOLELOG': '1'})
+    return env
+
+
+def measure_startup(runs: int = 5) -> List[Dict[str, float]]:
+    """运行若干次，返回每次各阶段的耗时（秒）"""
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _PROBE], cwd=APP_DIR, env=_probe_env(),
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def slowest_imports(limit: int = 10) -> List[Tuple[str, int]]:
+    """用 -X importtime 找出累计导入耗时最长的模块，返回[(模块, 微秒)]"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main_chinese'],
+                            cwd=APP_DIR, env=_probe_env(), check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True).stderr
+    timings = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _self_us, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            timings.append((name.strip(), int(cumulative)))
+    timings.sort(key=lambda item: item[1], reverse=True)
+    return timings[:limit]
+
+
+def format_startup(results: List[Dict[str, float]], imports: List[Tuple[str, int]]) -> str:
+    """生成启动耗时报告文本"""
+    lines = [f'启动耗时（{len(results)}次的中位数）：']
+    total = 0.0
+    for stage in STAGES:
+        median = statistics.median(result[stage] for result in results)
+        total += median
+        lines.append(f'  {STAGE_LABELS[stage]:<8} {median * 1000:>8.1f} 毫秒')
+    lines.append(f'  {"合计":<8} {total * 1000:>8.1f} 毫秒')
+    if imports:
+        lines.append('')
+        lines.append('导入最慢的模块（累计）：')
+        for name, micros in imports:
+            lines.append(f'  {micros / 1000:>8.1f} 毫秒  {name}')
+    return '\n'.join(lines)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据存储后端 - 账本等只追加日志和配置、草稿等小文档的统一读写接口
+
+- FileStorage：数据目录下的普通文件（原有布局，默认）
+- SQLiteStorage：单个SQLite数据库文件
+- MemoryStorage：纯内存，用于测试和性能对比
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional, Union
+
+STORAGE_BACKENDS = ('file', 'sqlite', 'memory')
+
+
+class Storage:
+    """存储接口
+
+    日志（journal）：按名称区分的只追加字节流，支持按偏移读取和截断，append 返回前已落盘。
+    文档（document）：按名称整体读写的小块数据，put 是原子的；version 在内容变化后改变，
+    用于判断缓存是否有效（不存在时为None）。
+    delete 删除同名的日志和文档（不存在时忽略）。
+    """
+
+    def append(self, name: str, data: bytes):
+        raise NotImplementedError
+
+    def read(self, name: str, start: int, size: int) -> bytes:
+        raise NotImplementedError
+
+    def size(self, name: str) -> int:
+        raise NotImplementedError
+
+    def truncate(self, name: str, size: int):
+        raise NotImplementedError
+
+    def get(self, name: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, name: str, data: bytes):
+        raise NotImplementedError
+
+    def version(self, name: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def delete(self, name: str):
+        raise NotImplementedError
+
+    def footprint(self) -> int:
+        """占用的存储空间（字节）"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileStorage(Storage):
+    """数据目录下的普通文件：日志和文档都是 base_dir/名称"""
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.base_dir, name)
+
+    def append(self, name: str, data: bytes):
+        with open(self.path(name), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, name: str, start: int, size: int) -> bytes:
+        try:
+            with open(self.path(name), 'rb') as f:
+                f.seek(start)
+                return f.read(size)
+        except OSError:
+            return b''
+
+    def size(self, name: str) -> int:
+        try:
+            return os.path.getsize(self.path(name))
+        except OSError:
+            return 0
+
+    def truncate(self, name: str, size: int):
+        with open(self.path(name), 'r+b') as f:
+            f.truncate(size)
+
+    def get(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.path(name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, name: str, data: bytes):
+        """先把临时文件落盘再替换，并同步目录，返回后内容在断电后也不会丢失或写坏
+        （账本折叠依赖这一点：快照落盘后才清空日志）"""
+        path = self.path(name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        """同步目录项，让替换本身落盘（Windows不支持打开目录，跳过）"""
+        if os.name != 'posix':
+            return
+        fd = os.open(self.base_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def version(self, name: str) -> Optional[int]:
+        try:
+            return os.stat(self.path(name)).st_mtime_ns
+        except OSError:
+            return None
+
+    def delete(self, name: str):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def footprint(self) -> int:
+        total = 0
+        for entry in os.scandir(self.base_dir):
+            if entry.is_file():
+                total += entry.stat().st_size
+        return total
+
+
+class SQLiteStorage(Storage):
+    """单个SQLite数据库：日志按追加块保存（以起始偏移为主键），文档一行一个
+
+    Android 打包时需要在 requirements 中加入 sqlite3。
+    """
+
+    def __init__(self, db_path: str):
+        import sqlite3
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal '
+                        '(name TEXT, offset INTEGER, data BLOB, PRIMARY KEY (name, offset))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS document '
+                        '(name TEXT PRIMARY KEY, data BLOB, version INTEGER)')
+        self._sizes = {}
+        # 连接在界面线程和后台线程间共用：事务和 _sizes 的读改写都要串行
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _transaction(self):
+        """多条语句的显式事务
+
+        连接为自动提交模式（isolation_level=None），单条语句本身即原子，但 with self.db 不会开始事务。
+        """
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def append(self, name: str, data: bytes):
+        if not data:
+            return
+        with self._lock:
+            offset = self.size(name)
+            self.db.execute('INSERT INTO journal VALUES (?, ?, ?)', (name, offset, data))
+            self._sizes[name] = offset + len(data)
+
+    def read(self, name: str, start: int, size: int) -> bytes:
+        end = start + size
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT offset, data FROM journal WHERE name = ? AND offset < ? '
+                'AND offset + length(data) > ? ORDER BY offset', (name, end, start)).fetchall()
+        parts = []
+        for offset, data in rows:
+            parts.append(data[max(0, start - offset):end - offset])
+        return b''.join(parts)
+
+    def size(self, name: str) -> int:
+        with self._lock:
+            size = self._sizes.get(name)
+            if size is None:
+                row = self.db.execute('SELECT offset + length(data) FROM journal WHERE name = ? '
+                                      'ORDER BY offset DESC LIMIT 1', (name,)).fetchone()
+                size = row[0] if row else 0
+                self._sizes[name] = size
+            return size
+
+    def truncate(self, name: str, size: int):
+        with self._lock:
+            with self._transaction():
+                row = self.db.execute('SELECT offset, data FROM journal WHERE name = ? AND offset < ? '
+                                      'AND offset + length(data) > ?', (name, size, size)).fetchone()
+                self.db.execute('DELETE FROM journal WHERE name = ? AND offset >= ?', (name, size))
+                if row:
+                    offset, data = row
+                    self.db.execute('UPDATE journal SET data = ? WHERE name = ? AND offset = ?',
+                                    (data[:size - offset], name, offset))
+            self._sizes.pop(name, None)
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            row = self.db.execute('SELECT data FROM document WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, name: str, data: bytes):
+        with self._lock:
+            self.db.execute('INSERT INTO document VALUES (?, ?, 1) ON CONFLICT(name) '
+                            'DO UPDATE SET data = excluded.data, version = version + 1',
+                            (name, data))
+
+    def version(self, name: str) -> Optional[int]:
+        with self._lock:
+            row = self.db.execute('SELECT version FROM document WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, name: str):
+        with self._lock:
+            with self._transaction():
+                self.db.execute('DELETE FROM journal WHERE name = ?', (name,))
+                self.db.execute('DELETE FROM document WHERE name = ?', (name,))
+            self._sizes.pop(name, None)
+
+    def footprint(self) -> int:
+        total = 0
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                total += os.path.getsize(self.db_path + suffix)
+            except OSError:
+                pass
+        return total
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class MemoryStorage(Storage):
+    """纯内存存储（进程退出即丢失），用于测试和性能对比"""
+
+    def __init__(self):
+        self.journals = {}   # 名称 -> bytearray
+        self.documents = {}  # 名称 -> (数据, 版本)
+
+    def append(self, name: str, data: bytes):
+        self.journals.setdefault(name, bytearray()).extend(data)
+
+    def read(self, name: str, start: int, size: int) -> bytes:
+        return bytes(self.journals.get(name, b'')[start:start + size])
+
+    def size(self, name: str) -> int:
+        return len(self.journals.get(name, b''))
+
+    def truncate(self, name: str, size: int):
+        if name in self.journals:
+            del self.journals[name][size:]
+
+    def get(self, name: str) -> Optional[bytes]:
+        entry = self.documents.get(name)
+        return entry[0] if entry else None
+
+    def put(self, name: str, data: bytes):
+        entry = self.documents.get(name)
+        self.documents[name] = (bytes(data), entry[1] + 1 if entry else 1)
+
+    def version(self, name: str) -> Optional[int]:
+        entry = self.documents.get(name)
+        return entry[1] if entry else None
+
+    def delete(self, name: str):
+        self.journals.pop(name, None)
+        self.documents.pop(name, None)
+
+    def footprint(self) -> int:
+        return (sum(len(data) for data in self.journals.values()) +
+                sum(len(data) for data, _version in self.documents.values()))
+
+
+def open_storage(kind: str, base_dir: str) -> Storage:
+    """按名称创建存储后端：file（默认）、sqlite、memory"""
+    if kind == 'file':
+        return FileStorage(base_dir)
+    if kind == 'sqlite':
+        os.makedirs(base_dir, exist_ok=True)
+        return SQLiteStorage(os.path.join(base_dir, 'shipping.db'))
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'未知的存储后端：{kind}')
+
+
+def as_storage(storage: Union[Storage, str]) -> Storage:
+    """传入数据目录路径时使用文件存储（兼容原来按目录创建的用法）"""
+    if isinstance(storage, Storage):
+        return storage
+    return FileStorage(storage)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储后端性能对比 - 在临时目录中用相同的负载测试各后端的延迟和占用空间
+"""
+
+import time
+import random
+import tempfile
+from typing import Callable, Dict, List, NamedTuple
+
+from code_ledger import TIERS, ConsumptionLedger
+from order_registry import OrderRegistry
+from storage import STORAGE_BACKENDS, open_storage
+
+
+class BenchResult(NamedTuple):
+    """单个后端的测试结果（耗时为毫秒）"""
+    backend: str
+    commit_ms: float        # 每次消耗提交
+    undo_ms: float          # 每次撤销
+    lookup_ms: float        # 每批 find_consumed（含精确确认）
+    scan_ms: float          # 完整遍历一次已消耗激活码
+    reopen_ms: float        # 重新打开账本（加载过滤器）
+    order_ms: float         # 每次订单记录追加
+    document_ms: float      # 每次文档读写（草稿）
+    footprint: int          # 占用空间（字节）
+
+
+def _timed(func: Callable[[], object], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+def bench_backend(backend: str, commits: int = 500, codes_per_commit: int = 5,
+                  seed: int = 1) -> BenchResult:
+    """用固定随机种子生成的负载测试一个后端"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as base_dir:
+        storage = open_storage(backend, base_dir)
+        try:
+            ledger = ConsumptionLedger(storage)
+            batches = [[rng.getrandbits(52) for _ in range(codes_per_commit)] for _ in range(commits)]
+            tiers = iter(rng.choice(TIERS) for _ in range(commits))
+            batch_iter = iter(batches)
+            commit_ms = _timed(lambda: ledger.commit(next(tiers), next(batch_iter)), commits)
+            undo_count = max(1, commits // 50)
+            undo_ms = _timed(ledger.undo_last, undo_count)
+            ledger.save_filter()
+
+            # 一半已消耗、一半未消耗的查询批次
+            consumed = [code for batch in batches for code in batch]
+            probes = rng.sample(consumed, min(100, len(consumed))) + \
+                [rng.getrandbits(52) for _ in range(100)]
+            lookup_ms = _timed(lambda: ledger.find_consumed(probes), 20)
+            scan_ms = _timed(lambda: sum(1 for _ in ledger.iter_consumed()), 5)
+            reopen_ms = _timed(lambda: ConsumptionLedger(storage), 5)
+
+            registry = OrderRegistry(storage)
+            order_ids = iter(range(commits))
+            order_ms = _timed(lambda: registry.add(f'T{next(order_ids)}', '365天', [['0123456789']]), commits)
+
+            draft = ('会员您好，您购买的商品现为您发货：\n' * 50).encode('utf-8')
+            document_ms = _timed(lambda: (storage.put('draft.txt', draft), storage.get('draft.txt')), 200)
+
+            footprint = storage.footprint()
+        finally:
+            storage.close()
+    return BenchResult(backend, commit_ms, undo_ms, lookup_ms, scan_ms, reopen_ms,
+                       order_ms, document_ms, footprint)
+
+
+def run_storage_benchmark(backends: List[str] = STORAGE_BACKENDS, commits: int = 500,
+                          codes_per_commit: int = 5) -> Dict[str, BenchResult]:
+    return {backend: bench_backend(backend, commits, codes_per_commit) for backend in backends}
+
+
+def format_benchmark(results: Dict[str, BenchResult]) -> str:
+    """生成对比表格文本"""
+    columns = (('提交', 'commit_ms'), ('撤销', 'undo_ms'), ('查重', 'lookup_ms'),
+               ('遍历', 'scan_ms'), ('重新打开', 'reopen_ms'), ('订单记录', 'order_ms'),
+               ('文档读写', 'document_ms'))
+    lines = ['后端     ' + ''.join(f'{label:>10}' for label, _field in columns) + f'{"占用KB":>10}']
+    for result in results.values():
+        row = ''.join(f'{getattr(result, field):>10.3f}' for _label, field in columns)
+        lines.append(f'{result.backend:<8} {row}{result.footprint / 1024:>10.1f}')
+    lines.append('（耗时单位：毫秒/次）')
+    return '\n'.join(lines)
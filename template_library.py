@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息模板库 - 多个命名模板（不同商品）保存在存储中，可随时切换
+
+每个模板是一个文档，编辑中的草稿保存在模板的草稿历史中（草稿优先）；模板名称列表和当前模板保存在设置中。
+读取并预处理后的结果按 (文档, 版本) 缓存，内容没有变化时切换模板或按订单指定模板都不需要重新读取。
+"""
+
+import re
+import threading
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from draft_history import DraftHistory
+from message_builder import CompiledTemplate, compile_template
+from settings import ACTIVE_TEMPLATE, DEFAULT_TEMPLATE_NAME, TEMPLATES, Settings
+from source_reader import decode_bytes
+from storage import Storage
+
+# 默认模板沿用原来的文档名称，升级后原有的模板和草稿仍然有效
+_DEFAULT_DOCUMENTS = ('sendGoodsMode.txt', 'draft.txt')
+
+# 模板名称用于文档名称，不能包含路径分隔符等文件名中不允许的字符
+_INVALID_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+class LoadedTemplate(NamedTuple):
+    """读取的模板：名称、文本、预处理结果，以及内容是否来自草稿"""
+    name: str
+    text: str
+    compiled: CompiledTemplate
+    is_draft: bool
+
+
+def check_template_name(name: str) -> str:
+    """检查模板名称，返回去掉首尾空白后的名称；无效时抛出 ValueError"""
+    name = name.strip()
+    if not name or name in ('.', '..') or _INVALID_NAME_RE.search(name):
+        raise ValueError(f'无效的模板名称：{name!r}')
+    return name
+
+
+def template_document(name: str) -> str:
+    """模板在存储中的文档名称"""
+    return _DEFAULT_DOCUMENTS[0] if name == DEFAULT_TEMPLATE_NAME else f'template-{name}.txt'
+
+
+def draft_document(name: str) -> str:
+    """模板草稿在存储中的文档名称（改用草稿历史之前保存草稿的位置）"""
+    return _DEFAULT_DOCUMENTS[1] if name == DEFAULT_TEMPLATE_NAME else f'draft-{name}.txt'
+
+
+class TemplateLibrary:
+    """命名模板库，可在多个线程中使用"""
+
+    def __init__(self, storage: Storage, settings: Settings):
+        self.storage = storage
+        self.settings = settings
+        self._cache = {}  # 文档或草稿历史 -> (版本, 文本, 预处理结果)
+        self._histories = {}  # 模板名称 -> 草稿历史
+        self._lock = threading.Lock()
+
+    def names(self) -> List[str]:
+        """所有模板名称（按添加顺序）"""
+        return self.settings.get(TEMPLATES)
+
+    @property
+    def active(self) -> str:
+        """当前模板名称（设置中的模板已不存在时为默认模板）"""
+        name = self.settings.get(ACTIVE_TEMPLATE)
+        return name if name in self.names() else DEFAULT_TEMPLATE_NAME
+
+    def activate(self, name: str):
+        """切换当前模板"""
+        if name not in self.names():
+            raise KeyError(f'模板不存在：{name}')
+        self.settings.set(ACTIVE_TEMPLATE, name)
+
+    def history(self, name: str) -> DraftHistory:
+        """模板的草稿历史；首次使用时导入原来的草稿文档"""
+        with self._lock:
+            history = self._histories.get(name)
+            if history is None:
+                history = DraftHistory(self.storage, draft_document(name)[:-len('.txt')])
+                if history.head_number() is None:
+                    data = self.storage.get(draft_document(name))
+                    if data and data.strip():
+                        history.record(decode_bytes(data))
+                self._histories[name] = history
+            return history
+
+    def _compile_cached(self, key: str, version: int,
+                        read: Callable[[], Optional[str]]) -> Optional[Tuple[str, CompiledTemplate]]:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+        text = read()
+        if text is None:
+            return None
+        text = text.strip()
+        compiled = compile_template(text)
+        with self._lock:
+            self._cache[key] = (version, text, compiled)
+        return text, compiled
+
+    def _read_document(self, document: str) -> Optional[str]:
+        data = self.storage.get(document)
+        # 模板可能是用户直接放入的GBK等编码文件
+        return None if data is None else decode_bytes(data)
+
+    def _load_document(self, document: str) -> Optional[Tuple[str, CompiledTemplate]]:
+        version = self.storage.version(document)
+        if version is None:
+            return None
+        return self._compile_cached(document, version, lambda: self._read_document(document))
+
+    def _load_draft(self, name: str) -> Optional[Tuple[str, CompiledTemplate]]:
+        history = self.history(name)
+        version = history.head_number()
+        if version is None:
+            return None
+        return self._compile_cached(history.index_name, version, history.latest)
+
+    def load(self, name: Optional[str] = None, use_draft: bool = True) -> Optional[LoadedTemplate]:
+        """读取模板（默认为当前模板，草稿优先）；模板和草稿都不存在或为空时返回None"""
+        name = name or self.active
+        if use_draft:
+            loaded = self._load_draft(name)
+            if loaded and loaded[0]:
+                return LoadedTemplate(name, loaded[0], loaded[1], True)
+        loaded = self._load_document(template_document(name))
+        if loaded and loaded[0]:
+            return LoadedTemplate(name, loaded[0], loaded[1], False)
+        return None
+
+    def save(self, name: str, text: str) -> str:
+        """保存模板（新名称加入模板库）并清空它的草稿，返回规范化后的名称"""
+        name = check_template_name(name)
+        self.storage.put(template_document(name), text.encode('utf-8'))
+        # 草稿清空也记入历史，之前的草稿仍可恢复
+        history = self.history(name)
+        if history.latest():
+            history.record('')
+        with self.settings.transaction():
+            names = self.names()
+            if name not in names:
+                self.settings.set(TEMPLATES, names + [name])
+        return name
+
+    def save_draft(self, name: str, text: str) -> Optional[int]:
+        """保存模板的草稿（追加到草稿历史），返回版本号；内容没有变化时返回None"""
+        return self.history(name).record(text)
+
+    def warm(self):
+        """读取并预处理所有模板（后台预热）"""
+        for name in self.names():
+            self.load(name)
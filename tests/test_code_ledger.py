@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""消耗账本：提交、撤销、折叠快照、重新打开后重放"""
+
+import pytest
+
+from code_ledger import JOURNAL_NAME, ConsumptionLedger
+from storage import STORAGE_BACKENDS, open_storage
+
+
+@pytest.fixture(params=STORAGE_BACKENDS)
+def storage(request, tmp_path):
+    storage = open_storage(request.param, str(tmp_path))
+    yield storage
+    storage.close()
+
+
+def test_commit_and_undo(storage):
+    ledger = ConsumptionLedger(storage)
+    ledger.commit('365', [11, 12])
+    ledger.commit_entries([('30', 21), ('90', 31)])
+    assert ledger.find_consumed([11, 12, 21, 31, 99]) == {11, 12, 21, 31}
+
+    assert ledger.undo_last() == [('30', 21), ('90', 31)]
+    assert ledger.find_consumed([11, 21, 31]) == {11}
+    assert sorted(ledger.iter_consumed()) == [11, 12]
+    assert list(ledger.iter_consumed('30')) == []
+    assert ledger.undo_last() == [('365', 11), ('365', 12)]
+    assert ledger.undo_last() == []
+
+
+def test_replay_after_reopen(storage):
+    ledger = ConsumptionLedger(storage)
+    ledger.commit('365', [1, 2])
+    ledger.commit('30', [3])
+    ledger.undo_last()
+    ledger.commit('90', [4])
+    ledger.save_filter()
+    ledger.commit('90', [5])  # 过滤器之后新增的日志在打开时补上
+
+    reopened = ConsumptionLedger(storage)
+    assert reopened.find_consumed(range(10)) == {1, 2, 4, 5}
+    assert reopened.undo_last() == [('90', 5)]
+    assert reopened.undo_last() == [('90', 4)]
+    assert reopened.undo_last() == [('365', 1), ('365', 2)]
+
+
+def test_checkpoint_folds_journal(storage):
+    ledger = ConsumptionLedger(storage)
+    ledger.commit('365', [7, 3])
+    ledger.commit('30', [5])
+    ledger.undo_last()
+    assert ledger.checkpoint()
+    assert not ledger.checkpoint()
+    assert ledger.journal_records == 0
+    assert list(ledger.snapshot_values()) == [3, 7]
+    assert ledger.is_checkpointed(3) and not ledger.is_checkpointed(5)
+    # 折叠前的提交不能再撤销
+    assert ledger.undo_last() == []
+
+    ledger.commit('30', [9])
+    reopened = ConsumptionLedger(storage)
+    assert reopened.find_consumed(range(10)) == {3, 7, 9}
+    assert reopened.consumed_entries() == [(3, 3), (7, 3), (9, 1)]
+    assert reopened.undo_last() == [('30', 9)]
+
+
+def test_torn_record_is_truncated(storage):
+    ledger = ConsumptionLedger(storage)
+    ledger.commit('365', [1])
+    storage.append(JOURNAL_NAME, b'\x01\x03')  # 崩溃时写了一半的记录
+    reopened = ConsumptionLedger(storage)
+    assert reopened.journal_records == 1
+    reopened.commit('365', [2])
+    assert ConsumptionLedger(storage).find_consumed([1, 2]) == {1, 2}
+
+
+def test_corrupt_snapshot_is_an_error(storage):
+    ledger = ConsumptionLedger(storage)
+    ledger.commit('365', [1])
+    ledger.checkpoint()
+    storage.put('ledger.snap', b'broken')
+    with pytest.raises(ValueError):
+        ConsumptionLedger(storage)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""激活码池与激活码文件压缩"""
+
+import os
+
+from code_generator import random_code_values, write_code_file
+from code_ledger import ConsumptionLedger
+from code_pool import TierPool, compact_code_file, decode_code, expand_sources, load_code_pool
+from storage import MemoryStorage
+
+
+def _make_pool_file(tmp_path, count=20):
+    path = str(tmp_path / 'code365day.txt')
+    values = sorted(set(random_code_values(count)))
+    write_code_file(path, '365', values, group_size=5)
+    return path, values
+
+
+def test_compact_without_checkpoint_keeps_consumed_codes_unavailable(tmp_path):
+    path, values = _make_pool_file(tmp_path)
+    index_dir = str(tmp_path / 'index')
+    ledger = ConsumptionLedger(MemoryStorage())
+    ledger.commit('365', values[:3])
+    ledger.checkpoint()
+    ledger.commit('365', values[3:6])  # 仍可撤销
+
+    assert compact_code_file(path, ledger.is_checkpointed) == len(values) - 3
+    pool = load_code_pool(path, index_dir)
+    pool.mark_ledger_consumed(ledger)
+
+    assert len(pool) == len(values) - 3
+    assert pool.available == len(values) - 6
+    taken = set(pool.head(len(values)))
+    assert not taken & {decode_code(v) for v in values[:6]}
+
+    # 还能撤销的激活码仍在文件中，撤销后可以放回
+    undone = [code for _tier, code in ledger.undo_last()]
+    assert pool.unmark_consumed(undone) == 3
+    assert pool.available == len(values) - 3
+
+
+def test_compacted_keeps_marks_of_undoable_codes(tmp_path):
+    path, values = _make_pool_file(tmp_path)
+    ledger = ConsumptionLedger(MemoryStorage())
+    ledger.commit('365', values[:2])
+    ledger.checkpoint()
+    ledger.commit('365', values[2:4])
+    pool = load_code_pool(path)
+    pool.mark_ledger_consumed(ledger)
+
+    compacted = pool.compacted(ledger.is_checkpointed)
+    assert len(compacted) == len(values) - 2
+    assert compacted.consumed_count == 2
+    assert compacted.available == len(values) - 4
+
+
+def test_compact_aborts_when_file_is_appended(tmp_path):
+    path, values = _make_pool_file(tmp_path)
+    extra = random_code_values(1)[0]
+
+    def is_consumed(value):
+        # 压缩读取期间有新激活码写入
+        if value == values[0]:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(decode_code(extra) + '\n')
+        return value == values[0]
+
+    assert compact_code_file(path, is_consumed) is None
+    pool = load_code_pool(path)
+    assert extra in pool and values[0] in pool
+
+
+def test_refresh_skips_partial_last_line(tmp_path):
+    path, values = _make_pool_file(tmp_path, 5)
+    pool = load_code_pool(path)
+    new = random_code_values(2)
+    code = decode_code(new[0])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(code[:6])
+    assert pool.refresh() == []
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(code[6:] + '\n' + decode_code(new[1]))
+    assert pool.refresh() == [new[0]]
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('\n')
+    assert pool.refresh() == [new[1]]
+
+
+def test_tier_pool_membership_includes_exhausted_sources(tmp_path):
+    path, values = _make_pool_file(tmp_path, 3)
+    pool = load_code_pool(path)
+    pool.mark_consumed(values)
+    pools = {path: pool}
+    tier_pool = TierPool([str(tmp_path / 'missing.txt'), path],
+                         lambda source: pools.get(source) or load_code_pool(source))
+    assert decode_code(values[0]) in tier_pool
+    assert tier_pool.take(5) == []
+
+
+def test_directory_sources_include_archives(tmp_path):
+    for name in ('b.zip', 'a.txt', 'c.txt.gz', 'notes.md'):
+        (tmp_path / name).write_bytes(b'')
+    sources = expand_sources(str(tmp_path))
+    assert [os.path.basename(source) for source in sources] == ['a.txt', 'b.zip', 'c.txt.gz']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""草稿历史：按行差异保存、恢复、中断恢复、按大小清理"""
+
+from draft_history import DraftHistory, line_delta
+from storage import MemoryStorage
+
+
+def test_line_delta():
+    assert line_delta(['a', 'b', 'c'], ['a', 'x', 'c']) == (1, 1, ['x'])
+    assert line_delta(['a'], ['a', 'b']) == (1, 0, ['b'])
+    assert line_delta([], ['a']) == (0, 0, ['a'])
+
+
+def test_record_and_restore_across_segments():
+    storage = MemoryStorage()
+    history = DraftHistory(storage, 'draft', interval=3)
+    texts = [f'标题\n第{i}行\n结尾' for i in range(8)]
+    numbers = [history.record(text) for text in texts]
+    assert numbers == list(range(1, 9))
+    assert history.record(texts[-1]) is None
+
+    reopened = DraftHistory(storage, 'draft', interval=3)
+    assert reopened.latest() == texts[-1]
+    assert [version.number for version in reopened.versions()] == numbers
+    for number, text in zip(numbers, texts):
+        assert reopened.restore(number) == text
+
+
+def test_torn_write_is_dropped():
+    storage = MemoryStorage()
+    history = DraftHistory(storage, 'draft')
+    history.record('一\n二')
+    history.record('一\n三')
+    storage.append('draft-history-1.bin', b'\x01\x00\x00')
+    reopened = DraftHistory(storage, 'draft')
+    assert reopened.latest() == '一\n三'
+    assert reopened.record('一\n四') == 3
+    assert DraftHistory(storage, 'draft').restore(3) == '一\n四'
+
+
+def test_prune_keeps_current_segment():
+    storage = MemoryStorage()
+    history = DraftHistory(storage, 'draft', max_bytes=200, interval=2)
+    for i in range(20):
+        history.record(f'第{i}版\n' + 'x' * 40)
+    versions = history.versions()
+    assert versions[-1].number == 20
+    assert len(versions) < 20
+    assert history.restore(20) == '第19版\n' + 'x' * 40
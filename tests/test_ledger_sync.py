@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""账本离线同步：导出、导入去重、冲突检测"""
+
+import pytest
+
+from code_ledger import ConsumptionLedger
+from ledger_sync import LedgerSync
+from storage import MemoryStorage
+
+
+class Device:
+    def __init__(self, name):
+        self.storage = MemoryStorage()
+        self.ledger = ConsumptionLedger(self.storage)
+        self.sync = LedgerSync(self.storage, self.ledger, name)
+
+
+@pytest.fixture
+def devices():
+    return Device('phone'), Device('pc')
+
+
+def test_import_records_remote_consumption(tmp_path, devices):
+    phone, pc = devices
+    phone.ledger.commit('365', [10, 11])
+    path = str(tmp_path / 'phone.sync')
+    assert phone.sync.export_delta(path) == 2
+
+    result = pc.sync.import_delta(path)
+    assert (result.device, result.received, result.consumed) == ('phone', 2, 2)
+    assert result.conflicts == []
+    assert pc.ledger.find_consumed([10, 11, 12]) == {10, 11}
+    # 其他设备的消耗不能在本机撤销
+    assert pc.ledger.undo_last() == []
+
+
+def test_import_is_idempotent_and_order_independent(tmp_path, devices):
+    phone, pc = devices
+    phone.ledger.commit('365', [1, 2])
+    first = str(tmp_path / 'first.sync')
+    phone.sync.export_delta(first)
+    phone.ledger.commit('30', [3])
+    second = str(tmp_path / 'second.sync')
+    assert phone.sync.export_delta(second) == 1
+
+    assert pc.sync.import_delta(second).consumed == 1
+    assert pc.sync.import_delta(first).consumed == 2
+    again = pc.sync.import_delta(first)
+    assert (again.received, again.consumed) == (0, 0)
+    assert pc.ledger.consumed_entries() == [(1, 3), (2, 3), (3, 1)]
+    assert pc.sync.device_counts() == {'phone': 3}
+
+
+def test_relayed_entries_reach_third_device(tmp_path, devices):
+    phone, pc = devices
+    tablet = Device('tablet')
+    phone.ledger.commit('90', [5])
+    path = str(tmp_path / 'phone.sync')
+    phone.sync.export_delta(path)
+    pc.sync.import_delta(path)
+    relay = str(tmp_path / 'pc.sync')
+    assert pc.sync.export_delta(relay) == 1
+    assert tablet.sync.import_delta(relay).consumed == 1
+    assert tablet.ledger.find_consumed([5]) == {5}
+
+
+def test_conflicts_are_reported(tmp_path, devices):
+    phone, pc = devices
+    phone.ledger.commit('365', [7, 8])
+    pc.ledger.commit('365', [8, 9])
+    path = str(tmp_path / 'phone.sync')
+    phone.sync.export_delta(path)
+
+    result = pc.sync.import_delta(path)
+    assert result.consumed == 1
+    assert [(c.code, c.tier, sorted(c.devices)) for c in result.conflicts] == \
+        [(8, '365', ['pc', 'phone'])]
+    # 重复导入不再报告新冲突，但冲突列表仍保留
+    assert pc.sync.import_delta(path).conflicts == []
+    assert [c.code for c in pc.sync.conflicts()] == [8]
+
+
+def test_state_survives_reopen(tmp_path, devices):
+    phone, pc = devices
+    phone.ledger.commit('365', [1])
+    path = str(tmp_path / 'phone.sync')
+    phone.sync.export_delta(path)
+    pc.sync.import_delta(path)
+    reopened = LedgerSync(pc.storage, ConsumptionLedger(pc.storage), 'pc')
+    assert reopened.import_delta(path).received == 0
+    assert reopened.device_counts() == {'phone': 1}
+
+
+def test_corrupt_file_is_rejected(tmp_path, devices):
+    _phone, pc = devices
+    path = tmp_path / 'bad.sync'
+    path.write_bytes(b'not a sync file')
+    with pytest.raises(ValueError):
+        pc.sync.import_delta(str(path))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""订单出码记录：预留、发出、撤销、取消"""
+
+from code_pool import encode_code
+from order_registry import OrderRegistry
+from storage import MemoryStorage
+
+CODES = [['AAAAAAAAAA', 'BBBBBBBBBB'], ['CCCCCCCCCC']]
+
+
+def _values(codes):
+    return {encode_code(code) for line_codes in codes for code in line_codes}
+
+
+def test_pending_until_done_and_reopened_by_undo():
+    storage = MemoryStorage()
+    registry = OrderRegistry(storage)
+    registry.add('A1', '365天+散装', CODES)
+    assert registry.pending_values() == _values(CODES)
+    registry.mark_done('A1')
+    assert registry.pending_values() == frozenset()
+
+    assert registry.orders_with_values([encode_code('CCCCCCCCCC'), 1]) == ['A1']
+    registry.reopen('A1')
+    reopened = OrderRegistry(storage)
+    assert not reopened.get('A1').done
+    assert reopened.get('A1').codes == CODES
+    assert reopened.pending_values() == _values(CODES)
+
+
+def test_pending_values_is_a_snapshot():
+    registry = OrderRegistry(MemoryStorage())
+    registry.add('A1', '', CODES)
+    snapshot = registry.pending_values()
+    registry.mark_done('A1')
+    assert snapshot == _values(CODES)
+
+
+def test_cancel_and_release_stale():
+    storage = MemoryStorage()
+    registry = OrderRegistry(storage)
+    registry.add('old', '', [['AAAAAAAAAA']])
+    registry.add('new', '', [['BBBBBBBBBB']])
+    registry.add('sent', '', [['CCCCCCCCCC']], done=True)
+    registry.orders['old'] = registry.orders['old']._replace(ts=0)
+
+    assert registry.release_stale(3600) == ['old']
+    assert not registry.cancel('sent')
+    assert registry.cancel('new')
+    reopened = OrderRegistry(storage)
+    assert sorted(reopened.orders) == ['sent']
+    assert reopened.pending_values() == frozenset()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""存储后端：日志追加、截断，文档读写"""
+
+import pytest
+
+from storage import STORAGE_BACKENDS, SQLiteStorage, open_storage
+
+
+@pytest.fixture(params=STORAGE_BACKENDS)
+def storage(request, tmp_path):
+    storage = open_storage(request.param, str(tmp_path))
+    yield storage
+    storage.close()
+
+
+def test_journal_append_read_truncate(storage):
+    storage.append('j', b'abcdef')
+    storage.append('j', b'ghij')
+    assert storage.size('j') == 10
+    assert storage.read('j', 4, 4) == b'efgh'
+    storage.truncate('j', 8)
+    assert storage.size('j') == 8
+    assert storage.read('j', 0, 100) == b'abcdefgh'
+    storage.append('j', b'XY')
+    assert storage.read('j', 0, 100) == b'abcdefghXY'
+    storage.truncate('j', 0)
+    assert storage.size('j') == 0
+
+
+def test_document_versions(storage):
+    assert storage.get('doc') is None and storage.version('doc') is None
+    storage.put('doc', b'one')
+    first = storage.version('doc')
+    storage.put('doc', b'two')
+    assert storage.get('doc') == b'two'
+    assert storage.version('doc') not in (None, first)
+    storage.delete('doc')
+    assert storage.get('doc') is None
+
+
+def test_sqlite_truncate_persists_and_is_transactional(tmp_path):
+    path = str(tmp_path / 'shipping.db')
+    storage = SQLiteStorage(path)
+    for chunk in (b'aaaa', b'bbbb', b'cccc'):
+        storage.append('j', chunk)
+    storage.truncate('j', 6)
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    assert storage.size('j') == 6
+    assert storage.read('j', 0, 100) == b'aaaabb'
+
+    # 事务中出错时全部回滚
+    with pytest.raises(RuntimeError):
+        with storage._transaction():
+            storage.db.execute('DELETE FROM journal WHERE name = ?', ('j',))
+            raise RuntimeError
+    assert not storage.db.in_transaction
+    storage._sizes.clear()
+    assert storage.read('j', 0, 100) == b'aaaabb'
+    storage.close()